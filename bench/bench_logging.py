@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Накладные расходы логирования в потоке запроса.
+
+Сравнивает синхронный RotatingFileHandler (как было) и очередь с фоновым
+писателем (DeferredQueueHandler + QueueListener из main.py) на типичных
+записях вебхука: REQ с телом запроса и ошибка REST с redact() ответа.
+
+    python bench/bench_logging.py --n 20000 --json bench_logging.json
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import statistics
+import sys
+import tempfile
+from logging.handlers import QueueListener, RotatingFileHandler
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import DeferredQueueHandler, Redacted, fmt  # noqa: E402
+
+BODY = ("event=ONIMBOTMESSAGEADD&data%5BPARAMS%5D%5BMESSAGE%5D=" + "%D0%BF%D1%80%D0%B8%D0%B2%D0%B5%D1%82+" * 200)[:4000]
+REST_ERROR = {
+    'error': 'QUERY_LIMIT_EXCEEDED',
+    'error_description': 'Too many requests',
+    'auth': {'access_token': 'a' * 40, 'refresh_token': 'r' * 40},
+    'result': {'users': [{'ID': str(i), 'NAME': 'Иван', 'token': 't' * 32} for i in range(50)]},
+}
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def _run(log, n):
+    samples = {'req_info': [], 'rest_error': [], 'debug_disabled': []}
+    hdrs = {'Host': 'example.com', 'Content-Type': 'application/x-www-form-urlencoded'}
+    for _ in range(n):
+        t = perf_counter()
+        log.info("REQ %s %s event=%s headers=%s body=%s", 'POST', '/python_bot/', 'ONIMBOTMESSAGEADD', hdrs, BODY)
+        samples['req_info'].append(perf_counter() - t)
+        t = perf_counter()
+        log.error("REST %s FAILED status=%s body=%s", 'user.get', 503, Redacted(REST_ERROR))
+        samples['rest_error'].append(perf_counter() - t)
+        t = perf_counter()
+        log.debug("REST %s OK body=%s", 'user.get', Redacted(REST_ERROR))
+        samples['debug_disabled'].append(perf_counter() - t)
+    return {
+        name: {
+            'mean_us': round(statistics.fmean(v) * 1e6, 2),
+            'p50_us': round(_percentile(v, 0.50) * 1e6, 2),
+            'p99_us': round(_percentile(v, 0.99) * 1e6, 2),
+        }
+        for name, v in samples.items()
+    }
+
+def _file_handler(directory):
+    handler = RotatingFileHandler(os.path.join(directory, 'bench.log'), maxBytes=2_000_000,
+                                  backupCount=5, encoding='utf-8')
+    handler.setFormatter(fmt)
+    return handler
+
+def bench_sync(directory, n):
+    log = logging.getLogger('bench.sync')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    log.handlers = [_file_handler(directory)]
+    result = _run(log, n)
+    log.handlers[0].close()
+    return result
+
+def bench_queued(directory, n):
+    log = logging.getLogger('bench.queued')
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    handler = DeferredQueueHandler(queue.Queue(n * 3 + 1))
+    listener = QueueListener(handler.queue, _file_handler(directory))
+    log.handlers = [handler]
+    listener.start()
+    result = _run(log, n)
+    t = perf_counter()
+    listener.stop()
+    result['drain_sec'] = round(perf_counter() - t, 3)
+    result['dropped'] = handler.dropped
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n', type=int, default=20000, help='итераций на сценарий')
+    parser.add_argument('--json', help='куда записать результаты')
+    args = parser.parse_args()
+
+    results = {'n': args.n}
+    with tempfile.TemporaryDirectory() as d:
+        results['sync'] = bench_sync(d, args.n)
+    with tempfile.TemporaryDirectory() as d:
+        results['queued'] = bench_queued(d, args.n)
+
+    for mode in ('sync', 'queued'):
+        for name in ('req_info', 'rest_error', 'debug_disabled'):
+            r = results[mode][name]
+            print(f"{mode:7} {name:15} mean={r['mean_us']:8.2f}us p50={r['p50_us']:8.2f}us p99={r['p99_us']:8.2f}us")
+    print(f"queued drain after run: {results['queued']['drain_sec']}s, dropped={results['queued']['dropped']}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
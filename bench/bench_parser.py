@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Микро-бенчмарк parse_bitrix_data на реальных формах вебхуков Б24.
+
+Корпус — bench/payloads/*.txt (тело запроса как есть, form-urlencoded).
+Перед замером проверяется, что новый парсер совпадает с прежним:
+при lists=False — байт в байт, при lists=True — всё дерево (включая auth)
+с точностью до замены узлов с ключами 0..n-1 на списки.
+
+    python bench/bench_parser.py --n 20000 --json bench_parser.json
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+from time import perf_counter
+from urllib.parse import parse_qsl
+
+from werkzeug.datastructures import MultiDict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from main import parse_bitrix_data  # noqa: E402
+
+def parse_bitrix_data_legacy(post_data):
+    """Прежняя реализация — эталон для сравнения."""
+    output = {}
+    for key, value in post_data.items():
+        keys = key.replace(']', '').split('[')
+        d = output
+        for k in keys[:-1]:
+            d = d.setdefault(k, {})
+        d[keys[-1]] = value
+    return output
+
+def listify(node):
+    """Эталонное превращение {'0': a, '1': b} в [a, b] по всему дереву."""
+    if isinstance(node, dict):
+        node = {k: listify(v) for k, v in node.items()}
+        if node and all(str(i) in node for i in range(len(node))):
+            return [node[str(i)] for i in range(len(node))]
+    return node
+
+def load_corpus():
+    corpus = {}
+    for path in sorted(glob.glob(os.path.join(BENCH_DIR, 'payloads', '*.txt'))):
+        with open(path, encoding='utf-8') as f:
+            body = f.read().strip()
+        corpus[os.path.splitext(os.path.basename(path))[0]] = MultiDict(parse_qsl(body, keep_blank_values=True))
+    return corpus
+
+def check(corpus):
+    for name, form in corpus.items():
+        legacy = parse_bitrix_data_legacy(form)
+        if parse_bitrix_data(form, lists=False) != legacy:
+            raise SystemExit(f"{name}: lists=False differs from legacy parser")
+        if parse_bitrix_data(form) != listify(legacy):
+            raise SystemExit(f"{name}: lists=True differs from listified legacy result")
+
+def timeit(fn, form, n):
+    fn(form)
+    t = perf_counter()
+    for _ in range(n):
+        fn(form)
+    return (perf_counter() - t) / n * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n', type=int, default=20000, help='итераций на payload')
+    parser.add_argument('--json', help='куда записать результаты')
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    check(corpus)
+    results = {}
+    for name, form in corpus.items():
+        results[name] = {
+            'keys': len(form),
+            'legacy_us': round(timeit(parse_bitrix_data_legacy, form, args.n), 2),
+            'dicts_us': round(timeit(lambda f: parse_bitrix_data(f, lists=False), form, args.n), 2),
+            'lists_us': round(timeit(parse_bitrix_data, form, args.n), 2),
+        }
+        r = results[name]
+        print(f"{name:28} keys={r['keys']:3} legacy={r['legacy_us']:7.2f}us "
+              f"lists=False {r['dicts_us']:7.2f}us lists=True {r['lists_us']:7.2f}us")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'n': args.n, 'payloads': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""Замер /api/dialogs, /api/dialogs/<chat_id>, /api/dialogs/batch, /api/search и /api/stats на синтетических БД.
+
+Для каждого размера (число сообщений) строит БД по схеме main.py — диалоги
+за последние --days дней, ~--per-dialog сообщений в диалоге, клиент и
+оператор в участниках — и гоняет сценарии чтения через gunicorn. Готовые БД
+кэшируются в --data-dir и переиспользуются между прогонами.
+
+С --writers N параллельно чтению идут вебхуки ONIMBOTMESSAGEADD (через
+фейковый REST из bench/fake_bitrix.py) — так видно, мешают ли записи чтению
+и появляются ли в bot.log ошибки блокировки SQLite.
+
+    python bench/bench_queries.py --sizes 10k,1m --requests 300 --concurrency 8 --json queries.json
+    python bench/bench_queries.py --sizes 10m --writers 4      # 10M строк: ~2 ГБ на диске
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+from main import SCHEMA_VERSION, close_db, migrate_db  # noqa: E402
+from stand import Stand, run_load, run_meta, write_results  # noqa: E402
+
+PHRASES = [
+    'Здравствуйте! Подскажите, пожалуйста, статус заказа',
+    'Добрый день, сейчас уточню информацию',
+    'Спасибо, жду ответа',
+    'Оплатили вчера, а письма так и нет',
+    'Передаю ваш вопрос в отдел доставки, ответим в течение часа',
+    'Можно ли изменить адрес доставки?',
+    'Да, конечно. Пришлите, пожалуйста, новый адрес и удобное время',
+    'Вложение: счёт.pdf',
+    'Ок',
+    'Проверил — заказ передан курьеру, трек-номер отправил на почту',
+]
+MANAGERS = 200
+
+def parse_size(text):
+    text = text.strip().lower()
+    mult = {'k': 10 ** 3, 'm': 10 ** 6}.get(text[-1:], 1)
+    return int(float(text.rstrip('km')) * mult)
+
+def build_db(path, messages, days, per_dialog, seed):
+    """Синтетическая БД: строки пишутся в порядке времени, как их пишет живой бот."""
+    rnd = random.Random(seed)
+    tmp = path + '.building'
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(tmp + suffix):
+            os.remove(tmp + suffix)
+    migrate_db(tmp)
+    close_db(tmp)
+    con = sqlite3.connect(tmp, isolation_level=None)
+    con.execute('PRAGMA synchronous=OFF')
+    dialogs = max(1, messages // per_dialog)
+    end = datetime.now().replace(microsecond=0)
+    start = end - timedelta(days=days)
+    con.execute('BEGIN')
+    con.executemany('INSERT INTO users (id, user_name, role) VALUES (?, ?, ?)',
+                    ((i, f'Оператор {i}', 'manager') for i in range(1, MANAGERS + 1)))
+    con.execute('COMMIT')
+
+    chat_base = 100000
+    per_day = dialogs / days
+    made_dialogs = made_messages = 0
+    t = perf_counter()
+    for day in range(days):
+        day_start = start + timedelta(days=day)
+        n_dialogs = int(per_day * (day + 1)) - int(per_day * day)
+        dialog_rows, user_rows, part_rows, msg_rows = [], [], [], []
+        for _ in range(n_dialogs):
+            made_dialogs += 1
+            chat_id = chat_base + made_dialogs
+            client_id = 1000000 + chat_id
+            manager_id = rnd.randint(1, MANAGERS)
+            opened = day_start + timedelta(seconds=rnd.randrange(86400))
+            dialog_rows.append((made_dialogs, chat_id, opened.isoformat()))
+            user_rows.append((client_id, f'Клиент {chat_id}', 'client'))
+            part_rows += [(made_dialogs, client_id), (made_dialogs, manager_id)]
+            ts = opened
+            for k in range(max(1, int(rnd.expovariate(1 / per_dialog)))):
+                if made_messages >= messages:
+                    break
+                made_messages += 1
+                ts += timedelta(seconds=rnd.randint(5, 600))
+                author = client_id if k % 2 == 0 else manager_id
+                msg_rows.append((chat_id, author, rnd.choice(PHRASES), ts.isoformat()))
+        msg_rows.sort(key=lambda r: r[3])
+        con.execute('BEGIN')
+        con.executemany('INSERT INTO dialogs (id, chat_id, start_time) VALUES (?, ?, ?)', dialog_rows)
+        con.executemany('INSERT INTO users (id, user_name, role) VALUES (?, ?, ?)', user_rows)
+        con.executemany('INSERT INTO dialog_participants (dialog_id, user_id) VALUES (?, ?)', part_rows)
+        con.executemany('INSERT INTO messages (dialog_chat_id, author_id, message_text, timestamp) '
+                        'VALUES (?, ?, ?, ?)', msg_rows)
+        con.execute('COMMIT')
+    con.execute('ANALYZE')
+    con.close()
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(tmp + suffix):
+            os.remove(tmp + suffix)
+    os.replace(tmp, path)
+    print(f"built {path}: {made_dialogs} dialogs, {made_messages} messages in {perf_counter() - t:.1f}s")
+
+def db_info(path):
+    con = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        version = con.execute('PRAGMA user_version').fetchone()[0]
+        messages = con.execute('SELECT max(id) FROM messages').fetchone()[0] or 0
+        days = [r[0] for r in con.execute(
+            'SELECT substr(start_time, 1, 10) AS d FROM dialogs GROUP BY d ORDER BY d')]
+        return version, messages, days
+    finally:
+        con.close()
+
+def sample_chats(path, day, n, rnd):
+    con = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        rows = con.execute('SELECT chat_id FROM dialogs WHERE start_time BETWEEN ? AND ?',
+                           (day, day + 'T23:59')).fetchall()
+    finally:
+        con.close()
+    return [rnd.choice(rows)[0] for _ in range(n)] if rows else []
+
+def collect_cursors(url, headers, day, limit, max_pages=200):
+    """Проходит день страницами (без замера) и возвращает курсоры для случайного доступа."""
+    cursors, cursor = [], None
+    session = requests.Session()
+    for _ in range(max_pages):
+        params = {'date': day, 'limit': limit}
+        if cursor:
+            params['cursor'] = cursor
+        cursor = session.get(url + '/api/dialogs', params=params, headers=headers, timeout=60).json().get('next_cursor')
+        if not cursor:
+            break
+        cursors.append(cursor)
+    return cursors
+
+def scenarios(stand, day, chats, cursors, limit):
+    url, headers = stand.url, stand.headers
+    pick = lambda seq, i: seq[i % len(seq)]
+    out = {
+        'dialogs_day': lambda s, i: s.get(url + '/api/dialogs', params={'date': day},
+                                          headers=headers, timeout=120),
+        'dialogs_first_page': lambda s, i: s.get(url + '/api/dialogs', params={'date': day, 'limit': limit},
+                                                 headers=headers, timeout=60),
+        'dialogs_day_ndjson': lambda s, i: s.get(url + '/api/dialogs', params={'date': day, 'stream': 'ndjson'},
+                                                 headers=headers, timeout=120),
+    }
+    # опрос дашборда без изменений: ETag первого ответа в If-None-Match -> 304
+    etag = requests.get(url + '/api/dialogs', params={'date': day}, headers=headers, timeout=120).headers.get('ETag')
+    if etag:
+        out['dialogs_day_304'] = lambda s, i: s.get(url + '/api/dialogs', params={'date': day},
+                                                    headers={**headers, 'If-None-Match': etag}, timeout=60)
+    if cursors:
+        out['dialogs_cursor_page'] = lambda s, i: s.get(
+            url + '/api/dialogs', params={'date': day, 'limit': limit, 'cursor': pick(cursors, i)},
+            headers=headers, timeout=60)
+    if chats:
+        out['dialog_details'] = lambda s, i: s.get(url + f'/api/dialogs/{pick(chats, i)}', params={'date': day},
+                                                   headers=headers, timeout=60)
+        out['dialog_details_page'] = lambda s, i: s.get(url + f'/api/dialogs/{pick(chats, i)}',
+                                                        params={'date': day, 'limit': 20},
+                                                        headers=headers, timeout=60)
+        # дашборд: 200 диалогов одним запросом вместо 200 запросов dialog_details
+        batch = lambda i: ','.join(str(pick(chats, i * 200 + k)) for k in range(200))
+        out['dialogs_batch_200'] = lambda s, i: s.get(url + '/api/dialogs/batch',
+                                                      params={'date': day, 'chat_ids': batch(i), 'messages': 1},
+                                                      headers=headers, timeout=60)
+        out['search_chat'] = lambda s, i: s.get(url + '/api/search', params={'q': 'адрес', 'chat_id': pick(chats, i)},
+                                                headers=headers, timeout=60)
+    out['dialogs_batch_day'] = lambda s, i: s.get(url + '/api/dialogs/batch', params={'date': day, 'limit': limit},
+                                                  headers=headers, timeout=60)
+    out['stats_day'] = lambda s, i: s.get(url + '/api/stats', params={'date': day, 'tz_offset': 3},
+                                          headers=headers, timeout=60)
+    out['search_rank'] = lambda s, i: s.get(url + '/api/search', params={'q': 'курьеру трек'},
+                                            headers=headers, timeout=60)
+    out['search_recent'] = lambda s, i: s.get(url + '/api/search', params={'q': 'заказ', 'order': 'recent'},
+                                              headers=headers, timeout=60)
+    return out
+
+def bench_size(args, size, rnd):
+    path = os.path.join(args.data_dir, f'synthetic_{size}.db')
+    if args.rebuild or not os.path.exists(path) or db_info(path)[0] != SCHEMA_VERSION:
+        build_db(path, size, args.days, args.per_dialog, args.seed)
+    _, messages, days = db_info(path)
+    day = days[len(days) // 2]
+    chats = sample_chats(path, day, 1000, rnd)
+    result = {'db_file': path, 'db_bytes': os.path.getsize(path), 'messages': messages,
+              'date': day, 'scenarios': {}}
+
+    writer = None
+    with Stand(workers=args.workers, threads=args.threads, db_file=path, keep=args.keep) as stand:
+        if args.writers:
+            writer = start_writers(stand, args)
+        cursors = collect_cursors(stand.url, stand.headers, day, args.limit)
+        for name, make_request in scenarios(stand, day, chats, cursors, args.limit).items():
+            run_load(make_request, 1, total=min(5, args.requests))  # прогрев кэша страниц
+            r = run_load(make_request, args.concurrency, total=args.requests)
+            result['scenarios'][name] = r
+            lat = r['latency']
+            print(f"{size:>10} {name:22} rps={r['throughput_rps']:8.1f} p50={lat['p50_ms']:9.2f}ms "
+                  f"p99={lat['p99_ms']:9.2f}ms status={r['status']}")
+        if writer:
+            result['writes'] = writer.stop()
+        result['log'] = stand.log_errors()
+    print(f"{size:>10} log_errors={result['log']['errors']} db_locked={result['log']['db_locked']}")
+    return result
+
+def start_writers(stand, args):
+    """Фоновая запись вебхуками на время чтения; stop() вернёт её статистику."""
+    import threading
+    from bench_webhooks import CONTENT_TYPE, build_bodies, load_payloads, render
+    from fake_bitrix import start_fake_bitrix
+
+    payloads = load_payloads()
+    fake = start_fake_bitrix(latency_ms=args.rest_latency_ms, seed=args.seed)
+    requests.post(stand.url + '/python_bot/', data=render(payloads['onappinstall'], fake.endpoint),
+                  headers=CONTENT_TYPE, timeout=30).raise_for_status()
+    bodies = build_bodies(payloads, fake.endpoint, 20000, 5000, 0.02, args.seed)
+    stop = threading.Event()
+    box = {}
+
+    def loop():
+        box['result'] = run_load(lambda s, i: s.post(stand.url + '/python_bot/', data=bodies[i % len(bodies)],
+                                                     headers=CONTENT_TYPE, timeout=60),
+                                 args.writers, stop=stop)
+
+    class Writer:
+        def stop(self):
+            stop.set()
+            thread.join()
+            fake.shutdown()
+            return box.get('result', {})
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return Writer()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10k,1m', help='размеры БД в сообщениях через запятую: 10k,1m,10m')
+    parser.add_argument('--days', type=int, default=90, help='за сколько дней диалоги')
+    parser.add_argument('--per-dialog', type=int, default=20, help='сообщений в диалоге в среднем')
+    parser.add_argument('--requests', type=int, default=200, help='запросов на сценарий')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--limit', type=int, default=100, help='размер страницы для сценариев с limit')
+    parser.add_argument('--workers', type=int, default=2, help='воркеры gunicorn')
+    parser.add_argument('--threads', type=int, default=4, help='потоки на воркер gunicorn')
+    parser.add_argument('--writers', type=int, default=0, help='параллельных клиентов-вебхуков на время замера')
+    parser.add_argument('--rest-latency-ms', type=float, default=50.0, help='задержка фейкового REST для --writers')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'b24bench-data'))
+    parser.add_argument('--rebuild', action='store_true', help='пересоздать синтетические БД')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help='не удалять каталог инстанса')
+    parser.add_argument('--json', help='куда записать результаты')
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    rnd = random.Random(args.seed)
+    results = {'meta': run_meta(args), 'sizes': {}}
+    for text in args.sizes.split(','):
+        size = parse_size(text)
+        results['sizes'][str(size)] = bench_size(args, size, rnd)
+    write_results(args.json, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Нагрузка вебхуками: реальные формы Б24 из bench/payloads против main.py под gunicorn.
+
+Поднимает фейковый REST Б24 (bench/fake_bitrix.py) и временный инстанс,
+устанавливает приложение (ONAPPINSTALL), затем шлёт смесь событий
+ONIMBOTMESSAGEADD/ONIMBOTJOINCHAT по случайным чатам. Пишет пропускную
+способность, p50/p99, статусы, ошибки блокировок SQLite из bot.log,
+очередь REST-задач и число вызовов REST. --redeliver-share повторяет часть
+уже отправленных событий, как Б24 при медленном ответе: дубли не должны
+добавлять ни строк messages, ни вызовов REST.
+
+    python bench/bench_webhooks.py --workers 4 --concurrency 32 --duration 30 --json webhooks.json
+    INGEST_MODE=group python bench/bench_webhooks.py ...   # переменные окружения уходят в инстанс
+    python bench/bench_webhooks.py --server async --workers 1 --concurrency 300
+    python bench/bench_webhooks.py --redeliver-share 0.2 ...
+    python bench/bench_webhooks.py --token-ttl 5 ...   # токен истекает каждые 5 с: нужны refresh, а не expired_token
+"""
+import argparse
+import glob
+import os
+import random
+import sys
+from time import sleep, time
+from urllib.parse import parse_qsl, urlencode
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_bitrix import start_fake_bitrix  # noqa: E402
+from stand import BENCH_DIR, Stand, run_load, run_meta, write_results  # noqa: E402
+
+CONTENT_TYPE = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+def load_payloads():
+    payloads = {}
+    for path in sorted(glob.glob(os.path.join(BENCH_DIR, 'payloads', '*.txt'))):
+        with open(path, encoding='utf-8') as f:
+            name = os.path.splitext(os.path.basename(path))[0]
+            payloads[name] = parse_qsl(f.read().strip(), keep_blank_values=True)
+    return payloads
+
+def render(pairs, endpoint, chat_id=None, message_id=None, ts=None):
+    """Форма с подменёнными client_endpoint, чатом, id сообщения и временем события."""
+    out = []
+    for key, value in pairs:
+        if key == 'auth[client_endpoint]':
+            value = endpoint
+        elif chat_id is not None and key.endswith(('[CHAT_ID]', '[TO_CHAT_ID]')):
+            value = str(chat_id)
+        elif chat_id is not None and key.endswith('[DIALOG_ID]'):
+            value = f'chat{chat_id}'
+        elif message_id is not None and key.endswith('[MESSAGE_ID]'):
+            value = str(message_id)
+        elif ts is not None and key == 'ts':
+            value = str(ts)
+        out.append((key, value))
+    return urlencode(out)
+
+def build_bodies(payloads, endpoint, n, chats, join_share, seed, redeliver_share=0.0):
+    """Заранее готовит n тел запросов, чтобы кодирование не попадало в замер.
+
+    Вторым значением — сколько из них повторные доставки уже отправленных событий.
+    """
+    rnd = random.Random(seed)
+    messages = [p for name, p in payloads.items() if name.startswith('onimbotmessageadd')]
+    join = payloads['onimbotjoinchat']
+    bodies = []
+    redelivered = 0
+    for i in range(n):
+        if bodies and rnd.random() < redeliver_share:
+            # повтор недавнего события: Б24 шлёт его снова, пока не дождётся ответа
+            bodies.append(bodies[max(0, len(bodies) - 1 - rnd.randrange(50))])
+            redelivered += 1
+            continue
+        chat_id = 100000 + rnd.randrange(chats)
+        if rnd.random() < join_share:
+            bodies.append(render(join, endpoint, chat_id, ts=1738317540 + i))
+        else:
+            bodies.append(render(rnd.choice(messages), endpoint, chat_id, 5000000 + i))
+    return bodies, redelivered
+
+def duplicates_skipped(stand):
+    """Сколько повторных доставок отсеяно — из b24bot_webhook_duplicates_total по всем воркерам."""
+    r = requests.get(stand.url + '/api/admin/metrics', headers=stand.headers, timeout=30)
+    out = {}
+    for line in r.text.splitlines() if r.ok else ():
+        if line.startswith('b24bot_webhook_duplicates_total{'):
+            labels, value = line.rsplit(' ', 1)
+            out[labels.split('event="', 1)[1].split('"', 1)[0]] = int(float(value))
+    return out
+
+def wait_jobs(stand, timeout):
+    """Ждёт, пока фоновые REST-задачи разойдутся; вернёт последнюю сводку очереди."""
+    deadline = time() + timeout
+    stats = {}
+    while time() < deadline:
+        stats = stand.admin('/api/admin/jobs?limit=10')
+        if not stats.get('pending'):
+            break
+        sleep(0.5)
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=2, help='воркеры gunicorn')
+    parser.add_argument('--threads', type=int, default=4, help='потоки на воркер gunicorn')
+    parser.add_argument('--server', choices=('sync', 'async'), default='sync',
+                        help='async — main_async.py на воркерах aiohttp')
+    parser.add_argument('--concurrency', type=int, default=16, help='параллельных клиентов')
+    parser.add_argument('--duration', type=float, default=20.0, help='секунд нагрузки')
+    parser.add_argument('--requests', type=int, default=0, help='вместо --duration: ровно столько запросов')
+    parser.add_argument('--chats', type=int, default=500, help='сколько разных чатов')
+    parser.add_argument('--join-share', type=float, default=0.05, help='доля ONIMBOTJOINCHAT')
+    parser.add_argument('--redeliver-share', type=float, default=0.0, help='доля повторных доставок')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='задержка фейкового REST')
+    parser.add_argument('--jitter-ms', type=float, default=20.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля 503 от фейкового REST')
+    parser.add_argument('--limit-rate', type=float, default=0.0, help='доля QUERY_LIMIT_EXCEEDED')
+    parser.add_argument('--token-ttl', type=float, default=0.0, help='время жизни access_token в фейковом Б24')
+    parser.add_argument('--drain-sec', type=float, default=30.0, help='сколько ждать фоновые задачи после нагрузки')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true', help='не удалять каталог инстанса')
+    parser.add_argument('--json', help='куда записать результаты')
+    args = parser.parse_args()
+
+    payloads = load_payloads()
+    fake = start_fake_bitrix(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                             error_rate=args.error_rate, limit_rate=args.limit_rate, seed=args.seed,
+                             token_ttl=args.token_ttl)
+    n = args.requests or int(args.duration * 2000) + 1000
+    bodies, redelivered = build_bodies(payloads, fake.endpoint, n, args.chats, args.join_share, args.seed,
+                                       args.redeliver_share)
+    results = {'meta': run_meta(args), 'env': {k: v for k, v in os.environ.items()
+                                               if k.startswith(('INGEST_', 'DB_', 'RATE_LIMIT_', 'JOB_', 'LOG_'))}}
+
+    env = {'B24_OAUTH_URL': fake.oauth_url, 'B24_CLIENT_ID': 'bench', 'B24_CLIENT_SECRET': 'bench'}
+    if args.token_ttl:
+        # обновлять заранее, но не на каждом вызове: запас — треть жизни токена
+        env['AUTH_REFRESH_MARGIN_SEC'] = str(args.token_ttl / 3)
+    with Stand(workers=args.workers, threads=args.threads, keep=args.keep, server=args.server, env=env) as stand:
+        r = requests.post(stand.url + '/python_bot/', data=render(payloads['onappinstall'], fake.endpoint),
+                          headers=CONTENT_TYPE, timeout=30)
+        if not r.ok:
+            raise SystemExit(f"ONAPPINSTALL failed: {r.status_code} {r.text[:200]}")
+
+        url = stand.url + '/python_bot/'
+        load = run_load(lambda s, i: s.post(url, data=bodies[i % len(bodies)], headers=CONTENT_TYPE, timeout=60),
+                        args.concurrency, duration=None if args.requests else args.duration,
+                        total=args.requests or None)
+        results['load'] = load
+        results['jobs'] = wait_jobs(stand, args.drain_sec)
+        results['db'] = stand.admin('/api/admin/db')
+        results['duplicates'] = {'prepared': redelivered, 'skipped': duplicates_skipped(stand)}
+        results['log'] = stand.log_errors()
+    results['rest_calls'] = fake.stats()
+    fake.shutdown()
+
+    lat = load['latency']
+    print(f"requests={load['requests']} rps={load['throughput_rps']} "
+          f"p50={lat['p50_ms']}ms p99={lat['p99_ms']}ms max={lat['max_ms']}ms")
+    print(f"status={load['status']} log_errors={results['log']['errors']} db_locked={results['log']['db_locked']}")
+    print(f"rest_calls={results['rest_calls']} duplicates={results['duplicates']}")
+    write_results(args.json, results)
+
+if __name__ == '__main__':
+    main()
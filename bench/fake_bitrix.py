@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""Локальная замена REST API Битрикс24 для нагрузочных замеров.
+
+Отвечает на методы, которые вызывает main.py: imbot.register, im.chat.get,
+user.get, imopenlines.bot.session.transfer и batch (со ссылками
+$result[ключ][поле] между командами). Задержка, доля 5xx и доля
+QUERY_LIMIT_EXCEEDED настраиваются; счётчики вызовов — GET /_stats.
+
+С --token-ttl токены живут заданное число секунд (незнакомый — с первого
+вызова): после этого REST отвечает 401 expired_token, а новый токен выдаёт
+GET /oauth/token/?grant_type=refresh_token. Refresh token, как в Б24,
+одноразовый: повторное использование — invalid_grant.
+
+    python bench/fake_bitrix.py --port 8091 --latency-ms 80 --jitter-ms 40 --error-rate 0.01
+    # в auth[client_endpoint] указывать http://127.0.0.1:8091/rest/, B24_OAUTH_URL=http://127.0.0.1:8091/oauth/token/
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep, time
+from urllib.parse import parse_qsl, urlsplit
+
+USERS_PER_CHAT = 3
+_REF_RE = re.compile(r'^\$result\[([^\]]+)\]((?:\[[^\]]*\])*)$')
+
+def chat_users(chat_id):
+    """Детерминированный состав чата: клиент и пара операторов."""
+    chat_id = int(chat_id or 0)
+    return [1000000 + chat_id] + [1 + (chat_id + i) % 50 for i in range(USERS_PER_CHAT - 1)]
+
+def user_record(user_id):
+    user_id = int(user_id)
+    client = user_id >= 1000000
+    return {
+        'ID': str(user_id),
+        'NAME': 'Клиент' if client else 'Оператор',
+        'LAST_NAME': str(user_id),
+        'IS_EXTRANET': 'Y' if client else 'N',
+    }
+
+def _php_parse(query):
+    """'ID[0]=1&ID[1]=2&X=y' -> {'ID': ['1', '2'], 'X': 'y'} (плоско, как нужно методам ниже)."""
+    out = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        name, _, rest = key.partition('[')
+        if rest:
+            out.setdefault(name, []).append(value)
+        else:
+            out[name] = value
+    return out
+
+def _resolve(value, results):
+    """Подставляет '$result[chat][users]' из результатов предыдущих команд batch."""
+    if not isinstance(value, str):
+        return value
+    m = _REF_RE.match(value)
+    if not m:
+        return value
+    node = results.get(m.group(1))
+    for part in re.findall(r'\[([^\]]*)\]', m.group(2)):
+        if isinstance(node, list):
+            node = node[int(part)] if part.isdigit() and int(part) < len(node) else None
+        elif isinstance(node, dict):
+            node = node.get(part)
+        else:
+            node = None
+    return node
+
+class FakeBitrix(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, limit_rate=0.0, seed=None,
+                 token_ttl=0.0):
+        super().__init__(address, _Handler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.limit_rate = limit_rate
+        self.token_ttl = token_ttl
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.tokens = {}          # access_token -> когда истекает (monotonic)
+        self.used_refresh = set()
+
+    @property
+    def endpoint(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/rest/'
+
+    @property
+    def oauth_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/oauth/token/'
+
+    def token_valid(self, token):
+        if not self.token_ttl:
+            return True
+        with self.lock:
+            return self.tokens.setdefault(token, monotonic() + self.token_ttl) > monotonic()
+
+    def refresh(self, query):
+        """(статус, тело) ответа OAuth-сервера на grant_type=refresh_token."""
+        self.count('oauth.refresh')
+        token = query.get('refresh_token')
+        ttl = self.token_ttl or 3600
+        with self.lock:
+            if query.get('grant_type') != 'refresh_token' or not token or token in self.used_refresh:
+                self.calls['!invalid_grant'] = self.calls.get('!invalid_grant', 0) + 1
+                return 400, {'error': 'invalid_grant', 'error_description': 'Invalid refresh token'}
+            self.used_refresh.add(token)
+            access = uuid.uuid4().hex
+            self.tokens[access] = monotonic() + ttl
+        return 200, {'access_token': access, 'refresh_token': uuid.uuid4().hex, 'expires': int(time() + ttl),
+                     'expires_in': int(ttl), 'client_endpoint': self.endpoint, 'server_endpoint': self.oauth_url,
+                     'domain': 'example.bitrix24.ru', 'member_id': 'fake', 'status': 'L'}
+
+    def count(self, key):
+        with self.lock:
+            self.calls[key] = self.calls.get(key, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def call(self, method, params):
+        """(результат, ошибка) одного метода — общая часть прямого вызова и batch."""
+        if method == 'imbot.register':
+            return 528, None
+        if method == 'im.chat.get':
+            chat_id = params.get('CHAT_ID') or str(params.get('DIALOG_ID', '')).replace('chat', '')
+            return {'id': int(chat_id or 0), 'type': 'lines', 'users': chat_users(chat_id)}, None
+        if method == 'user.get':
+            ids = params.get('ID') or params.get('FILTER', {}).get('ID') or []
+            if not isinstance(ids, list):
+                ids = [ids]
+            return [user_record(i) for i in ids if str(i).isdigit()], None
+        if method == 'imopenlines.bot.session.transfer':
+            return True, None
+        return None, {'error': 'ERROR_METHOD_NOT_FOUND', 'error_description': f'Method not found: {method}'}
+
+    def batch(self, params):
+        cmd = params.get('cmd') or {}
+        halt = str(params.get('halt', 0)) in ('1', 'true')
+        body = {'result': {}, 'result_error': {}, 'result_total': {}, 'result_next': {}, 'result_time': {}}
+        for key, line in cmd.items():
+            method, _, query = line.partition('?')
+            sub = {k: _resolve(v, body['result']) for k, v in _php_parse(query).items()}
+            self.count(f'batch:{method}')
+            result, error = self.call(method, sub)
+            if error:
+                body['result_error'][key] = error
+                if halt:
+                    break
+            else:
+                body['result'][key] = result
+                if isinstance(result, list):
+                    body['result_total'][key] = len(result)
+        return body, None
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith('/_stats'):
+            return self._send(200, self.server.stats())
+        if self.path.startswith('/oauth/token/'):
+            return self._send(*self.server.refresh(dict(parse_qsl(urlsplit(self.path).query))))
+        self._send(404, {'error': 'NOT_FOUND'})
+
+    def do_POST(self):
+        srv = self.server
+        raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = urlsplit(self.path).path
+        method = path.rsplit('/', 1)[-1].removesuffix('.json')
+        if 'json' in (self.headers.get('Content-Type') or ''):
+            params = json.loads(raw or b'{}')
+        else:
+            params = _php_parse(raw.decode('utf-8'))
+        srv.count(method)
+
+        delay = srv.latency_ms + srv.random.uniform(-srv.jitter_ms, srv.jitter_ms)
+        if delay > 0:
+            sleep(delay / 1000)
+        roll = srv.random.random()
+        if roll < srv.error_rate:
+            srv.count('!http_503')
+            return self._send(503, {'error': 'INTERNAL_SERVER_ERROR', 'error_description': 'fake outage'})
+        if roll < srv.error_rate + srv.limit_rate:
+            srv.count('!query_limit')
+            return self._send(503, {'error': 'QUERY_LIMIT_EXCEEDED', 'error_description': 'Too many requests'})
+        if not srv.token_valid(params.get('auth')):
+            srv.count('!expired_token')
+            return self._send(401, {'error': 'expired_token', 'error_description': 'The access token provided has expired.'})
+
+        if method == 'batch':
+            result, error = srv.batch(params)
+        else:
+            result, error = srv.call(method, params)
+        if error:
+            return self._send(400, error)
+        self._send(200, {'result': result, 'time': {'duration': delay / 1000}})
+
+def start_fake_bitrix(port=0, **options):
+    """Поднимает сервер в фоновом потоке; вернёт FakeBitrix (shutdown() — остановить)."""
+    server = FakeBitrix(('127.0.0.1', port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True, name='fake-bitrix').start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8091)
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='средняя задержка ответа')
+    parser.add_argument('--jitter-ms', type=float, default=20.0, help='разброс задержки, ±')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 503')
+    parser.add_argument('--limit-rate', type=float, default=0.0, help='доля ответов QUERY_LIMIT_EXCEEDED')
+    parser.add_argument('--token-ttl', type=float, default=0.0, help='сколько секунд живёт access_token (0 — вечно)')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    server = FakeBitrix(('127.0.0.1', args.port), args.latency_ms, args.jitter_ms,
+                        args.error_rate, args.limit_rate, args.seed, args.token_ttl)
+    print(f"fake Bitrix24 REST on {server.endpoint}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
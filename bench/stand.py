@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""Общая обвязка нагрузочных замеров: временный инстанс под gunicorn и генератор нагрузки.
+
+Инстанс — временный каталог со ссылками на main.py и config.py: BASE_DIR в
+main.py берётся из пути файла без разыменования ссылок, поэтому БД, auth.json
+и bot.log живут в этом каталоге и не трогают рабочие файлы.
+"""
+import glob
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from datetime import datetime
+from time import perf_counter, sleep, time
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+API_TOKEN = 'bench-token'
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+def latency_summary(samples):
+    """Секунды -> сводка в миллисекундах."""
+    return {
+        'count': len(samples),
+        'mean_ms': round(statistics.fmean(samples) * 1000, 3) if samples else 0.0,
+        'p50_ms': round(percentile(samples, 0.50) * 1000, 3),
+        'p99_ms': round(percentile(samples, 0.99) * 1000, 3),
+        'max_ms': round(max(samples) * 1000, 3) if samples else 0.0,
+    }
+
+def run_meta(args):
+    """Окружение прогона — чтобы результаты разных машин и коммитов можно было сравнивать."""
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                             capture_output=True, text=True, timeout=10).stdout.strip()
+    except Exception:
+        rev = None
+    return {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'git_rev': rev or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+    }
+
+def write_results(path, results):
+    if path:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"results -> {path}")
+
+class Stand:
+    """main.py под gunicorn во временном каталоге.
+
+        with Stand(workers=4, env={'INGEST_MODE': 'group'}) as stand:
+            requests.get(stand.url + '/python_bot/')
+
+    server='async' — main_async.py на воркерах aiohttp; threads тогда задаёт ASYNC_THREADS.
+    """
+
+    def __init__(self, workers=2, threads=4, env=None, db_file=None, keep=False, server='sync'):
+        self.workers = workers
+        self.threads = threads
+        self.env = env or {}
+        self.db_file = db_file
+        self.keep = keep
+        self.server = server
+        self.dir = None
+        self.proc = None
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp(prefix='b24bench-')
+        for name in ('main.py', 'main_async.py', 'config.py'):
+            os.symlink(os.path.join(REPO_DIR, name), os.path.join(self.dir, name))
+        if self.db_file:
+            # большие синтетические БД не копируем — gunicorn читает их по ссылке
+            os.symlink(os.path.abspath(self.db_file), os.path.join(self.dir, 'dialogs.db'))
+        env = dict(os.environ)
+        env.update({
+            'API_SECRET_TOKEN': API_TOKEN,
+            'INSTANCE': 'bench',
+            # лимитер настроен на реальный портал; замеряем приложение, а не паузы
+            'RATE_LIMIT_RPS': env.get('RATE_LIMIT_RPS', '10000'),
+            'RATE_LIMIT_BURST': env.get('RATE_LIMIT_BURST', '10000'),
+        })
+        env.update({k: str(v) for k, v in self.env.items()})
+        cmd = [sys.executable, '-m', 'gunicorn', '-w', str(self.workers),
+               '-b', f'127.0.0.1:{self.port}', '--log-level', 'warning']
+        if self.server == 'async':
+            env.setdefault('ASYNC_THREADS', str(self.threads))
+            cmd += ['-k', 'aiohttp.GunicornWebWorker', 'main_async:app']
+        else:
+            cmd += ['--threads', str(self.threads), 'main:app']
+        self.proc = subprocess.Popen(cmd, cwd=self.dir, env=env,
+                                     stdout=subprocess.DEVNULL, stderr=open(self.path('gunicorn.err'), 'wb'))
+        deadline = time() + 30
+        while time() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"gunicorn exited: {open(self.path('gunicorn.err')).read()[-2000:]}")
+            try:
+                if requests.get(self.url + '/python_bot/', timeout=1).ok:
+                    return self
+            except requests.RequestException:
+                pass
+            sleep(0.1)
+        self.__exit__(None, None, None)
+        raise RuntimeError('gunicorn did not start in 30s')
+
+    def __exit__(self, *exc):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        if self.dir and not self.keep:
+            shutil.rmtree(self.dir, ignore_errors=True)
+        elif self.dir:
+            print(f"stand kept in {self.dir}")
+
+    @property
+    def headers(self):
+        # админка принимает X-API-Token, публичный API — Bearer
+        return {'Authorization': f'Bearer {API_TOKEN}', 'X-API-Token': API_TOKEN}
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def admin(self, path, method='GET'):
+        r = requests.request(method, self.url + path, headers=self.headers, timeout=30)
+        return r.json() if r.ok else {'status': r.status_code}
+
+    def log_errors(self):
+        """Ошибки из bot.log*: всего ERROR и сколько из них — блокировки SQLite."""
+        errors = locked = 0
+        for name in glob.glob(self.path('bot.log*')):
+            with open(name, encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    if ' - ERROR - ' in line:
+                        errors += 1
+                    if 'database is locked' in line or 'database is busy' in line:
+                        locked += 1
+        return {'errors': errors, 'db_locked': locked}
+
+def run_load(make_request, concurrency, duration=None, total=None, stop=None):
+    """Гоняет make_request(session, i) из concurrency потоков.
+
+    make_request возвращает requests.Response. Останавливается через duration
+    секунд, после total запросов или по событию stop. Возвращает пропускную способность,
+    перцентили задержки и разбивку по статусам.
+    """
+    lock = threading.Lock()
+    counter = iter(range(total if total else 10 ** 12))
+    latencies, statuses, failures = [], {}, []
+    stop_at = perf_counter() + duration if duration else None
+
+    def worker():
+        session = requests.Session()
+        local_lat, local_status = [], {}
+        while (stop_at is None or perf_counter() < stop_at) and not (stop and stop.is_set()):
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            t = perf_counter()
+            try:
+                r = make_request(session, i)
+                key = str(r.status_code)
+                r.content
+            except requests.RequestException as e:
+                key = type(e).__name__
+                failures.append(str(e)[:200])
+            local_lat.append(perf_counter() - t)
+            local_status[key] = local_status.get(key, 0) + 1
+        with lock:
+            latencies.extend(local_lat)
+            for k, v in local_status.items():
+                statuses[k] = statuses.get(k, 0) + v
+
+    started = perf_counter()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = perf_counter() - started
+    result = {
+        'requests': len(latencies),
+        'elapsed_sec': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'status': statuses,
+        'latency': latency_summary(latencies),
+    }
+    if failures:
+        result['client_errors'] = failures[:10]
+    return result
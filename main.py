@@ -1,14 +1,36 @@
 # -*- coding: utf-8 -*-
+import atexit
+import base64
+import bisect
+import contextvars
+import csv
+import fcntl
+import io
 import json
 import logging
 import os
+import queue
+import random
+import re
 import sqlite3
+import tempfile
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from contextlib import contextmanager
 from datetime import datetime, timedelta, time
-from functools import wraps
+from functools import lru_cache, wraps
+from time import monotonic, perf_counter, sleep, time as unix_time
+from urllib.parse import quote, urlsplit
 
+import click
 import requests
-from flask import Flask, request, jsonify, abort, Response
-from logging.handlers import RotatingFileHandler
+from requests.adapters import HTTPAdapter
+from flask import Flask, request, jsonify, abort, g, Response
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from config import get_app_config
 
 # --- Базовая директория инстанса ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -17,6 +39,8 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 LOG_FILE  = os.path.join(BASE_DIR, "bot.log")
 AUTH_FILE = os.path.join(BASE_DIR, "auth.json")
 DB_FILE   = os.path.join(BASE_DIR, "dialogs.db")
+RATE_LIMIT_DB = os.path.join(BASE_DIR, "ratelimit.db")
+METRICS_DIR   = os.path.join(BASE_DIR, "metrics")
 
 # Файлы-флаги для мягкого включения/выключения
 ENABLED_FLAG  = os.path.join(BASE_DIR, "ENABLED")
@@ -28,16 +52,193 @@ BOT_CODE = os.environ.get('BOT_CODE', f'py_interceptor_bot_{INSTANCE}')
 API_SECRET_TOKEN = os.environ.get('API_SECRET_TOKEN', 'asd1a2s3d4asd41a23sdas4d')
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
 
+# --- SQLite ---
+DB_BUSY_TIMEOUT_MS   = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+DB_CACHED_STATEMENTS = int(os.environ.get('DB_CACHED_STATEMENTS', '256'))
+DB_MAX_CONNS_PER_THREAD = int(os.environ.get('DB_MAX_CONNS_PER_THREAD', '16'))
+
+# --- Запись событий вебхука ---
+# direct — событие пишется сразу одной транзакцией; group — через общий писатель
+# с групповым коммитом (ответ ждёт коммита); async — через писатель без ожидания
+INGEST_MODE        = os.environ.get('INGEST_MODE', 'direct').lower()
+INGEST_QUEUE_SIZE  = int(os.environ.get('INGEST_QUEUE_SIZE', '10000'))
+INGEST_BATCH_SIZE  = int(os.environ.get('INGEST_BATCH_SIZE', '200'))
+INGEST_FLUSH_MS    = int(os.environ.get('INGEST_FLUSH_MS', '50'))
+# повторные доставки Б24 в этом окне отвечают OK без обработки
+DEDUP_WINDOW_SEC   = float(os.environ.get('DEDUP_WINDOW_SEC', '3600'))
+DEDUP_MEMORY_SIZE  = int(os.environ.get('DEDUP_MEMORY_SIZE', '20000'))
+DEDUP_CLEANUP_SEC  = 60.0
+
+# --- REST Б24 ---
+REST_TIMEOUT       = float(os.environ.get('REST_TIMEOUT', '15'))
+REST_POOL_SIZE     = int(os.environ.get('REST_POOL_SIZE', '10'))
+# лимит Bitrix24 на портал: ~2 запроса/с с запасом на всплеск
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') not in ('0', 'false', 'no')
+RATE_LIMIT_RPS     = float(os.environ.get('RATE_LIMIT_RPS', '2'))
+RATE_LIMIT_BURST   = float(os.environ.get('RATE_LIMIT_BURST', '50'))
+RATE_LIMIT_WAIT_SEC = float(os.environ.get('RATE_LIMIT_WAIT_SEC', '60'))
+RATE_LIMIT_PENALTY_SEC = float(os.environ.get('RATE_LIMIT_PENALTY_SEC', '2'))
+
+# --- Очередь REST-задач ---
+JOB_WORKERS        = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_MAX_ATTEMPTS   = int(os.environ.get('JOB_MAX_ATTEMPTS', '8'))
+JOB_BACKOFF_SEC    = float(os.environ.get('JOB_BACKOFF_SEC', '2'))
+JOB_BACKOFF_MAX_SEC = float(os.environ.get('JOB_BACKOFF_MAX_SEC', '600'))
+JOB_LEASE_SEC      = float(os.environ.get('JOB_LEASE_SEC', '120'))
+JOB_POLL_SEC       = float(os.environ.get('JOB_POLL_SEC', '1'))
+
+# --- Авторизация Б24 ---
+AUTH_RECHECK_SEC   = float(os.environ.get('AUTH_RECHECK_SEC', '1'))
+# access_token живёт час: обновляем заранее, за AUTH_REFRESH_MARGIN_SEC до истечения
+B24_OAUTH_URL      = os.environ.get('B24_OAUTH_URL', 'https://oauth.bitrix.info/oauth/token/')
+AUTH_REFRESH_MARGIN_SEC = float(os.environ.get('AUTH_REFRESH_MARGIN_SEC', '300'))
+AUTH_REFRESH_RETRY_SEC  = float(os.environ.get('AUTH_REFRESH_RETRY_SEC', '60'))
+# если приложения нет в config.APP_CONFIG — ключи из ENV-файла инстанса
+B24_CLIENT_ID      = os.environ.get('B24_CLIENT_ID', '')
+B24_CLIENT_SECRET  = os.environ.get('B24_CLIENT_SECRET', '')
+
+# --- Логи ---
+LOG_QUEUE_SIZE     = int(os.environ.get('LOG_QUEUE_SIZE', '100000'))
+LOG_BODY_MAX       = int(os.environ.get('LOG_BODY_MAX', '4000'))
+# доля запросов, для которых пишется тело: "ONIMBOTMESSAGEADD=0.05,*=1"
+LOG_BODY_SAMPLING  = os.environ.get('LOG_BODY_SAMPLING', '*=1')
+LOG_TAIL_MAX       = int(os.environ.get('LOG_TAIL_MAX', '5000'))
+LOG_FOLLOW_MAX_SEC = float(os.environ.get('LOG_FOLLOW_MAX_SEC', '60'))
+LOG_FOLLOW_POLL_SEC = 0.5
+LOG_READ_BLOCK     = 64 * 1024
+
+# --- Публичные API ---
+API_PAGE_MAX       = int(os.environ.get('API_PAGE_MAX', '10000'))
+API_BATCH_MAX      = int(os.environ.get('API_BATCH_MAX', '500'))
+STREAM_FETCH_SIZE  = int(os.environ.get('STREAM_FETCH_SIZE', '500'))
+STREAM_CHUNK_BYTES = 64 * 1024
+EXPORT_CHUNK_ROWS  = int(os.environ.get('EXPORT_CHUNK_ROWS', '5000'))
+EXPORT_GZIP_LEVEL  = int(os.environ.get('EXPORT_GZIP_LEVEL', '6'))
+SEARCH_BACKFILL_BATCH = int(os.environ.get('SEARCH_BACKFILL_BATCH', '20000'))
+SEARCH_LIMIT_MAX   = int(os.environ.get('SEARCH_LIMIT_MAX', '200'))
+SEARCH_RANK_WINDOW = int(os.environ.get('SEARCH_RANK_WINDOW', '5000'))
+STATS_BACKFILL_BATCH = int(os.environ.get('STATS_BACKFILL_BATCH', '50000'))
+
+# --- Архив старых сообщений ---
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '0'))  # 0 — не архивировать
+ARCHIVE_BATCH      = int(os.environ.get('ARCHIVE_BATCH', '5000'))
+ARCHIVE_ATTACH_MAX = int(os.environ.get('ARCHIVE_ATTACH_MAX', '4'))
+ARCHIVE_VACUUM_PAGES = int(os.environ.get('ARCHIVE_VACUUM_PAGES', '2000'))
+
+# --- Кэши ---
+CACHE_USERS_SIZE        = int(os.environ.get('CACHE_USERS_SIZE', '10000'))
+CACHE_PARTICIPANTS_SIZE = int(os.environ.get('CACHE_PARTICIPANTS_SIZE', '50000'))
+CACHE_DIALOGS_SIZE      = int(os.environ.get('CACHE_DIALOGS_SIZE', '50000'))
+CACHE_TTL_SEC           = float(os.environ.get('CACHE_TTL_SEC', '300'))
+RESPONSE_CACHE_SIZE     = int(os.environ.get('RESPONSE_CACHE_SIZE', '256'))
+RESPONSE_CACHE_MB       = float(os.environ.get('RESPONSE_CACHE_MB', '16'))
+
+# --- Метрики ---
+METRICS_ENABLED    = os.environ.get('METRICS_ENABLED', '1') not in ('0', 'false', 'no')
+METRICS_FLUSH_SEC  = float(os.environ.get('METRICS_FLUSH_SEC', '5'))
+
+# --- Мультитенантный режим ---
+# Один пул процессов обслуживает все инстансы из TENANTS_ROOT
+# (раскладка setup_multi.sh: /var/www/b24bots/<инстанс>/dialogs.db, auth.json, флаги)
+TENANTS_ROOT       = os.environ.get('TENANTS_ROOT', '')
+TENANT_ENV_DIR     = os.environ.get('TENANT_ENV_DIR', '/etc/b24bot/env')
+TENANT_IDLE_SEC    = float(os.environ.get('TENANT_IDLE_SEC', '900'))
+TENANT_MAX_ACTIVE  = int(os.environ.get('TENANT_MAX_ACTIVE', '100'))
+# Токен общих для пула эндпойнтов (уровень логов, метрики, лимитер): токен
+# инстанса к ним не подходит, без POOL_ADMIN_TOKEN они закрыты
+POOL_ADMIN_TOKEN   = os.environ.get('POOL_ADMIN_TOKEN', '')
+
 # --- Логирование с ротацией ---
+# Обработчики вызываются из фонового потока QueueListener: поток запроса только
+# кладёт запись в очередь, а форматирование, redact() и запись/ротация файла
+# происходят в писателе.
 logger = logging.getLogger()
 logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
-fmt = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s:%(lineno)d - %(message)s')
+class LogFormatter(logging.Formatter):
+    """Формат bot.log; запись из контекста инстанса — с его именем перед сообщением.
 
-file_handler = RotatingFileHandler(LOG_FILE, maxBytes=2_000_000, backupCount=5, encoding='utf-8')
+    '… - [client1] Saved message …'; имя кладёт в запись _TenantLogTag.
+    """
+
+    def formatMessage(self, record):
+        line = super().formatMessage(record)
+        name = getattr(record, 'tenant_name', None)
+        if not name:
+            return line
+        # сообщение — последнее поле формата
+        head = len(line) - len(record.message)
+        return f'{line[:head]}[{name}] {line[head:]}'
+
+fmt = LogFormatter('%(asctime)s - %(levelname)s - %(name)s:%(lineno)d - %(message)s')
+
+class _ArgSnapshot:
+    """Аргумент записи лога, снятый в момент вызова: str() и repr() изменяемого объекта."""
+    __slots__ = ('s', 'r')
+
+    def __init__(self, obj):
+        self.s, self.r = str(obj), repr(obj)
+
+    def __str__(self):
+        return self.s
+
+    def __repr__(self):
+        return self.r
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler без форматирования в потоке вызова; при переполнении запись отбрасывается."""
+
+    # такие аргументы не поменяются, пока запись ждёт в очереди
+    SAFE_ARGS = (str, int, float, bool, bytes, type(None))
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # сообщение соберёт писатель, а dict/list/объект из аргументов к тому времени может
+        # измениться — снимаем с них str/repr сейчас. Redacted не трогаем: redact() дорогой
+        # и ради него и отложен (redact() возвращает новый объект, исходный не меняет)
+        args = record.args
+        if isinstance(args, tuple):
+            if not all(isinstance(a, self.SAFE_ARGS) for a in args):
+                record.args = tuple(a if isinstance(a, self.SAFE_ARGS + (Redacted,)) else _ArgSnapshot(a)
+                                    for a in args)
+        elif args:
+            # logging.info('%(x)s', {'x': ...}) — форматируем сразу
+            record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+LOG_BACKUP_COUNT = 5
+file_handler = RotatingFileHandler(LOG_FILE, maxBytes=2_000_000, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
 file_handler.setFormatter(fmt)
 stream_handler = logging.StreamHandler()
 stream_handler.setFormatter(fmt)
-logger.handlers = [file_handler, stream_handler]
+queue_handler = DeferredQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+log_listener = QueueListener(queue_handler.queue, file_handler, stream_handler, respect_handler_level=True)
+logger.handlers = [queue_handler]
+log_listener.start()
+
+def _stop_log_listener():
+    # дописывает очередь при выходе процесса (в дочернем после fork — свой слушатель)
+    log_listener.stop()
+
+atexit.register(_stop_log_listener)
+
+def _restart_log_listener():
+    # после fork (gunicorn --preload) потока писателя в дочернем процессе нет, а очередь
+    # могла остаться заблокированной — заводим новые очередь и слушателя
+    global log_listener
+    queue_handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    log_listener = QueueListener(queue_handler.queue, file_handler, stream_handler, respect_handler_level=True)
+    log_listener.start()
+
+os.register_at_fork(after_in_child=_restart_log_listener)
 
 app = Flask(__name__)
 
@@ -56,7 +257,43 @@ def redact(obj):
         return [redact(x) for x in obj]
     return obj
 
+class Redacted:
+    """Аргумент для logging: redact() выполняется, только если запись реально пишется."""
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return str(redact(self.obj))
+
+    __repr__ = __str__
+
+def _parse_sampling(spec):
+    """'ONIMBOTMESSAGEADD=0.1,*=1' -> {'ONIMBOTMESSAGEADD': 0.1, '*': 1.0}."""
+    rates = {}
+    for item in spec.split(','):
+        if '=' not in item:
+            continue
+        name, _, value = item.partition('=')
+        try:
+            rates[name.strip()] = max(0.0, min(1.0, float(value)))
+        except ValueError:
+            continue
+    return rates
+
+LOG_BODY_RATES = _parse_sampling(LOG_BODY_SAMPLING)
+
+def should_log_body(event):
+    rate = LOG_BODY_RATES.get(event or '*', LOG_BODY_RATES.get('*', 1.0))
+    return rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+
 def _startup_dump():
+    if TENANTS_ROOT:
+        logging.info("Startup: multi-tenant mode, TENANTS_ROOT=%s TENANT_ENV_DIR=%s", TENANTS_ROOT, TENANT_ENV_DIR)
+        if not POOL_ADMIN_TOKEN:
+            logging.warning("POOL_ADMIN_TOKEN is not set: pool-wide admin endpoints are disabled")
+        return
     logging.info("Startup: INSTANCE=%s BOT_CODE=%s API_SECRET_TOKEN_len=%s",
                  INSTANCE, BOT_CODE, len(API_SECRET_TOKEN) if API_SECRET_TOKEN else 0)
 
@@ -64,227 +301,2259 @@ _startup_dump()
 
 # ---------------------- Утилиты ----------------------
 def bot_enabled() -> bool:
-    return not os.path.exists(DISABLED_FLAG)
+    return not os.path.exists(tenant().disabled_flag)
 
 def public_handler_url():
     proto  = request.headers.get('X-Forwarded-Proto', request.scheme or 'http')
     prefix = request.headers.get('X-Forwarded-Prefix', '')
-    public_path = (prefix.rstrip('/') + request.path) if prefix else request.path
+    public_path = (prefix.rstrip('/') + request.path) if prefix else request.script_root + request.path
     return f"{proto}://{request.host}{public_path}"
 
-# ---------------------- Работа с БД ----------------------
-def init_db():
-    try:
-        con = sqlite3.connect(DB_FILE)
-        cur = con.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS dialogs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER UNIQUE,
-                start_time TEXT
-            )
-        ''')
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY,
-                user_name TEXT,
-                role TEXT
-            )
-        ''')
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS dialog_participants (
-                dialog_id INTEGER,
-                user_id INTEGER,
-                FOREIGN KEY (dialog_id) REFERENCES dialogs (id),
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                PRIMARY KEY (dialog_id, user_id)
-            )
-        ''')
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                dialog_chat_id INTEGER,
-                author_id INTEGER,
-                message_text TEXT,
-                timestamp TEXT,
-                FOREIGN KEY (dialog_chat_id) REFERENCES dialogs (chat_id),
-                FOREIGN KEY (author_id) REFERENCES users (id)
-            )
-        ''')
-        con.commit()
-        con.close()
-        logging.info("Database initialized successfully.")
-    except Exception as e:
-        logging.error(f"Error initializing database: {e}")
+# ---------------------- Метрики ----------------------
+# Каждый процесс копит счётчики и гистограммы в памяти и раз в METRICS_FLUSH_SEC
+# (а также перед выдачей /api/admin/metrics) сбрасывает снимок в
+# METRICS_DIR/<pid>.json. Эндпоинт складывает снимки всех живых воркеров;
+# счётчики завершившихся воркеров переносятся в _retired.json, поэтому суммы
+# не убывают после перезапуска gunicorn-воркера.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+DB_BUCKETS      = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
 
-def ensure_db_exists():
+# имя -> (тип, описание, границы гистограммы)
+METRICS = {
+    'b24bot_webhook_requests_total':      ('counter', 'Webhook events by event type and response status', None),
+    'b24bot_webhook_duration_seconds':    ('histogram', 'Webhook handling time by event type', LATENCY_BUCKETS),
+    'b24bot_webhook_duplicates_total':    ('counter', 'Re-delivered webhook events skipped by event type', None),
+    'b24bot_ingest_lost_total':           ('counter', 'Webhook events acknowledged in async mode but not written', None),
+    'b24bot_http_requests_total':         ('counter', 'API requests by route, method and status', None),
+    'b24bot_http_duration_seconds':       ('histogram', 'API request handling time by route', LATENCY_BUCKETS),
+    'b24bot_rest_requests_total':         ('counter', 'Bitrix24 REST calls by method, portal and outcome', None),
+    'b24bot_rest_duration_seconds':       ('histogram', 'Bitrix24 REST call time by method and portal', LATENCY_BUCKETS),
+    'b24bot_rest_ratelimit_wait_seconds': ('histogram', 'Time spent waiting for a rate limit token', LATENCY_BUCKETS),
+    'b24bot_db_duration_seconds':         ('histogram', 'DB helper time by operation', DB_BUCKETS),
+    'b24bot_jobs_total':                  ('counter', 'Finished REST job attempts by kind and outcome', None),
+    'b24bot_cache_hits_total':            ('counter', 'LRU cache hits', None),
+    'b24bot_cache_misses_total':          ('counter', 'LRU cache misses', None),
+    'b24bot_cache_entries':               ('gauge', 'LRU cache size', None),
+    'b24bot_queue_depth':                 ('gauge', 'In-process queue depth', None),
+    'b24bot_log_dropped_total':           ('counter', 'Log records dropped on a full log queue', None),
+    'b24bot_jobs_pending':                ('gauge', 'REST jobs waiting in rest_jobs', None),
+    'b24bot_jobs_dead':                   ('gauge', 'REST jobs in rest_jobs_dead', None),
+    'b24bot_ratelimit_waiting':           ('gauge', 'Processes waiting for a rate limit token', None),
+    'b24bot_workers':                     ('gauge', 'Worker processes with a live metrics snapshot', None),
+    'b24bot_tenants_active':              ('gauge', 'Instances loaded in multi-tenant mode', None),
+}
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _pid_alive(pid):
     try:
-        need = not os.path.exists(DB_FILE)
-        if not need:
-            con = sqlite3.connect(DB_FILE)
-            cur = con.cursor()
-            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='dialogs'")
-            need = (cur.fetchone() is None)
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Metrics:
+    """Счётчики и гистограммы процесса со снимками в METRICS_DIR для сборки по всем воркерам."""
+
+    def __init__(self, directory, flush_sec, enabled=True):
+        self.directory = directory
+        self.flush_sec = flush_sec
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._values = {}      # (имя, метки) -> число
+        self._hists = {}       # (имя, метки) -> [счётчики по корзинам + inf, сумма]
+        self._collectors = []  # () -> [(имя, метки, значение)] — снимаются при сбросе
+        self._thread = None
+        self._pid = os.getpid()
+
+    def inc(self, name, value=1.0, **labels):
+        if not self.enabled:
+            return
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, _labels_key(labels))
+        buckets = METRICS[name][2]
+        with self._lock:
+            hist = self._hists.get(key)
+            if hist is None:
+                hist = self._hists[key] = [[0] * (len(buckets) + 1), 0.0]
+            hist[0][bisect.bisect_left(buckets, seconds)] += 1
+            hist[1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        t = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - t, **labels)
+
+    def timed(self, name, **labels):
+        """Декоратор: время вызова функции в гистограмму name."""
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                t = perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.observe(name, perf_counter() - t, **labels)
+            return wrapper
+        return decorator
+
+    def add_collector(self, fn):
+        """fn() -> [(имя, метки, значение)]: счётчики и gauge, которые процесс и так хранит."""
+        self._collectors.append(fn)
+
+    def reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._values, self._hists = {}, {}
+        self._thread = None
+        self._pid = os.getpid()
+
+    def snapshot(self):
+        with self._lock:
+            values = [[name, dict(labels), v] for (name, labels), v in self._values.items()]
+            hists = [[name, dict(labels), list(h[0]), h[1]] for (name, labels), h in self._hists.items()]
+        for fn in self._collectors:
+            try:
+                values += [[name, labels, value] for name, labels, value in fn()]
+            except Exception as e:
+                logging.error(f"Metrics collector {getattr(fn, '__name__', fn)} failed: {e}")
+        return {'pid': os.getpid(), 'time': unix_time(), 'values': values, 'hists': hists}
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(prefix='.metrics.', suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def flush(self):
+        if not self.enabled:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            self._write(os.path.join(self.directory, f'{os.getpid()}.json'), self.snapshot())
+        except Exception as e:
+            logging.error(f"Metrics flush failed: {e}")
+
+    def ensure_started(self):
+        if not self.enabled or (self._thread is not None and self._pid == os.getpid()):
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            sleep(self.flush_sec)
+            self.flush()
+
+    def collect(self):
+        """Складывает снимки всех процессов: {'values': {ключ: v}, 'hists': {ключ: [корзины, сумма]}, 'workers': n}."""
+        self.flush()
+        values, hists = {}, {}
+        workers = 0
+        retired_path = os.path.join(self.directory, '_retired.json')
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(retired_path) as f:
+                    retired = json.load(f)
+            except (OSError, ValueError):
+                retired = {}
+            dead = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.json') or not name[:-5].isdigit():
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    with open(path) as f:
+                        snap = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if _pid_alive(int(name[:-5])):
+                    workers += 1
+                    _merge_snapshot(values, hists, snap)
+                else:
+                    dead.append((path, snap))
+            if dead:
+                # счётчики умерших воркеров копим в _retired.json, их gauge выбрасываем
+                r_values, r_hists = {}, {}
+                for snap in [retired] + [snap for _, snap in dead]:
+                    _merge_snapshot(r_values, r_hists, snap, gauges=False)
+                retired = {
+                    'values': [[n, dict(l), v] for (n, l), v in r_values.items()],
+                    'hists': [[n, dict(l), h[0], h[1]] for (n, l), h in r_hists.items()],
+                }
+                self._write(retired_path, retired)
+                for path, _ in dead:
+                    os.unlink(path)
+            _merge_snapshot(values, hists, retired, gauges=False)
+        return {'values': values, 'hists': hists, 'workers': workers}
+
+def _merge_snapshot(values, hists, snap, gauges=True):
+    for name, labels, v in snap.get('values', []):
+        if not gauges and METRICS.get(name, ('gauge',))[0] == 'gauge':
+            continue
+        key = (name, _labels_key(labels))
+        values[key] = values.get(key, 0.0) + v
+    for name, labels, counts, total in snap.get('hists', []):
+        key = (name, _labels_key(labels))
+        hist = hists.setdefault(key, [[0] * len(counts), 0.0])
+        if len(hist[0]) != len(counts):
+            continue  # сменились границы корзин — старый снимок не складываем
+        hist[0] = [a + b for a, b in zip(hist[0], counts)]
+        hist[1] += total
+
+metrics = Metrics(METRICS_DIR, METRICS_FLUSH_SEC, enabled=METRICS_ENABLED)
+atexit.register(metrics.flush)
+os.register_at_fork(after_in_child=metrics.reset_after_fork)
+
+def _prom_labels(labels, extra=None):
+    items = list(labels) + (list(extra) if extra else [])
+    if not items:
+        return ''
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in items) + '}'
+
+def render_metrics(collected, extra_values=()):
+    """Текстовый формат Prometheus из Metrics.collect() и значений, общих для всех воркеров."""
+    values = dict(collected['values'])
+    for name, labels, v in extra_values:
+        values[(name, _labels_key(labels))] = v
+    values[('b24bot_workers', ())] = collected['workers']
+    by_name = {}
+    for (name, labels), v in values.items():
+        by_name.setdefault(name, []).append((labels, v))
+    for (name, labels), h in collected['hists'].items():
+        by_name.setdefault(name, []).append((labels, h))
+    lines = []
+    for name in sorted(by_name):
+        kind, help_text, buckets = METRICS.get(name, ('untyped', '', None))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, v in sorted(by_name[name], key=lambda item: item[0]):
+            if kind != 'histogram':
+                lines.append(f'{name}{_prom_labels(labels)} {v:g}')
+                continue
+            counts, total = v
+            acc = 0
+            for bound, n in zip(list(buckets) + ['+Inf'], counts):
+                acc += n
+                le = bound if bound == '+Inf' else f'{bound:g}'
+                lines.append(f'{name}_bucket{_prom_labels(labels, [("le", le)])} {acc}')
+            lines.append(f'{name}_sum{_prom_labels(labels)} {total:.6f}')
+            lines.append(f'{name}_count{_prom_labels(labels)} {acc}')
+    return '\n'.join(lines) + '\n'
+
+# ---------------------- Соединения с БД ----------------------
+# Одно долгоживущее соединение на (процесс, поток, файл БД): gunicorn-воркер
+# больше не открывает 4–5 соединений на вебхук. Соединения работают в
+# autocommit-режиме, транзакции открываются явно через db_tx().
+_db_local = threading.local()
+
+def _open_db(path):
+    con = sqlite3.connect(path, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None,
+                          cached_statements=DB_CACHED_STATEMENTS)
+    con.row_factory = sqlite3.Row
+    con.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    # действует только на новый файл (до первой таблицы): место после архивации
+    # возвращает PRAGMA incremental_vacuum; старую БД переводит archive --convert-vacuum
+    con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    return con
+
+# БД выгруженных инстансов: путь -> номер выгрузки. Соединения к ним есть у каждого
+# потока, а закрыть чужое соединение нельзя — поток закрывает свои сам в get_db()
+_retired_dbs = {}
+_retired_gen = 0
+_retired_lock = threading.Lock()
+
+def retire_db(path):
+    """Закрывает соединения всех потоков с path: своё — сразу, остальные — при их следующем get_db()."""
+    global _retired_gen
+    with _retired_lock:
+        _retired_gen += 1
+        _retired_dbs[path] = _retired_gen
+    close_db(path)
+
+def _close_retired():
+    # соединение открыто на номере opened; выгрузка после него — закрываем, если не в транзакции
+    busy = False
+    for p, opened in list(_db_local.opened.items()):
+        if _retired_dbs.get(p, 0) > opened:
+            con = _db_local.conns.get(p)
+            if con is not None and con.in_transaction:
+                busy = True
+                continue
+            _db_local.opened.pop(p)
+            if con is not None:
+                del _db_local.conns[p]
+                con.close()
+    if not busy:
+        _db_local.gen = _retired_gen
+
+def get_db(path=None):
+    """Соединение текущего потока с БД текущего инстанса (после fork переоткрывается)."""
+    path = path or tenant().db_file
+    if getattr(_db_local, 'pid', None) != os.getpid():
+        # соединения, унаследованные от родителя через fork, не трогаем
+        _db_local.pid = os.getpid()
+        _db_local.conns = OrderedDict()
+        _db_local.opened = {}
+        _db_local.gen = _retired_gen
+    if _db_local.gen != _retired_gen:
+        _close_retired()
+    con = _db_local.conns.get(path)
+    if con is None:
+        # номер берём до открытия: выгрузка во время открытия тоже закроет соединение
+        _db_local.opened[path] = _retired_gen
+        con = _db_local.conns[path] = _open_db(path)
+        # в мультитенантном режиме поток ходит во многие БД — держим только недавние;
+        # соединение посреди транзакции (вложенный db_tx другого инстанса) не вытесняем:
+        # его ещё закоммитят, а лимит временно превышается
+        excess = len(_db_local.conns) - DB_MAX_CONNS_PER_THREAD
+        for old_path, old in list(_db_local.conns.items()):
+            if excess <= 0 or old_path == path:
+                break
+            if old.in_transaction:
+                continue
+            del _db_local.conns[old_path]
+            _db_local.opened.pop(old_path, None)
+            old.close()
+            excess -= 1
+    else:
+        _db_local.conns.move_to_end(path)
+    return con
+
+def close_db(path=None):
+    """Закрывает соединения текущего потока (все или только к path)."""
+    if getattr(_db_local, 'pid', None) != os.getpid():
+        return
+    for p in [path] if path else list(_db_local.conns):
+        con = _db_local.conns.pop(p, None)
+        _db_local.opened.pop(p, None)
+        if con is not None:
             con.close()
-        if need:
-            init_db()
-            logging.info("DB ensured (auto)")
-    except Exception as e:
-        logging.error(f"ensure_db_exists failed: {e}")
 
-def save_new_dialog(chat_id: int):
+# вызываются после ROLLBACK: кэши могли запомнить то, что не записалось
+_rollback_hooks = []
+
+@contextmanager
+def db_tx(path=None):
+    """Транзакция на запись (BEGIN IMMEDIATE); вложенные вызовы входят во внешнюю."""
+    con = get_db(path)
+    if con.in_transaction:
+        yield con
+        return
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        yield con
+    except BaseException:
+        # RAISE(ROLLBACK) в триггере уже откатил транзакцию сам
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        for hook in _rollback_hooks:
+            hook()
+        raise
+    con.execute("COMMIT")
+
+def in_tx():
+    """Идёт ли db_tx() в текущем потоке: тогда хелперы записи не глушат ошибки, а отдают их наружу."""
+    return get_db().in_transaction
+
+# ---------------------- Кэши записи ----------------------
+class LRUCache:
+    """Потокобезопасный LRU с ограничением размера, (опционально) TTL записей и суммарного веса.
+
+    Вес записи (например, длину тела ответа) передаёт set(); при maxbytes
+    вытесняются старые записи, пока сумма весов не уложится в лимит.
+    """
+
+    def __init__(self, maxsize, ttl=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires, _ = item
+                if expires is None or expires > monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._pop(key)
+            self.misses += 1
+            return default
+
+    def _pop(self, key):
+        self.bytes -= self._data.pop(key)[2]
+
+    def set(self, key, value, nbytes=0):
+        expires = monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            if self.maxbytes is not None and nbytes > self.maxbytes:
+                return
+            self._data[key] = (value, expires, nbytes)
+            self.bytes += nbytes
+            while len(self._data) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes):
+                self._pop(next(iter(self._data)))
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            out = {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else None,
+            }
+            if self.maxbytes is not None:
+                out.update(bytes=self.bytes, maxbytes=self.maxbytes)
+            return out
+
+def new_write_caches():
+    """Кэши записи одного инстанса (у каждого тенанта свои)."""
+    return {
+        # user_id -> (user_name, role); TTL — чтобы увидеть переименование, сделанное другим воркером
+        'users': LRUCache(CACHE_USERS_SIZE, ttl=CACHE_TTL_SEC),
+        # (chat_id, user_id) -> True и chat_id -> dialogs.id; TTL — архивация, запущенная
+        # другим процессом, может унести диалог из горячей БД
+        'participants': LRUCache(CACHE_PARTICIPANTS_SIZE, ttl=CACHE_TTL_SEC),
+        'dialogs': LRUCache(CACHE_DIALOGS_SIZE, ttl=CACHE_TTL_SEC),
+        # ключи уже принятых событий вебхука — быстрый путь перед webhook_events
+        'events': LRUCache(DEDUP_MEMORY_SIZE, ttl=DEDUP_WINDOW_SEC),
+        # тела ответов GET API по версии данных (см. conditional_get); ограничены и по объёму
+        'responses': LRUCache(RESPONSE_CACHE_SIZE, maxbytes=int(RESPONSE_CACHE_MB * 1024 * 1024)),
+    }
+
+# кэши инстанса по умолчанию (обычный режим: один инстанс на процесс)
+WRITE_CACHES = new_write_caches()
+user_cache = WRITE_CACHES['users']
+participant_cache = WRITE_CACHES['participants']
+dialog_id_cache = WRITE_CACHES['dialogs']
+
+def write_caches():
+    """Кэши записи текущего инстанса."""
+    return tenant().caches
+
+def clear_write_caches():
+    for cache in write_caches().values():
+        cache.clear()
+
+_rollback_hooks.append(clear_write_caches)
+
+# ---------------------- Миграции схемы ----------------------
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется
+# один раз и вместе с записью новой версии в одной транзакции, поэтому
+# существующие dialogs.db обновляются на месте.
+def _migration_base_schema(con):
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS dialogs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER UNIQUE,
+            start_time TEXT
+        )
+    ''')
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            user_name TEXT,
+            role TEXT
+        )
+    ''')
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS dialog_participants (
+            dialog_id INTEGER,
+            user_id INTEGER,
+            FOREIGN KEY (dialog_id) REFERENCES dialogs (id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            PRIMARY KEY (dialog_id, user_id)
+        )
+    ''')
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            dialog_chat_id INTEGER,
+            author_id INTEGER,
+            message_text TEXT,
+            timestamp TEXT,
+            FOREIGN KEY (dialog_chat_id) REFERENCES dialogs (chat_id),
+            FOREIGN KEY (author_id) REFERENCES users (id)
+        )
+    ''')
+
+def _migration_hot_indexes(con):
+    # /api/dialogs: WHERE start_time BETWEEN
+    con.execute("CREATE INDEX IF NOT EXISTS idx_dialogs_start_time ON dialogs (start_time)")
+    # /api/dialogs/<chat_id>: WHERE dialog_chat_id = ? AND timestamp BETWEEN
+    con.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_ts ON messages (dialog_chat_id, timestamp)")
+    con.execute("CREATE INDEX IF NOT EXISTS idx_participants_user ON dialog_participants (user_id)")
+
+def _migration_rest_jobs(con):
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS rest_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_at REAL NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL
+        )
+    ''')
+    con.execute("CREATE INDEX IF NOT EXISTS idx_rest_jobs_run_at ON rest_jobs (run_at)")
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS rest_jobs_dead (
+            id INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            failed_at REAL NOT NULL
+        )
+    ''')
+
+def _migration_users_seq(con):
+    # users.id — ID из Б24 и строки обновляются на месте, поэтому для курсора
+    # /api/export у пользователя свой возрастающий номер изменения
+    con.execute("ALTER TABLE users ADD COLUMN seq INTEGER")
+    con.execute("UPDATE users SET seq = id")
+    con.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_seq ON users (seq)")
+    con.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_seq_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE users SET seq = (SELECT IFNULL(MAX(seq), 0) + 1 FROM users) WHERE id = NEW.id;
+        END
+    ''')
+    con.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_users_seq_update AFTER UPDATE OF user_name, role ON users
+        WHEN NEW.user_name IS NOT OLD.user_name OR NEW.role IS NOT OLD.role
+        BEGIN
+            UPDATE users SET seq = (SELECT IFNULL(MAX(seq), 0) + 1 FROM users) WHERE id = NEW.id;
+        END
+    ''')
+
+# unicode61 приводит кириллицу к нижнему регистру, но «ё» не считает «е» с диакритикой —
+# в индекс и в запрос текст попадает с «ё» -> «е»; границы слов при этом не меняются,
+# поэтому highlight()/snippet() по исходному тексту размечают те же слова
+def _fts_text(expr):
+    return f"replace(replace({expr}, 'ё', 'е'), 'Ё', 'Е')"
+
+def _migration_messages_fts(con):
+    # external content: текст хранится только в messages, индекс — в messages_fts
+    con.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            message_text, content='messages', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    # сообщения, которые были до миграции, индексирует search_backfill() (id <= upto);
+    # пока он не дошёл до строки, удалять её из индекса нельзя — её там нет
+    con.execute("CREATE TABLE IF NOT EXISTS search_backfill (upto INTEGER NOT NULL, done INTEGER NOT NULL)")
+    upto = con.execute("SELECT IFNULL(MAX(id), 0) FROM messages").fetchone()[0]
+    con.execute("INSERT INTO search_backfill (upto, done) VALUES (?, 0)", (upto,))
+    indexed = "(OLD.id <= (SELECT done FROM search_backfill) OR OLD.id > (SELECT upto FROM search_backfill))"
+    con.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, message_text) VALUES (NEW.id, {_fts_text('NEW.message_text')});
+        END
+    ''')
+    con.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_delete AFTER DELETE ON messages WHEN {indexed}
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text)
+            VALUES ('delete', OLD.id, {_fts_text('OLD.message_text')});
+        END
+    ''')
+    con.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_update AFTER UPDATE OF message_text ON messages WHEN {indexed}
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text)
+            VALUES ('delete', OLD.id, {_fts_text('OLD.message_text')});
+            INSERT INTO messages_fts (rowid, message_text) VALUES (NEW.id, {_fts_text('NEW.message_text')});
+        END
+    ''')
+
+# Статистика копится по часам UTC (ключ — 'YYYY-MM-DDTHH', начало ISO-времени):
+# из часовых строк собирается любой день с любым tz_offset. Сообщения —
+# счётчик на (час, роль, автор), клиенты складываются в author_id = 0;
+# диалоги и время первого ответа — по часу start_time диалога.
+def _stats_hour(expr):
+    return f"substr({expr}, 1, 13)"
+
+# границы гистограммы времени первого ответа, секунды; -1 — «больше последней»
+FIRST_RESPONSE_BUCKETS = (60, 300, 900, 1800, 3600, 4 * 3600, 24 * 3600)
+
+def _first_response_bucket(expr):
+    whens = ' '.join(f"WHEN {expr} <= {le} THEN {le}" for le in FIRST_RESPONSE_BUCKETS)
+    return f"CASE {whens} ELSE -1 END"
+
+def _response_sec(ts_expr, client_expr):
+    return f"round((julianday({ts_expr}) - julianday({client_expr})) * 86400, 3)"
+
+def _migration_stats(con):
+    # первое сообщение клиента и секунды до первого ответа менеджера после него
+    con.execute("ALTER TABLE dialogs ADD COLUMN first_client_at TEXT")
+    con.execute("ALTER TABLE dialogs ADD COLUMN first_response_sec REAL")
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS stats_messages (
+            hour TEXT NOT NULL,
+            role TEXT NOT NULL,
+            author_id INTEGER NOT NULL,
+            messages INTEGER NOT NULL,
+            PRIMARY KEY (hour, role, author_id)
+        ) WITHOUT ROWID
+    ''')
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS stats_dialogs (
+            hour TEXT PRIMARY KEY,
+            opened INTEGER NOT NULL DEFAULT 0,
+            with_client INTEGER NOT NULL DEFAULT 0,
+            responded INTEGER NOT NULL DEFAULT 0,
+            response_sec REAL NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS stats_response (
+            hour TEXT NOT NULL,
+            le INTEGER NOT NULL,
+            dialogs INTEGER NOT NULL,
+            PRIMARY KEY (hour, le)
+        ) WITHOUT ROWID
+    ''')
+    # диалогов немного — считаем сразу; сообщения до миграции дозаливает stats_backfill()
+    con.execute(f'''
+        INSERT INTO stats_dialogs (hour, opened)
+        SELECT {_stats_hour('start_time')}, COUNT(*) FROM dialogs GROUP BY 1
+    ''')
+    con.execute("CREATE TABLE IF NOT EXISTS stats_backfill (upto INTEGER NOT NULL, done INTEGER NOT NULL)")
+    upto = con.execute("SELECT IFNULL(MAX(id), 0) FROM messages").fetchone()[0]
+    con.execute("INSERT INTO stats_backfill (upto, done) VALUES (?, 0)", (upto,))
+
+    role = "(SELECT role FROM users WHERE id = NEW.author_id)"
+    sec = _response_sec('NEW.timestamp', 'first_client_at')
+    con.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_messages_stats AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO stats_messages (hour, role, author_id, messages)
+            VALUES ({_stats_hour('NEW.timestamp')}, IFNULL({role}, ''),
+                    CASE {role} WHEN 'manager' THEN NEW.author_id ELSE 0 END, 1)
+            ON CONFLICT (hour, role, author_id) DO UPDATE SET messages = messages + 1;
+            UPDATE dialogs SET first_client_at = NEW.timestamp
+            WHERE chat_id = NEW.dialog_chat_id AND {role} = 'client'
+              AND (first_client_at IS NULL OR first_client_at > NEW.timestamp);
+            UPDATE dialogs SET first_response_sec = {sec}
+            WHERE chat_id = NEW.dialog_chat_id AND {role} = 'manager' AND first_client_at <= NEW.timestamp
+              AND (first_response_sec IS NULL OR first_response_sec > {sec});
+        END
+    ''')
+    con.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_dialogs_stats_insert AFTER INSERT ON dialogs
+        BEGIN
+            INSERT INTO stats_dialogs (hour, opened) VALUES ({_stats_hour('NEW.start_time')}, 1)
+            ON CONFLICT (hour) DO UPDATE SET opened = opened + 1;
+        END
+    ''')
+    con.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_dialogs_stats_client AFTER UPDATE OF first_client_at ON dialogs
+        WHEN (OLD.first_client_at IS NULL) <> (NEW.first_client_at IS NULL)
+        BEGIN
+            INSERT INTO stats_dialogs (hour, with_client)
+            VALUES ({_stats_hour('NEW.start_time')}, CASE WHEN NEW.first_client_at IS NULL THEN -1 ELSE 1 END)
+            ON CONFLICT (hour) DO UPDATE SET with_client = with_client + excluded.with_client;
+        END
+    ''')
+    # время ответа может уточниться (история дозаливается позже) — вычитаем старое, добавляем новое
+    con.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_dialogs_stats_response AFTER UPDATE OF first_response_sec ON dialogs
+        WHEN OLD.first_response_sec IS NOT NEW.first_response_sec
+        BEGIN
+            UPDATE stats_dialogs SET responded = responded - 1, response_sec = response_sec - OLD.first_response_sec
+            WHERE hour = {_stats_hour('OLD.start_time')} AND OLD.first_response_sec IS NOT NULL;
+            UPDATE stats_response SET dialogs = dialogs - 1
+            WHERE hour = {_stats_hour('OLD.start_time')} AND le = {_first_response_bucket('OLD.first_response_sec')}
+              AND OLD.first_response_sec IS NOT NULL;
+            INSERT INTO stats_dialogs (hour, responded, response_sec)
+            SELECT {_stats_hour('NEW.start_time')}, 1, NEW.first_response_sec WHERE NEW.first_response_sec IS NOT NULL
+            ON CONFLICT (hour) DO UPDATE SET responded = responded + 1, response_sec = response_sec + excluded.response_sec;
+            INSERT INTO stats_response (hour, le, dialogs)
+            SELECT {_stats_hour('NEW.start_time')}, {_first_response_bucket('NEW.first_response_sec')}, 1
+            WHERE NEW.first_response_sec IS NOT NULL
+            ON CONFLICT (hour, le) DO UPDATE SET dialogs = dialogs + 1;
+        END
+    ''')
+
+def _migration_archive_catalog(con):
+    # какие месяцы уже есть в archive/<YYYY-MM>.db и где искать перенесённый диалог
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS archive_months (
+            month TEXT PRIMARY KEY,
+            dialogs INTEGER NOT NULL DEFAULT 0,
+            messages INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        ) WITHOUT ROWID
+    ''')
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS archive_dialogs (
+            chat_id INTEGER PRIMARY KEY,
+            dialog_id INTEGER NOT NULL,
+            month TEXT NOT NULL
+        )
+    ''')
+
+def _migration_webhook_dedup(con):
+    # id сообщения в Б24: повторная доставка события не создаёт вторую строку;
+    # у старых строк и событий без MESSAGE_ID столбец пустой и в индекс не попадает
+    con.execute("ALTER TABLE messages ADD COLUMN b24_message_id INTEGER")
+    con.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_b24_id ON messages (b24_message_id) "
+                "WHERE b24_message_id IS NOT NULL")
+    # окно дедупликации событий, общее для воркеров; просроченные ключи чистит claim_event()
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS webhook_events (
+            key TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+# таблицы, из которых читают /api/users, /api/dialogs*, — любая запись в них меняет версию
+VERSIONED_TABLES = ('dialogs', 'users', 'dialog_participants', 'messages')
+
+def _migration_change_version(con):
+    # счётчик записей для ETag; epoch отличает пересозданную БД, где счёт начнётся заново
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS change_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL,
+            epoch TEXT NOT NULL
+        )
+    ''')
+    con.execute("INSERT OR IGNORE INTO change_version (id, version, epoch) VALUES (1, 0, lower(hex(randomblob(4))))")
+    for table in VERSIONED_TABLES:
+        for op in ('INSERT', 'UPDATE', 'DELETE'):
+            con.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{op.lower()} AFTER {op} ON {table}
+                BEGIN
+                    UPDATE change_version SET version = version + 1 WHERE id = 1;
+                END
+            ''')
+
+def _migration_participants_seq(con):
+    # у dialog_participants нет AUTOINCREMENT: rowid удалённой строки (перенос в архив)
+    # может достаться новой, и курсор since по rowid её пропустил бы. seq берётся из
+    # счётчика export_seq, который не убывает при удалениях
+    con.execute("ALTER TABLE dialog_participants ADD COLUMN seq INTEGER")
+    # since, выданные до миграции, — это rowid
+    con.execute("UPDATE dialog_participants SET seq = rowid")
+    con.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_participants_seq ON dialog_participants (seq)")
+    con.execute("CREATE TABLE IF NOT EXISTS export_seq (name TEXT PRIMARY KEY, seq INTEGER NOT NULL)")
+    con.execute("INSERT OR IGNORE INTO export_seq (name, seq) "
+                "SELECT 'dialog_participants', IFNULL(MAX(seq), 0) FROM dialog_participants")
+    con.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_participants_seq_insert AFTER INSERT ON dialog_participants
+        BEGIN
+            UPDATE export_seq SET seq = seq + 1 WHERE name = 'dialog_participants';
+            UPDATE dialog_participants SET seq = (SELECT seq FROM export_seq WHERE name = 'dialog_participants')
+            WHERE rowid = NEW.rowid;
+        END
+    ''')
+
+def _migration_first_response_recalc(con):
+    # первое сообщение клиента сдвинулось раньше (история дозалита или пришла не по порядку) —
+    # первый ответ считается заново от него, а не только уменьшается
+    con.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_dialogs_first_response_recalc AFTER UPDATE OF first_client_at ON dialogs
+        WHEN NEW.first_client_at IS NOT NULL AND OLD.first_client_at IS NOT NEW.first_client_at
+        BEGIN
+            UPDATE dialogs SET first_response_sec = (
+                SELECT {_response_sec('MIN(m.timestamp)', 'NEW.first_client_at')}
+                FROM messages m JOIN users u ON u.id = m.author_id
+                WHERE m.dialog_chat_id = NEW.chat_id AND u.role = 'manager' AND m.timestamp >= NEW.first_client_at)
+            WHERE id = NEW.id;
+        END
+    ''')
+
+MIGRATIONS = [
+    (1, 'base schema', _migration_base_schema),
+    (2, 'indexes for API queries', _migration_hot_indexes),
+    (3, 'rest job queue', _migration_rest_jobs),
+    (4, 'users change sequence for export', _migration_users_seq),
+    (5, 'full-text search index', _migration_messages_fts),
+    (6, 'incremental statistics', _migration_stats),
+    (7, 'archive catalog', _migration_archive_catalog),
+    (8, 'webhook deduplication', _migration_webhook_dedup),
+    (9, 'change version for conditional GET', _migration_change_version),
+    (10, 'participants change sequence for export', _migration_participants_seq),
+    (11, 'first response after earlier client message', _migration_first_response_recalc),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version(path=None):
+    return get_db(path).execute("PRAGMA user_version").fetchone()[0]
+
+def migrate_db(path=None):
+    """Доводит схему БД до SCHEMA_VERSION. Безопасно вызывать из нескольких воркеров.
+
+    Каждая миграция коммитится вместе со своей user_version: сбой на шаге N
+    оставляет схему версии N-1, и следующий запуск продолжит с шага N. Ошибка
+    пробрасывается — воркер не должен обслуживать запросы без схемы.
+    """
+    while schema_version(path) < SCHEMA_VERSION:
+        with db_tx(path) as con:
+            # перечитываем под блокировкой: другой воркер мог успеть раньше
+            version = con.execute("PRAGMA user_version").fetchone()[0]
+            pending = [m for m in MIGRATIONS if m[0] > version]
+            if not pending:
+                return
+            target, name, apply = pending[0]
+            try:
+                apply(con)
+            except Exception as e:
+                logging.error(f"DB migration to version {target} ({name}) failed: {e}")
+                raise
+            con.execute(f"PRAGMA user_version = {int(target)}")
+        logging.info(f"DB migrated to version {target} ({name})")
+
+def init_db():
+    """Совместимость с установщиком и ONAPPINSTALL: то же, что migrate_db()."""
+    migrate_db()
+    # БД могли удалить и создать заново — запомненные id больше не верны
+    clear_write_caches()
+
+# ---------------------- Работа с БД ----------------------
+@metrics.timed('b24bot_db_duration_seconds', op='save_new_dialog')
+def save_new_dialog(chat_id: int, start_time=None):
     """Создаёт запись о диалоге, если её ещё нет."""
     try:
-        con = sqlite3.connect(DB_FILE)
-        cur = con.cursor()
-        start_time = datetime.now().isoformat()
-        cur.execute(
+        start_time = start_time or datetime.now().isoformat()
+        get_db().execute(
             "INSERT OR IGNORE INTO dialogs (chat_id, start_time) VALUES (?, ?)",
             (chat_id, start_time)
         )
-        con.commit()
-        con.close()
         logging.info(f"Saved new dialog with chat_id: {chat_id}")
     except Exception as e:
         logging.error(f"Error saving new dialog {chat_id}: {e}")
+        if in_tx():
+            raise
+
+@metrics.timed('b24bot_db_duration_seconds', op='save_message')
+def save_message(chat_id: int, author_id, message_text: str, timestamp=None, message_id=None):
+    """Сохраняет сообщение (author_id может быть None — тогда пишем -1).
 
-def save_message(chat_id: int, author_id, message_text: str):
-    """Сохраняет сообщение (author_id может быть None — тогда пишем -1)."""
+    message_id — MESSAGE_ID из Б24: сообщение с уже записанным id пропускается.
+    """
     try:
-        con = sqlite3.connect(DB_FILE)
-        cur = con.cursor()
-        timestamp = datetime.now().isoformat()
-        cur.execute(
-            "INSERT INTO messages (dialog_chat_id, author_id, message_text, timestamp) VALUES (?, ?, ?, ?)",
-            (chat_id, author_id if author_id is not None else -1, message_text, timestamp)
+        timestamp = timestamp or datetime.now().isoformat()
+        cur = get_db().execute(
+            "INSERT OR IGNORE INTO messages (dialog_chat_id, author_id, message_text, timestamp, b24_message_id) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (chat_id, author_id if author_id is not None else -1, message_text, timestamp, message_id)
         )
-        con.commit()
-        con.close()
+        if not cur.rowcount:
+            logging.info(f"Message {message_id} in chat {chat_id} is already saved, skipped")
+            return
         logging.info(f"Saved message from {author_id} in chat {chat_id}")
     except Exception as e:
         logging.error(f"Error saving message in chat {chat_id}: {e}")
+        if in_tx():
+            raise
 
-# гарантия при старте воркера gunicorn
-ensure_db_exists()
 _first_request_checked = False  # флаг для первого запроса
 
 # ---------------------- Авторизация Б24 ----------------------
+class AuthStore:
+    """auth.json, закэшированный в памяти процесса.
+
+    Файл перечитывается, только если сменились inode/mtime/размер, а сам stat
+    делается не чаще раза в recheck_sec — в обычном вебхуке файлового I/O нет.
+    Запись атомарная (временный файл + os.replace), поэтому другие воркеры
+    никогда не видят недописанный JSON и подхватывают новый файл по inode.
+    """
+
+    def __init__(self, path, recheck_sec):
+        self.path = path
+        self.recheck_sec = recheck_sec
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._data = None
+        self._sig = None
+        self._checked_at = None
+        self.refresh_failed_at = None
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def get(self, force=False):
+        now = monotonic()
+        if not force and self._checked_at is not None and now - self._checked_at < self.recheck_sec:
+            return dict(self._data) if self._data is not None else None
+        with self._lock:
+            sig = self._signature()
+            if sig != self._sig:
+                data = None
+                if sig is not None:
+                    try:
+                        with open(self.path, 'r') as f:
+                            data = json.load(f)
+                    except Exception as e:
+                        logging.error(f"Failed to read auth data from {self.path}: {e}")
+                        sig = None
+                self._data, self._sig = data, sig
+            self._checked_at = now
+            return dict(self._data) if self._data is not None else None
+
+    def save(self, payload):
+        directory = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(prefix='.auth.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(payload, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self._data = dict(payload)
+            self._sig = self._signature()
+            self._checked_at = monotonic()
+
+    def refresh(self, stale, fetch):
+        """Заменяет устаревший токен из stale новым от fetch(auth) -> payload | None.
+
+        Обновляет один поток на все воркеры: поток берёт свой lock и flock на
+        auth.json.lock, перечитывает файл и, если другой воркер уже записал
+        новый токен, берёт его без запроса к OAuth-серверу. Refresh token
+        Б24 одноразовый, поэтому параллельные обновления ломали бы друг друга.
+        """
+        with self._refresh_lock, open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            current = self.get(force=True)
+            if current and current.get('access_token') != stale.get('access_token') and not token_expiring(current):
+                return current
+            fresh = fetch(current or stale)
+            if fresh is None:
+                self.refresh_failed_at = monotonic()
+                return None
+            self.save(fresh)
+            self.refresh_failed_at = None
+            return fresh
+
+auth_store = AuthStore(AUTH_FILE, AUTH_RECHECK_SEC)
+
+# ---------------------- Инстансы (тенанты) ----------------------
+# Всё, чем инстансы отличаются друг от друга: файлы, токен API, код бота, кэши.
+# В обычном режиме есть только default_tenant из BASE_DIR и переменных
+# окружения. С TENANTS_ROOT один процесс обслуживает все каталоги
+# TENANTS_ROOT/<инстанс>: инстанс выбирается по X-Forwarded-Prefix или
+# префиксу пути, загружается при первом запросе и выгружается после
+# TENANT_IDLE_SEC без запросов — память растёт с числом активных порталов.
+_TENANT_NAME_RE = re.compile(r'^[a-z0-9-]{1,64}$')
+
+class Tenant:
+    def __init__(self, name, base_dir, api_token, bot_code, caches=None, auth=None):
+        self.name = name
+        self.base_dir = base_dir
+        self.api_token = api_token
+        self.bot_code = bot_code
+        self.db_file = os.path.join(base_dir, 'dialogs.db')
+        self.auth_file = os.path.join(base_dir, 'auth.json')
+        self.enabled_flag = os.path.join(base_dir, 'ENABLED')
+        self.disabled_flag = os.path.join(base_dir, 'DISABLED')
+        self.caches = caches if caches is not None else new_write_caches()
+        self.auth_store = auth or AuthStore(self.auth_file, AUTH_RECHECK_SEC)
+        self.last_used = monotonic()
+        # подсказка исполнителям REST-задач (см. JobQueue.due_tenants)
+        self.jobs_due_at = 0.0
+        self.jobs_seen = None
+
+    def __repr__(self):
+        return f'<Tenant {self.name}>'
+
+default_tenant = Tenant(INSTANCE, BASE_DIR, API_SECRET_TOKEN, BOT_CODE, caches=WRITE_CACHES, auth=auth_store)
+_current_tenant = contextvars.ContextVar('tenant', default=default_tenant)
+
+def tenant():
+    """Инстанс, для которого выполняется текущий запрос или фоновая задача."""
+    return _current_tenant.get()
+
+@contextmanager
+def use_tenant(t):
+    token = _current_tenant.set(t)
+    try:
+        yield t
+    finally:
+        _current_tenant.reset(token)
+
+def _read_env_file(path):
+    """KEY=VALUE из EnvironmentFile systemd (его пишет setup_multi.sh)."""
+    values = {}
+    try:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#') or '=' not in line:
+                    continue
+                key, _, value = line.partition('=')
+                values[key.strip()] = value.strip().strip('"\'')
+    except FileNotFoundError:
+        pass
+    return values
+
+class TenantRegistry:
+    """Загруженные инстансы мультитенантного режима."""
+
+    SWEEP_EVERY_SEC = 30
+
+    def __init__(self, root, env_dir, idle_sec, max_active):
+        self.root = root
+        self.env_dir = env_dir
+        self.idle_sec = idle_sec
+        self.max_active = max_active
+        self._lock = threading.Lock()
+        self._tenants = OrderedDict()
+        self._swept_at = monotonic()
+
+    def get(self, name):
+        """Инстанс по имени (загружается при первом обращении) или None, если каталога нет."""
+        t = self._tenants.get(name)
+        if t is None:
+            if not _TENANT_NAME_RE.match(name or ''):
+                return None
+            base_dir = os.path.join(self.root, name)
+            if not os.path.isdir(base_dir):
+                return None
+            with self._lock:
+                t = self._tenants.get(name)
+                if t is None:
+                    t = self._tenants[name] = self._load(name, base_dir)
+        t.last_used = monotonic()
+        if t.last_used - self._swept_at > self.SWEEP_EVERY_SEC:
+            self.sweep()
+        return t
+
+    def _load(self, name, base_dir):
+        # токен и код бота — из того же env-файла, что у отдельного сервиса инстанса
+        env = _read_env_file(os.path.join(self.env_dir, f'{name}.env'))
+        t = Tenant(name, base_dir, env.get('API_SECRET_TOKEN') or None,
+                   env.get('BOT_CODE') or f'py_interceptor_bot_{name}')
+        with use_tenant(t):
+            migrate_db()
+            logging.info(f"Tenant {name} loaded from {base_dir}")
+        return t
+
+    def active(self):
+        return list(self._tenants.values())
+
+    def load_pending(self):
+        """Загружает незагруженные инстансы, у которых в rest_jobs остались задачи.
+
+        После рестарта их задачи иначе ждали бы первого HTTP-запроса к инстансу.
+        БД открываются только на чтение и мимо пула соединений потока.
+        """
+        try:
+            names = sorted(os.listdir(self.root))
+        except OSError as e:
+            logging.error(f"Cannot list tenants in {self.root}: {e}")
+            return
+        for name in names:
+            path = os.path.join(self.root, name, 'dialogs.db')
+            if name in self._tenants or not _TENANT_NAME_RE.match(name) or not os.path.isfile(path):
+                continue
+            try:
+                con = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+                try:
+                    pending = con.execute("SELECT 1 FROM rest_jobs LIMIT 1").fetchone() is not None
+                finally:
+                    con.close()
+            except sqlite3.Error:
+                continue  # ещё не мигрирована — задач в ней нет
+            if pending:
+                self.get(name)
+
+    def _has_jobs(self, t):
+        # REST-задачи выполняются только у загруженных инстансов — такие не выгружаем
+        try:
+            with use_tenant(t):
+                return get_db().execute("SELECT 1 FROM rest_jobs LIMIT 1").fetchone() is not None
+        except Exception:
+            return False
+
+    def sweep(self):
+        """Выгружает инстансы, простаивающие дольше idle_sec, и лишние сверх max_active."""
+        with self._lock:
+            now = self._swept_at = monotonic()
+            excess = len(self._tenants) - self.max_active
+            for t in sorted(self._tenants.values(), key=lambda t: t.last_used):
+                if now - t.last_used < self.idle_sec and excess <= 0:
+                    break
+                if self._has_jobs(t):
+                    continue
+                del self._tenants[t.name]
+                excess -= 1
+                self._retire(t, now)
+
+    def _retire(self, t, now):
+        # попадания кэшей переходят в счётчики процесса, чтобы метрики не убывали
+        for cache_name, cache in t.caches.items():
+            st = cache.stats()
+            metrics.inc('b24bot_cache_hits_total', st['hits'], cache=cache_name)
+            metrics.inc('b24bot_cache_misses_total', st['misses'], cache=cache_name)
+        retire_db(t.db_file)
+        with use_tenant(t):
+            logging.info(f"Tenant {t.name} unloaded after {now - t.last_used:.0f}s idle")
+
+tenants = TenantRegistry(TENANTS_ROOT, TENANT_ENV_DIR, TENANT_IDLE_SEC, TENANT_MAX_ACTIVE) if TENANTS_ROOT else None
+
+def active_tenants():
+    """Инстансы, которые обслуживают фоновые потоки этого процесса."""
+    return tenants.active() if tenants is not None else [default_tenant]
+
+class TenantMiddleware:
+    """WSGI-обёртка мультитенантного режима: выбирает инстанс запроса.
+
+    Имя берётся из X-Forwarded-Prefix (nginx из setup_multi.sh срезает
+    /<инстанс> и передаёт его заголовком) или из пути /<инстанс>/python_bot/,
+    /<инстанс>/api/… — тогда префикс переносится в SCRIPT_NAME. Контекст
+    инстанса не сбрасывается после ответа: потоковые ответы дочитываются
+    позже в том же потоке, а следующий запрос выставит свой.
+    """
+
+    def __init__(self, wsgi_app, registry):
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        _current_tenant.set(default_tenant)
+        name = environ.get('HTTP_X_FORWARDED_PREFIX', '').strip('/').rsplit('/', 1)[-1]
+        if not name:
+            path = environ.get('PATH_INFO', '')
+            parts = path.split('/', 3)
+            if len(parts) > 2 and parts[2] in ('python_bot', 'api'):
+                name = parts[1]
+                environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + '/' + name
+                environ['PATH_INFO'] = path[len(name) + 1:]
+        t = self.registry.get(name) if name else None
+        if t is None:
+            start_response('404 Not Found', [('Content-Type', 'application/json')])
+            return [json.dumps({'error': 'Unknown instance'}).encode('utf-8')]
+        _current_tenant.set(t)
+        return self.wsgi_app(environ, start_response)
+
+class _TenantLogTag(logging.Filter):
+    """Запоминает в записи инстанс, пока она ещё в его потоке; в текст имя добавляет LogFormatter."""
+
+    def filter(self, record):
+        t = _current_tenant.get()
+        if t is not default_tenant:
+            record.tenant_name = t.name
+        return True
+
+if tenants is None:
+    # гарантия при старте воркера gunicorn; тенанты мигрируют при загрузке
+    migrate_db()
+else:
+    app.wsgi_app = TenantMiddleware(app.wsgi_app, tenants)
+    queue_handler.addFilter(_TenantLogTag())
+
 def save_auth_data(auth_payload):
     app_token = auth_payload.get('application_token')
     if app_token:
+        t = tenant()
         try:
-            with open(AUTH_FILE, 'w') as f:
-                json.dump(auth_payload, f, indent=2)
-            logging.info(f"Auth data for {app_token} saved to {AUTH_FILE}.")
+            t.auth_store.save(auth_payload)
+            logging.info(f"Auth data for {app_token} saved to {t.auth_file}.")
             return True
         except Exception as e:
-            logging.error(f"Failed to save auth data to {AUTH_FILE}: {e}")
+            logging.error(f"Failed to save auth data to {t.auth_file}: {e}")
             return False
 
-def get_current_auth():
-    if not os.path.exists(AUTH_FILE):
+def get_current_auth(force=False):
+    return tenant().auth_store.get(force)
+
+# ---------------------- Обновление OAuth-токена ----------------------
+# access_token из ONAPPINSTALL живёт expires_in (час). Перед вызовом REST токен,
+# истекающий в ближайшие AUTH_REFRESH_MARGIN_SEC, обновляется заранее, а вызов,
+# получивший expired_token, повторяется один раз с новым токеном.
+# CLIENT_ID/CLIENT_SECRET приложения — из config.APP_CONFIG по application_token
+# или из B24_CLIENT_ID/B24_CLIENT_SECRET.
+def token_expiring(auth_data, margin=AUTH_REFRESH_MARGIN_SEC):
+    try:
+        expires = float(auth_data.get('expires') or 0)
+    except (TypeError, ValueError):
+        return False
+    # без expires (старый auth.json) обновляемся только по expired_token
+    return bool(expires) and expires - unix_time() < margin
+
+def _oauth_refresh(auth_data):
+    """Запрос grant_type=refresh_token; новый payload auth.json или None."""
+    creds = get_app_config(auth_data.get('application_token')) or {}
+    if not creds.get('CLIENT_ID'):
+        creds = {'CLIENT_ID': B24_CLIENT_ID, 'CLIENT_SECRET': B24_CLIENT_SECRET}
+    if not creds.get('CLIENT_ID') or not creds.get('CLIENT_SECRET') or not auth_data.get('refresh_token'):
+        logging.error("Cannot refresh access token: set CLIENT_ID/CLIENT_SECRET in config.APP_CONFIG or "
+                      "B24_CLIENT_ID/B24_CLIENT_SECRET (and reinstall the app if auth.json has no refresh_token)")
+        return None
+    portal = urlsplit(B24_OAUTH_URL).netloc
+    started = perf_counter()
+    try:
+        response = _http_session(B24_OAUTH_URL).get(B24_OAUTH_URL, params={
+            'grant_type': 'refresh_token',
+            'client_id': creds['CLIENT_ID'],
+            'client_secret': creds['CLIENT_SECRET'],
+            'refresh_token': auth_data['refresh_token'],
+        }, timeout=REST_TIMEOUT)
+        js = response.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        metrics.inc('b24bot_rest_requests_total', method='oauth.refresh', portal=portal, outcome='exception')
+        logging.error(f"Access token refresh failed: {e}")
+        return None
+    finally:
+        metrics.observe('b24bot_rest_duration_seconds', perf_counter() - started, method='oauth.refresh', portal=portal)
+    if response.status_code >= 400 or not isinstance(js, dict) or not js.get('access_token'):
+        metrics.inc('b24bot_rest_requests_total', method='oauth.refresh', portal=portal, outcome='error')
+        logging.error("Access token refresh FAILED status=%s body=%s", response.status_code, Redacted(js))
+        return None
+    metrics.inc('b24bot_rest_requests_total', method='oauth.refresh', portal=portal, outcome='ok')
+    fresh = dict(auth_data)
+    for key in ('access_token', 'refresh_token', 'expires', 'expires_in', 'client_endpoint',
+                'server_endpoint', 'domain', 'member_id', 'scope'):
+        if js.get(key):
+            fresh[key] = js[key]
+    if not js.get('expires') and js.get('expires_in'):
+        fresh['expires'] = int(unix_time() + float(js['expires_in']))
+    logging.info(f"Access token refreshed, valid until {datetime.fromtimestamp(float(fresh.get('expires') or 0)).isoformat()}")
+    return fresh
+
+def refresh_auth(auth_data):
+    """Новые данные авторизации вместо auth_data с устаревшим токеном; None — обновить не удалось."""
+    store = tenant().auth_store
+    if store.refresh_failed_at is not None and monotonic() - store.refresh_failed_at < AUTH_REFRESH_RETRY_SEC:
+        # после неудачи не долбим OAuth-сервер на каждом вызове
         return None
     try:
-        with open(AUTH_FILE, 'r') as f:
-            return json.load(f)
+        return store.refresh(auth_data, _oauth_refresh)
     except Exception as e:
-        logging.error(f"Failed to read auth data from {AUTH_FILE}: {e}")
+        logging.error(f"Access token refresh failed: {e}")
         return None
 
-def rest_command(auth_data, method, params=None):
+def fresh_auth(auth_data):
+    """auth_data, токен которого не истечёт в ближайшие AUTH_REFRESH_MARGIN_SEC."""
+    if not token_expiring(auth_data):
+        return auth_data
+    return refresh_auth(auth_data) or auth_data
+
+def rest_expired(js):
+    """Портал отверг токен как истёкший: вызов стоит повторить после refresh_auth()."""
+    return isinstance(js, dict) and js.get('error') == 'expired_token'
+
+# Одна keep-alive сессия на (процесс, портал): без нового TCP+TLS на каждый вызов
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+def _http_session(url):
+    parts = urlsplit(url)
+    key = (os.getpid(), parts.scheme, parts.netloc)
+    session = _http_sessions.get(key)
+    if session is None:
+        with _http_sessions_lock:
+            session = _http_sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=REST_POOL_SIZE)
+                session.mount(f"{parts.scheme}://", adapter)
+                _http_sessions[key] = session
+    return session
+
+# ---------------------- Лимит запросов к порталу ----------------------
+# Приоритеты: меньше — раньше. Передача сессии оператору не должна ждать
+# фонового обновления участников.
+PRIORITY_TRANSFER = 0
+PRIORITY_DEFAULT  = 1
+PRIORITY_REFRESH  = 2
+
+class RateLimitTimeout(Exception):
+    pass
+
+class RateLimiter:
+    """Token bucket на портал, общий для всех воркеров (состояние в ratelimit.db).
+
+    Ожидающие вызовы стоят в общей очереди waiters: токен получает только
+    голова очереди по (priority, id), поэтому воркеры не обгоняют друг друга,
+    а срочные вызовы проходят раньше фоновых.
+    """
+
+    STALE_WAITER_SEC = 10.0
+
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self._ready_pid = None
+
+    def _db(self):
+        con = get_db(self.path)
+        if self._ready_pid != os.getpid():
+            con.execute('''
+                CREATE TABLE IF NOT EXISTS buckets (
+                    portal TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    blocked_until REAL NOT NULL DEFAULT 0
+                )
+            ''')
+            con.execute('''
+                CREATE TABLE IF NOT EXISTS waiters (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    portal TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    heartbeat REAL NOT NULL
+                )
+            ''')
+            con.execute("CREATE INDEX IF NOT EXISTS idx_waiters_queue ON waiters (portal, priority, id)")
+            self._ready_pid = os.getpid()
+        return con
+
+    def _bucket(self, con, portal, now):
+        row = con.execute("SELECT tokens, updated, blocked_until FROM buckets WHERE portal = ?", (portal,)).fetchone()
+        if row is None:
+            return self.burst, 0.0
+        tokens = min(self.burst, row['tokens'] + max(0.0, now - row['updated']) * self.rate)
+        return tokens, row['blocked_until']
+
+    def _store(self, con, portal, tokens, now, blocked_until):
+        con.execute(
+            "INSERT OR REPLACE INTO buckets (portal, tokens, updated, blocked_until) VALUES (?, ?, ?, ?)",
+            (portal, tokens, now, blocked_until)
+        )
+
+    def join(self, portal, priority=PRIORITY_DEFAULT):
+        """Встаёт в очередь ожидающих; вернёт номер билета."""
+        self._db()
+        with db_tx(self.path) as con:
+            return con.execute(
+                "INSERT INTO waiters (portal, priority, heartbeat) VALUES (?, ?, ?)",
+                (portal, priority, unix_time())
+            ).lastrowid
+
+    def try_acquire(self, portal, ticket):
+        """Одна попытка: None — токен выдан и билет погашен, иначе сколько ещё ждать."""
+        con = self._db()
+        with db_tx(self.path):
+            now = unix_time()
+            con.execute("UPDATE waiters SET heartbeat = ? WHERE id = ?", (now, ticket))
+            con.execute("DELETE FROM waiters WHERE heartbeat < ?", (now - self.STALE_WAITER_SEC,))
+            head = con.execute(
+                "SELECT id FROM waiters WHERE portal = ? ORDER BY priority, id LIMIT 1", (portal,)
+            ).fetchone()
+            tokens, blocked_until = self._bucket(con, portal, now)
+            if head is not None and head['id'] == ticket and tokens >= 1 and now >= blocked_until:
+                self._store(con, portal, tokens - 1, now, blocked_until)
+                con.execute("DELETE FROM waiters WHERE id = ?", (ticket,))
+                return None
+            return max((1 - tokens) / self.rate, blocked_until - now, 0.0)
+
+    def leave(self, ticket):
+        try:
+            with db_tx(self.path) as con:
+                con.execute("DELETE FROM waiters WHERE id = ?", (ticket,))
+        except Exception as e:
+            logging.error(f"Failed to drop rate limit ticket {ticket}: {e}")
+
+    def acquire(self, portal, priority=PRIORITY_DEFAULT, timeout=RATE_LIMIT_WAIT_SEC):
+        """Ждёт своей очереди и токена. Возвращает время ожидания в секундах."""
+        started = monotonic()
+        ticket = self.join(portal, priority)
+        try:
+            while True:
+                wait = self.try_acquire(portal, ticket)
+                if wait is None:
+                    ticket = None
+                    return monotonic() - started
+                if monotonic() - started + wait > timeout:
+                    raise RateLimitTimeout(f"rate limit wait for {portal} exceeded {timeout}s")
+                # не-головные ждут хотя бы один интервал пополнения, опрашивая чаще голову
+                sleep(min(max(wait, 0.02), 0.5))
+        finally:
+            if ticket is not None:
+                self.leave(ticket)
+
+    def penalize(self, portal, seconds):
+        """Портал ответил QUERY_LIMIT_EXCEEDED: обнуляем ведро и выжидаем паузу."""
+        # таблиц ещё может не быть: вызов шёл мимо сломанного лимитера (см. rest_command)
+        self._db()
+        with db_tx(self.path) as con:
+            now = unix_time()
+            _, blocked_until = self._bucket(con, portal, now)
+            self._store(con, portal, 0.0, now, max(blocked_until, now + seconds))
+
+    def state(self):
+        con = self._db()
+        now = unix_time()
+        result = {}
+        for row in con.execute("SELECT portal FROM buckets").fetchall():
+            tokens, blocked_until = self._bucket(con, row['portal'], now)
+            result[row['portal']] = {
+                'tokens': round(tokens, 3),
+                'blocked_for_sec': round(max(0.0, blocked_until - now), 3),
+                'waiting': {},
+            }
+        for row in con.execute(
+            "SELECT portal, priority, COUNT(*) AS n FROM waiters WHERE heartbeat >= ? GROUP BY portal, priority",
+            (now - self.STALE_WAITER_SEC,)
+        ).fetchall():
+            entry = result.setdefault(row['portal'], {'tokens': self.burst, 'blocked_for_sec': 0.0, 'waiting': {}})
+            entry['waiting'][row['priority']] = row['n']
+        return {'rate_per_sec': self.rate, 'burst': self.burst, 'portals': result}
+
+rate_limiter = RateLimiter(RATE_LIMIT_DB, RATE_LIMIT_RPS, RATE_LIMIT_BURST)
+
+def rest_target(auth_data, method, params=None):
+    """URL метода, параметры с токеном и портал (ключ лимитера)."""
     if params is None:
         params = {}
     api_url = f"{auth_data['client_endpoint']}{method}"
     params['auth'] = auth_data['access_token']
-    try:
-        logging.info("REST %s -> %s", method, api_url)
-        response = requests.post(api_url, json=params, timeout=15)
-        status = response.status_code
+    return api_url, params, urlsplit(api_url).netloc
+
+def rest_waited(method, portal, waited):
+    metrics.observe('b24bot_rest_ratelimit_wait_seconds', waited, portal=portal)
+    if waited > 1:
+        logging.info("REST %s waited %.1fs for rate limit", method, waited)
+
+def rest_outcome(method, portal, status, js, penalties):
+    """Учитывает ответ портала. True — QUERY_LIMIT_EXCEEDED: вызов надо повторить после паузы."""
+    if rest_expired(js):
+        # повтор с новым токеном решает вызывающий (см. refresh_auth)
+        metrics.inc('b24bot_rest_requests_total', method=method, portal=portal, outcome='expired_token')
+        logging.warning("REST %s rejected: access token expired", method)
+        return False
+    if RATE_LIMIT_ENABLED and js.get('error') == 'QUERY_LIMIT_EXCEEDED' and penalties < 3:
+        # не падаем, а встаём в очередь заново после паузы
+        metrics.inc('b24bot_rest_requests_total', method=method, portal=portal, outcome='query_limit')
+        logging.warning("REST %s hit QUERY_LIMIT_EXCEEDED, requeueing (%s)", method, penalties + 1)
+        rate_limiter.penalize(portal, RATE_LIMIT_PENALTY_SEC * (penalties + 1))
+        return True
+    if status >= 400 or 'error' in js:
+        metrics.inc('b24bot_rest_requests_total', method=method, portal=portal, outcome='error')
+        logging.error("REST %s FAILED status=%s body=%s", method, status, Redacted(js))
+    else:
+        metrics.inc('b24bot_rest_requests_total', method=method, portal=portal, outcome='ok')
+        logging.info("REST %s OK status=%s result_keys=%s", method, status, list(js.keys()))
+    return False
+
+def rest_command(auth_data, method, params=None, priority=PRIORITY_DEFAULT):
+    auth_data = fresh_auth(auth_data)
+    api_url, params, portal = rest_target(auth_data, method, params)
+    penalties = 0
+    refreshed = False
+    while True:
+        if RATE_LIMIT_ENABLED:
+            try:
+                rest_waited(method, portal, rate_limiter.acquire(portal, priority))
+            except RateLimitTimeout as e:
+                logging.error("REST %s not sent: %s", method, e)
+                return {'error': 'RATE_LIMIT_TIMEOUT', 'error_description': str(e)}
+            except Exception as e:
+                # сломанный ratelimit.db не должен останавливать вызовы
+                logging.error("Rate limiter failed, calling %s without it: %s", method, e)
+        started = perf_counter()
         try:
-            js = response.json()
-        except Exception:
-            js = {'non_json': response.text[:2000]}
-        if status >= 400 or 'error' in js:
-            logging.error("REST %s FAILED status=%s body=%s", method, status, redact(js))
+            logging.info("REST %s -> %s", method, api_url)
+            response = _http_session(api_url).post(api_url, json=params, timeout=REST_TIMEOUT)
+            metrics.observe('b24bot_rest_duration_seconds', perf_counter() - started, method=method, portal=portal)
+            try:
+                js = response.json()
+            except Exception:
+                js = {'non_json': response.text[:2000]}
+            if rest_outcome(method, portal, response.status_code, js, penalties):
+                penalties += 1
+                continue
+            if rest_expired(js) and not refreshed:
+                refreshed = True
+                fresh = refresh_auth(auth_data)
+                if fresh:
+                    auth_data = fresh
+                    api_url, params, portal = rest_target(auth_data, method, params)
+                    continue
+            response.raise_for_status()
+            return js
+        except requests.exceptions.RequestException as e:
+            if not isinstance(e, requests.exceptions.HTTPError):
+                # HTTPError из raise_for_status уже посчитан как error
+                metrics.observe('b24bot_rest_duration_seconds', perf_counter() - started, method=method, portal=portal)
+                metrics.inc('b24bot_rest_requests_total', method=method, portal=portal, outcome='exception')
+            logging.error("REST %s exception: %s", method, e)
+            return {'error': str(e)}
+
+def run_rest(steps):
+    """Выполняет сценарий из шагов REST через rest_command.
+
+    Сценарий — генератор: отдаёт аргументы rest_command (auth_data, метод,
+    параметры, приоритет) и получает ответ портала. Всё, что между вызовами
+    (SQLite, auth.json), остаётся в генераторе, поэтому тот же сценарий
+    выполняет и асинхронный режим (main_async.py) своим HTTP-клиентом.
+    """
+    try:
+        call = next(steps)
+        while True:
+            call = steps.send(rest_command(*call))
+    except StopIteration as e:
+        return e.value
+
+# ---------------------- Batch-вызовы Б24 ----------------------
+REST_BATCH_LIMIT = 50  # столько команд Bitrix24 принимает в одном batch
+
+def _php_query(params, prefix=None):
+    """Аналог PHP http_build_query: {'ID': [1, 2]} -> 'ID[0]=1&ID[1]=2'."""
+    if isinstance(params, dict):
+        items = params.items()
+    else:
+        items = enumerate(params)
+    pairs = []
+    for k, v in items:
+        key = f"{prefix}[{k}]" if prefix is not None else str(k)
+        if isinstance(v, (dict, list, tuple)):
+            nested = _php_query(v, key)
+            if nested:
+                pairs.append(nested)
         else:
-            logging.info("REST %s OK status=%s result_keys=%s", method, status, list(js.keys()))
-        response.raise_for_status()
-        return js
-    except requests.exceptions.RequestException as e:
-        logging.error("REST %s exception: %s", method, e)
-        return {'error': str(e)}
+            if v is None:
+                v = ''
+            elif isinstance(v, bool):
+                v = 'Y' if v else 'N'
+            pairs.append(f"{quote(key, safe='[]')}={quote(str(v), safe='')}")
+    return '&'.join(pairs)
+
+def rest_batch(auth_data, commands, halt=False, priority=PRIORITY_DEFAULT):
+    return run_rest(rest_batch_steps(auth_data, commands, halt, priority))
+
+def rest_batch_steps(auth_data, commands, halt=False, priority=PRIORITY_DEFAULT):
+    """Выполняет команды через метод batch, по REST_BATCH_LIMIT за один запрос.
+
+    commands — {ключ: (метод, параметры)}; параметры могут ссылаться на
+    результат предыдущей команды той же пачки: {'ID': '$result[chat][users]'}.
+    Возвращает {ключ: {'result': ..., 'total': ..., 'next': ...}} или
+    {ключ: {'error': ..., 'error_description': ...}} для каждой команды.
+    """
+    keys = list(commands)
+    out = {}
+    for i in range(0, len(keys), REST_BATCH_LIMIT):
+        chunk = keys[i:i + REST_BATCH_LIMIT]
+        cmd = {}
+        for key in chunk:
+            method, params = commands[key]
+            query = _php_query(params or {})
+            cmd[key] = f"{method}?{query}" if query else method
+        js = yield (auth_data, 'batch', {'halt': 1 if halt else 0, 'cmd': cmd}, priority)
+        body = js.get('result') if isinstance(js, dict) else None
+        if not isinstance(body, dict):
+            error = {'error': js.get('error', 'batch_failed') if isinstance(js, dict) else 'batch_failed',
+                     'error_description': (js or {}).get('error_description', '')}
+            for key in chunk:
+                out[key] = dict(error)
+            continue
+        results = body.get('result') or {}
+        errors = body.get('result_error') or {}
+        totals = body.get('result_total') or {}
+        nexts = body.get('result_next') or {}
+        for key in chunk:
+            if key in errors:
+                err = errors[key]
+                out[key] = err if isinstance(err, dict) else {'error': str(err)}
+            elif key in results:
+                out[key] = {'result': results[key], 'total': totals.get(key), 'next': nexts.get(key)}
+            else:
+                # при halt=1 команды после ошибки не выполняются
+                out[key] = {'error': 'not_executed', 'error_description': 'batch halted'}
+        if halt and errors:
+            for key in keys[i + REST_BATCH_LIMIT:]:
+                out[key] = {'error': 'not_executed', 'error_description': 'batch halted'}
+            break
+    return out
 
 # ---------------------- Хелперы ----------------------
-def parse_bitrix_data(post_data):
+@lru_cache(maxsize=4096)
+def _key_path(key):
+    """'data[PARAMS][FILES][0]' -> (('data', 'PARAMS', 'FILES', '0'), (3,)).
+
+    Кэшируется по форме ключа; второй элемент — позиции числовых и пустых
+    индексов ниже корня, т.е. где на пути может понадобиться список.
+    """
+    path = tuple(key.replace(']', '').split('['))
+    return path, tuple(i for i, k in enumerate(path) if i and (k == '' or k.isdigit()))
+
+def parse_bitrix_data(post_data, lists=True):
+    """Разбирает PHP-ключи формы Б24 во вложенные словари.
+
+    При lists=True узлы с ключами 0..n-1 (data[PARAMS][FILES][0]) и повторяющиеся
+    'a[]' становятся списками; lists=False даёт прежний результат (только словари).
+    """
     output = {}
+    numeric = {}  # id узла -> (глубина, родитель, имя) узлов с числовыми ключами
     for key, value in post_data.items():
-        keys = key.replace(']', '').split('[')
+        path, positions = _key_path(key)
         d = output
-        for k in keys[:-1]:
+        if not (lists and positions):
+            for k in path[:-1]:
+                d = d.setdefault(k, {})
+            d[path[-1]] = value
+            continue
+        nodes = [d]
+        for k in path[:-1]:
             d = d.setdefault(k, {})
-        d[keys[-1]] = value
+            nodes.append(d)
+        leaf = path[-1]
+        if leaf == '':
+            # 'a[]=1&a[]=2' — как в PHP, дописываем по порядку
+            values = post_data.getlist(key) if hasattr(post_data, 'getlist') else [value]
+            start = len(d)
+            for i, item in enumerate(values):
+                d[str(start + i)] = item
+        else:
+            d[leaf] = value
+        for p in positions:
+            node = nodes[p]
+            if id(node) not in numeric:
+                numeric[id(node)] = (p, nodes[p - 1], path[p - 1])
+    # сначала самые глубокие узлы, чтобы родитель-список собирался из готовых детей
+    for _, parent, name in sorted(numeric.values(), key=lambda item: -item[0]):
+        node = parent[name]
+        if isinstance(node, dict) and all(str(i) in node for i in range(len(node))):
+            parent[name] = [node[str(i)] for i in range(len(node))]
     return output
 
+@metrics.timed('b24bot_db_duration_seconds', op='get_dialog_id')
 def get_dialog_id(chat_id):
+    cache = write_caches()['dialogs']
+    dialog_db_id = cache.get(chat_id)
+    if dialog_db_id is not None:
+        return dialog_db_id
     try:
-        con = sqlite3.connect(DB_FILE)
-        cur = con.cursor()
-        cur.execute("SELECT id FROM dialogs WHERE chat_id = ?", (chat_id,))
-        result = cur.fetchone()
-        con.close()
+        result = get_db().execute("SELECT id FROM dialogs WHERE chat_id = ?", (chat_id,)).fetchone()
+        if result:
+            cache.set(chat_id, result[0])
         return result[0] if result else None
     except Exception as e:
         logging.error(f"Error checking dialog {chat_id}: {e}")
+        if in_tx():
+            raise
         return None
 
+@metrics.timed('b24bot_db_duration_seconds', op='add_user')
 def add_user(user_id, user_name, role='manager'):
+    key = str(user_id)
+    cache = write_caches()['users']
+    if cache.get(key) == (user_name, role):
+        return
     try:
-        con = sqlite3.connect(DB_FILE)
-        cur = con.cursor()
-        cur.execute("INSERT OR IGNORE INTO users (id, user_name, role) VALUES (?, ?, ?)", (user_id, user_name, role))
-        cur.execute("UPDATE users SET user_name = ?, role = ? WHERE id = ?", (user_name, role, user_id))
-        con.commit()
-        con.close()
+        with db_tx() as con:
+            con.execute("INSERT OR IGNORE INTO users (id, user_name, role) VALUES (?, ?, ?)", (user_id, user_name, role))
+            con.execute("UPDATE users SET user_name = ?, role = ? WHERE id = ?", (user_name, role, user_id))
+        cache.set(key, (user_name, role))
     except Exception as e:
+        cache.discard(key)
         logging.error(f"Error adding/updating user {user_id}: {e}")
+        if in_tx():
+            raise
 
+@metrics.timed('b24bot_db_duration_seconds', op='add_participant_to_dialog')
 def add_participant_to_dialog(chat_id, user_id):
+    key = (int(chat_id), str(user_id))
+    cache = write_caches()['participants']
+    if cache.get(key):
+        return
     try:
-        con = sqlite3.connect(DB_FILE)
-        cur = con.cursor()
-        cur.execute("SELECT id FROM dialogs WHERE chat_id = ?", (chat_id,))
-        row = cur.fetchone()
-        if not row:
-            logging.error(f"add_participant_to_dialog: dialog {chat_id} not found")
-            con.close()
-            return
-        dialog_db_id = row[0]
-        cur.execute("INSERT OR IGNORE INTO dialog_participants (dialog_id, user_id) VALUES (?, ?)", (dialog_db_id, user_id))
-        con.commit()
-        con.close()
+        dialog_db_id = get_dialog_id(chat_id)
+        if not dialog_db_id:
+            raise LookupError(f"dialog {chat_id} not found")
+        get_db().execute("INSERT OR IGNORE INTO dialog_participants (dialog_id, user_id) VALUES (?, ?)", (dialog_db_id, user_id))
+        cache.set(key, True)
     except Exception as e:
         logging.error(f"Error adding participant {user_id} to chat {chat_id}: {e}")
+        if in_tx():
+            raise
 
 def update_participants_for_dialog(chat_id, auth_data):
+    return run_rest(update_participants_steps(chat_id, auth_data))
+
+def update_participants_steps(chat_id, auth_data):
     logging.info(f"Updating participants for chat_id: {chat_id}")
-    chat_get_result = rest_command(auth_data, 'im.chat.get', {'CHAT_ID': chat_id})
-    if not chat_get_result or 'result' not in chat_get_result or 'users' not in chat_get_result['result']:
+    # im.chat.get и user.get за один запрос: ID пользователей подставляет сам Б24
+    res = yield from rest_batch_steps(auth_data, {
+        'chat': ('im.chat.get', {'CHAT_ID': chat_id}),
+        'users': ('user.get', {'ID': '$result[chat][users]'}),
+    }, priority=PRIORITY_REFRESH)
+    chat_get_result = res['chat']
+    if 'result' not in chat_get_result or not isinstance(chat_get_result['result'], dict) \
+            or 'users' not in chat_get_result['result']:
         logging.error(f"Failed to get chat users for chat_id {chat_id}. Response: {chat_get_result}")
-        return
+        return False
     user_ids = chat_get_result['result']['users'] or []
     if not user_ids:
-        return
-    users_get_result = rest_command(auth_data, 'user.get', {'ID': user_ids})
-    if not users_get_result or 'result' not in users_get_result:
+        return True
+    users_get_result = res['users']
+    if 'result' not in users_get_result:
         logging.error(f"Failed to get user details for IDs {user_ids}. Response: {users_get_result}")
-        if users_get_result and isinstance(users_get_result.get('details'), dict) and users_get_result['details'].get('error') == 'insufficient_scope':
+        if users_get_result.get('error') == 'insufficient_scope':
             logging.error("CRITICAL: Missing 'user' scope. Add it in app settings and reinstall.")
-        return
-    for user in users_get_result['result']:
+        return False
+    in_chat = {str(uid) for uid in user_ids}
+    for user in users_get_result['result'] or []:
         user_id = user.get('ID')
+        if str(user_id) not in in_chat:
+            continue
         user_name = f"{user.get('NAME', '')} {user.get('LAST_NAME', '')}".strip()
         add_user(user_id, user_name)
         add_participant_to_dialog(chat_id, user_id)
+    return True
+
+# ---------------------- Запись событий (ingest) ----------------------
+def _write_event(ev):
+    """Пишет диалог, участника и сообщение одного события (внутри db_tx).
+
+    Хелперы внутри транзакции пробрасывают ошибки, поэтому событие либо
+    записывается целиком, либо откатывается целиком.
+    """
+    chat_id = ev['chat_id']
+    if not get_dialog_id(chat_id):
+        save_new_dialog(chat_id, ev['ts'])
+    if ev['user_id'] is not None:
+        add_user(ev['user_id'], ev['user_name'], ev['role'])
+        add_participant_to_dialog(chat_id, ev['user_id'])
+    if ev['message_text']:
+        save_message(chat_id, ev['user_id'], ev['message_text'], ev['ts'], ev['message_id'])
+
+# итог IngestWriter.submit()
+SUBMIT_QUEUED    = 'queued'     # в очереди, коммита не ждали
+SUBMIT_COMMITTED = 'committed'
+SUBMIT_FAILED    = 'failed'     # писатель не смог записать событие
+SUBMIT_PENDING   = 'pending'    # в очереди, но коммит не успел за timeout
+SUBMIT_FULL      = 'full'       # в очередь не попало
+
+class IngestWriter:
+    """Фоновый писатель: собирает события из очереди и коммитит их пачками."""
+
+    def __init__(self, maxsize, batch_size, flush_ms):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                if self._pid != os.getpid():
+                    # очередь родителя после fork не наследуем
+                    self.queue = queue.Queue(maxsize=self.queue.maxsize)
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, ev, wait=False, timeout=5.0):
+        """Ставит событие в очередь; при wait=True ждёт коммита. Вернёт один из SUBMIT_*.
+
+        Только при SUBMIT_FULL событие не попало к писателю и его можно писать
+        самому; SUBMIT_PENDING значит, что писатель ещё запишет его позже.
+        """
+        self._ensure_started()
+        done = Future() if wait else None
+        try:
+            self.queue.put((ev, done), timeout=timeout)
+        except queue.Full:
+            return SUBMIT_FULL
+        if done is None:
+            return SUBMIT_QUEUED
+        try:
+            return SUBMIT_COMMITTED if done.result(timeout) else SUBMIT_FAILED
+        except FutureTimeout:
+            return SUBMIT_PENDING
+
+    def _collect(self):
+        items = [self.queue.get()]
+        deadline = monotonic() + self.flush_interval
+        while len(items) < self.batch_size:
+            left = deadline - monotonic()
+            if left <= 0:
+                break
+            try:
+                items.append(self.queue.get(timeout=left))
+            except queue.Empty:
+                break
+        return items
+
+    def _commit(self, items):
+        # события разных инстансов коммитятся каждое в свою БД
+        by_tenant = OrderedDict()
+        for i, (ev, _) in enumerate(items):
+            if ev is not None:
+                by_tenant.setdefault(ev['tenant'], []).append((i, ev))
+        ok = [True] * len(items)
+        for t, indexed in by_tenant.items():
+            with use_tenant(t):
+                for (i, _), result in zip(indexed, self._commit_events([ev for _, ev in indexed])):
+                    ok[i] = result
+        for (ev, done), result in zip(items, ok):
+            if done is not None:
+                done.set_result(result)
+            elif not result:
+                with use_tenant(ev['tenant']):
+                    self._lost(ev)
+
+    def _lost(self, ev):
+        # никто не ждал коммита (async): вебхук уже ответил 200, и Б24 событие не повторит.
+        # Ключ освобождаем — повтор, если он всё же придёт, будет записан; само событие —
+        # в лог целиком, чтобы его можно было восстановить руками
+        if ev['event_key']:
+            release_event(ev['event_key'])
+        metrics.inc('b24bot_ingest_lost_total')
+        lost = {k: v for k, v in ev.items() if k != 'tenant'}
+        logging.critical(f"Acknowledged webhook event was NOT written: {json.dumps(lost, ensure_ascii=False)}")
+
+    @metrics.timed('b24bot_db_duration_seconds', op='ingest_batch')
+    def _commit_events(self, events):
+        """Коммитит пачку; вернёт по событию True/False — записано ли оно."""
+        try:
+            with db_tx():
+                for ev in events:
+                    _write_event(ev)
+            return [True] * len(events)
+        except Exception as e:
+            logging.error(f"Ingest batch of {len(events)} failed, retrying one by one: {e}")
+        results = []
+        for ev in events:
+            try:
+                with db_tx():
+                    _write_event(ev)
+                results.append(True)
+            except Exception as e:
+                logging.error(f"Ingest of event in chat {ev['chat_id']} failed: {e}")
+                results.append(False)
+        return results
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            self._commit(items)
+            for _ in items:
+                self.queue.task_done()
+
+    def flush(self, timeout=5.0):
+        """Дожидается записи всего, что уже стоит в очереди."""
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return True
+        return self.submit(None, wait=True, timeout=timeout) == SUBMIT_COMMITTED
+
+ingest_writer = IngestWriter(INGEST_QUEUE_SIZE, INGEST_BATCH_SIZE, INGEST_FLUSH_MS)
+atexit.register(ingest_writer.flush)
+
+def ingest_event(chat_id, user_id=None, user_name='', role='manager', message_text=None, message_id=None,
+                 event_key=None):
+    """Записывает событие вебхука одной транзакцией (или через групповой коммит).
+
+    False — событие не записано и откачено целиком. В режиме async ошибка
+    фонового коммита сюда не доходит, как и в group, если коммит не успел
+    за время ожидания: событие остаётся в очереди писателя. Тогда писатель
+    сам освобождает event_key (ключ дедупликации) и пишет событие в лог.
+    """
+    if not get_dialog_id(chat_id):
+        # диалог мог уехать в архив: возвращаем до транзакции записи — в ней ATTACH нельзя
+        restore_archived_dialog(chat_id)
+    ev = {
+        'chat_id': chat_id,
+        'user_id': user_id,
+        'user_name': user_name,
+        'role': role,
+        'message_text': message_text,
+        'message_id': message_id,
+        'event_key': event_key,
+        'ts': datetime.now().isoformat(),
+        'tenant': tenant(),
+    }
+    if INGEST_MODE in ('group', 'async'):
+        state = ingest_writer.submit(ev, wait=(INGEST_MODE == 'group'))
+        if state == SUBMIT_PENDING:
+            # событие уже у писателя: прямая запись дала бы вторую копию
+            logging.warning(f"Ingest of chat {chat_id} event is still pending in the writer queue")
+            return True
+        if state != SUBMIT_FULL:
+            return state != SUBMIT_FAILED
+        logging.warning(f"Ingest queue is full, writing chat {chat_id} event directly")
+    try:
+        with metrics.timer('b24bot_db_duration_seconds', op='ingest_event'), db_tx():
+            _write_event(ev)
+        return True
+    except Exception as e:
+        logging.error(f"Error ingesting event in chat {chat_id}: {e}")
+        return False
+
+# ---------------------- Повторные доставки вебхуков ----------------------
+# Б24 повторяет событие, если обработчик не ответил вовремя. Ключ события
+# занимается в webhook_events до обработки, и повтор в окне DEDUP_WINDOW_SEC
+# стоит одного поиска: сначала в памяти воркера, затем в общей таблице.
+# Запись сообщений дополнительно страхует уникальный messages.b24_message_id.
+_events_cleanup_at = {}  # файл БД -> когда чистить просроченные ключи
+
+def webhook_event_key(event, data):
+    """Ключ события для дедупликации или None, если отличить повтор не по чему."""
+    params = data.get('data', {}).get('PARAMS', {})
+    if event == 'ONIMBOTMESSAGEADD' and params.get('MESSAGE_ID'):
+        return f"msg:{params['MESSAGE_ID']}"
+    if event == 'ONIMBOTJOINCHAT' and params.get('CHAT_ID') and data.get('ts'):
+        # своего id у присоединения нет; повтор приходит с тем же ts, а новая сессия — с новым
+        return f"join:{params['CHAT_ID']}:{data['ts']}"
+    return None
+
+def _cleanup_events(con, now):
+    path = tenant().db_file
+    if _events_cleanup_at.get(path, 0) > now:
+        return
+    _events_cleanup_at[path] = now + DEDUP_CLEANUP_SEC
+    con.execute("DELETE FROM webhook_events WHERE expires_at < ?", (now,))
+
+@metrics.timed('b24bot_db_duration_seconds', op='claim_event')
+def claim_event(key):
+    """True — событие новое и занято этим вызовом, False — повтор внутри окна."""
+    cache = write_caches()['events']
+    if cache.get(key):
+        return False
+    now = unix_time()
+    try:
+        con = get_db()
+        _cleanup_events(con, now)
+        # просроченный, но ещё не вычищенный ключ занимается заново
+        claimed = con.execute(
+            "INSERT INTO webhook_events (key, expires_at) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET expires_at = excluded.expires_at WHERE expires_at < ?",
+            (key, now + DEDUP_WINDOW_SEC, now)
+        ).rowcount == 1
+    except Exception as e:
+        # лучше обработать повтор, чем потерять событие
+        logging.error(f"Error claiming webhook event {key}: {e}")
+        return True
+    # запоминаем только свой ключ: проигравший гонку не знает, чем кончится обработка
+    # у другого воркера, — если тот освободит ключ (release_event), повтор должен пройти
+    if claimed:
+        cache.set(key, True)
+    return claimed
+
+def release_event(key):
+    """Освобождает ключ, если событие не удалось обработать: повтор Б24 будет принят."""
+    write_caches()['events'].discard(key)
+    try:
+        get_db().execute("DELETE FROM webhook_events WHERE key = ?", (key,))
+    except Exception as e:
+        logging.error(f"Error releasing webhook event {key}: {e}")
+
+# ---------------------- Очередь REST-задач ----------------------
+# Исходящие вызовы Bitrix24 не делаются в обработчике вебхука: задача
+# пишется в rest_jobs, а фоновые потоки каждого воркера забирают её,
+# выполняют и при ошибке откладывают с экспоненциальной задержкой.
+# После JOB_MAX_ATTEMPTS попыток задача уходит в rest_jobs_dead.
+class JobError(Exception):
+    pass
+
+def _require_auth():
+    auth_data = get_current_auth()
+    if not auth_data:
+        raise JobError("no auth data, install the app first")
+    return auth_data
+
+# Обработчики задач — сценарии для run_rest(): отдают вызовы REST и получают ответы
+def _job_session_transfer(payload):
+    result = yield (_require_auth(), 'imopenlines.bot.session.transfer', {
+        'CHAT_ID': payload['chat_id'],
+        'QUEUE': 'Y',
+        'LEAVE': 'Y'
+    }, PRIORITY_TRANSFER)
+    if not result or 'error' in result:
+        raise JobError(f"session.transfer failed: {redact(result)}")
+
+def _job_refresh_participants(payload):
+    if not (yield from update_participants_steps(payload['chat_id'], _require_auth())):
+        raise JobError("participants refresh failed")
+
+def _job_bot_register(payload):
+    handler_url = payload['handler_url']
+    result = yield (_require_auth(), 'imbot.register', {
+        'CODE': tenant().bot_code,
+        'TYPE': 'O',
+        'EVENT_WELCOME_MESSAGE': handler_url,
+        'EVENT_MESSAGE_ADD':    handler_url,
+        'EVENT_BOT_DELETE':     handler_url,
+        'PROPERTIES': {
+            'NAME': 'Python Interceptor Bot',
+            'WORK_POSITION': 'Перехват и передача диалогов',
+            'COLOR': 'AQUA',
+        }
+    }, PRIORITY_TRANSFER)
+    if result and 'result' in result:
+        logging.info(f"Bot registered with ID: {result.get('result')}")
+    else:
+        raise JobError(f"imbot.register failed: {redact(result)}")
+
+JOB_HANDLERS = {
+    'session_transfer': _job_session_transfer,
+    'refresh_participants': _job_refresh_participants,
+    'bot_register': _job_bot_register,
+}
+
+def _db_signature(path):
+    """Размеры и mtime файла БД и её WAL: любая запись в БД меняет хотя бы один из них."""
+    sig = []
+    for name in (path, path + '-wal'):
+        try:
+            st = os.stat(name)
+            sig.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append(None)
+    return tuple(sig)
+
+def job_backoff(attempts):
+    """Задержка перед попыткой attempts+1: 2, 4, 8… секунд с джиттером, не больше максимума."""
+    delay = min(JOB_BACKOFF_SEC * (2 ** (attempts - 1)), JOB_BACKOFF_MAX_SEC)
+    return delay * random.uniform(0.8, 1.2)
+
+class JobQueue:
+    """Долговечная очередь задач в SQLite с пулом потоков-исполнителей на воркер."""
+
+    # страховка подсказки due_tenants(): пустую очередь всё равно перечитываем раз в столько секунд
+    IDLE_RECHECK_SEC = 30.0
+
+    def __init__(self, workers, poll_sec):
+        self.workers = workers
+        self.poll_sec = poll_sec
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid() and all(t.is_alive() for t in self._threads):
+            return
+        with self._lock:
+            scan = self._pid != os.getpid()
+            if scan:
+                self._pid = os.getpid()
+                self._threads = []
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                # первый поток нового процесса подгружает инстансы с задачами, оставшимися до рестарта
+                t = threading.Thread(target=self._run, args=(scan and not self._threads,),
+                                     name=f'rest-job-{len(self._threads)}', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def enqueue(self, kind, payload, delay=0.0):
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"unknown job kind: {kind}")
+        now = unix_time()
+        with db_tx() as con:
+            job_id = con.execute(
+                "INSERT INTO rest_jobs (kind, payload, run_at, created_at) VALUES (?, ?, ?, ?)",
+                (kind, json.dumps(payload), now + delay, now)
+            ).lastrowid
+        logging.info(f"Job {job_id} {kind} queued")
+        tenant().jobs_due_at = 0.0
+        self.ensure_started()
+        self.wake()
+        return job_id
+
+    def wake(self):
+        self._wakeup.set()
+
+    @metrics.timed('b24bot_db_duration_seconds', op='job_claim')
+    def _claim(self):
+        """Берёт одну готовую задачу и продлевает её аренду на JOB_LEASE_SEC.
+
+        Пустая очередь стоит одного чтения: транзакция на запись, за которую
+        конкурируют вебхуки, открывается, только когда готовая задача нашлась.
+        """
+        con = get_db()
+        while True:
+            now = unix_time()
+            row = con.execute(
+                "SELECT id, kind, payload, attempts, created_at FROM rest_jobs WHERE run_at <= ? ORDER BY run_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            # если воркер умрёт посреди задачи, её подхватят после окончания аренды;
+            # условие не даст забрать задачу, которую между чтением и BEGIN взял другой поток
+            with db_tx() as con:
+                claimed = con.execute(
+                    "UPDATE rest_jobs SET attempts = attempts + 1, run_at = ? WHERE id = ? AND run_at <= ? AND attempts = ?",
+                    (now + JOB_LEASE_SEC, row['id'], now, row['attempts'])
+                ).rowcount
+            if claimed:
+                return dict(row, attempts=row['attempts'] + 1)
+
+    def _finish(self, job, error=None):
+        now = unix_time()
+        if error is None:
+            outcome = 'ok'
+        else:
+            outcome = 'dead' if job['attempts'] >= JOB_MAX_ATTEMPTS else 'retry'
+        metrics.inc('b24bot_jobs_total', kind=job['kind'], outcome=outcome)
+        with db_tx() as con:
+            if error is None:
+                con.execute("DELETE FROM rest_jobs WHERE id = ?", (job['id'],))
+            elif job['attempts'] >= JOB_MAX_ATTEMPTS:
+                con.execute(
+                    "INSERT OR REPLACE INTO rest_jobs_dead (id, kind, payload, attempts, last_error, created_at, failed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job['id'], job['kind'], job['payload'], job['attempts'], error, job['created_at'], now)
+                )
+                con.execute("DELETE FROM rest_jobs WHERE id = ?", (job['id'],))
+                logging.error(f"Job {job['id']} {job['kind']} moved to dead letters after {job['attempts']} attempts: {error}")
+            else:
+                delay = job_backoff(job['attempts'])
+                con.execute("UPDATE rest_jobs SET run_at = ?, last_error = ? WHERE id = ?",
+                            (now + delay, error, job['id']))
+                logging.warning(f"Job {job['id']} {job['kind']} attempt {job['attempts']} failed, retry in {delay:.1f}s: {error}")
+
+    def due_tenants(self):
+        """Инстансы, в очереди которых может быть готовая задача.
+
+        После пустого опроса инстанс запоминает срок ближайшей задачи и подпись
+        файлов БД (_db_signature). Пока срок не наступил и в БД никто не писал,
+        инстанс пропускается без обращения к SQLite: простаивающие инстансы не
+        вытесняют соединения из пула потока и не опрашиваются каждый тик.
+        """
+        now = unix_time()
+        return [t for t in active_tenants()
+                if t.jobs_due_at <= now or _db_signature(t.db_file) != t.jobs_seen]
+
+    def _idle(self):
+        """Готовых задач у инстанса нет: запоминает, когда смотреть снова."""
+        t = tenant()
+        # подпись — до чтения: запись после неё заметит следующий due_tenants()
+        seen = _db_signature(t.db_file)
+        next_at = get_db().execute("SELECT MIN(run_at) FROM rest_jobs").fetchone()[0]
+        t.jobs_seen = seen
+        t.jobs_due_at = min(next_at if next_at is not None else float('inf'), unix_time() + self.IDLE_RECHECK_SEC)
+
+    def run_once(self):
+        """Выполняет одну готовую задачу. False — задач нет."""
+        job = self._claim()
+        if job is None:
+            self._idle()
+            return False
+        try:
+            run_rest(JOB_HANDLERS[job['kind']](json.loads(job['payload'])))
+        except Exception as e:
+            self._finish(job, str(e) or e.__class__.__name__)
+        else:
+            self._finish(job)
+        return True
+
+    def _run(self, scan=False):
+        if scan and tenants is not None:
+            tenants.load_pending()
+        while True:
+            # сбрасываем до опроса: wake() от enqueue() во время прохода не потеряется,
+            # а разбудит следующее ожидание сразу
+            self._wakeup.clear()
+            busy = False
+            for t in self.due_tenants():
+                try:
+                    with use_tenant(t):
+                        busy = self.run_once() or busy
+                except Exception as e:
+                    logging.error(f"Job worker error ({t.name}): {e}")
+            if not busy:
+                self._wakeup.wait(self.poll_sec)
+
+    def stats(self):
+        con = get_db()
+        pending = con.execute("SELECT kind, COUNT(*) AS n FROM rest_jobs GROUP BY kind").fetchall()
+        dead = con.execute("SELECT COUNT(*) FROM rest_jobs_dead").fetchone()[0]
+        return {'pending': {row['kind']: row['n'] for row in pending}, 'dead': dead}
+
+    def dead_letters(self, limit=100):
+        cur = get_db().execute(
+            "SELECT id, kind, payload, attempts, last_error, created_at, failed_at "
+            "FROM rest_jobs_dead ORDER BY failed_at DESC LIMIT ?", (limit,)
+        )
+        return [dict(row) for row in cur.fetchall()]
+
+    def retry_dead(self, job_id):
+        """Возвращает задачу из dead letters в очередь. False — такой нет."""
+        now = unix_time()
+        with db_tx() as con:
+            row = con.execute("SELECT kind, payload, created_at FROM rest_jobs_dead WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return False
+            con.execute("INSERT INTO rest_jobs (kind, payload, run_at, created_at) VALUES (?, ?, ?, ?)",
+                        (row['kind'], row['payload'], now, row['created_at']))
+            con.execute("DELETE FROM rest_jobs_dead WHERE id = ?", (job_id,))
+        tenant().jobs_due_at = 0.0
+        self.ensure_started()
+        self.wake()
+        return True
+
+job_queue = JobQueue(JOB_WORKERS, JOB_POLL_SEC)
+
+def enqueue_job(kind, payload, delay=0.0):
+    try:
+        return job_queue.enqueue(kind, payload, delay)
+    except Exception as e:
+        logging.error(f"Failed to enqueue job {kind}: {e}")
+        return None
 
 # ---------------------- Безопасность API ----------------------
 def token_required(f):
@@ -300,14 +2569,20 @@ def token_required(f):
                 return json.dumps({'message': 'Bearer token malformed'}), 401, {'Content-Type': 'application/json'}
         if not token:
             return json.dumps({'message': 'Token is missing!'}), 401, {'Content-Type': 'application/json'}
-        if token != API_SECRET_TOKEN:
+        if token != tenant().api_token:
             return json.dumps({'message': 'Token is invalid!'}), 401, {'Content-Type': 'application/json'}
         return f(*args, **kwargs)
     return decorated
 
-def _admin_check():
+def _admin_check(pool=False):
+    """403, если токен не подходит.
+
+    pool=True — эндпойнт меняет или показывает состояние всего процесса; в
+    мультитенантном режиме он требует POOL_ADMIN_TOKEN, а не токен инстанса.
+    """
     tok = request.args.get('token') or request.headers.get('X-API-Token')
-    if tok != API_SECRET_TOKEN:
+    expected = POOL_ADMIN_TOKEN if pool and tenants is not None else tenant().api_token
+    if not expected or tok != expected:
         abort(403)
 
 # ---------------------- Глобальный before_request ----------------------
@@ -316,9 +2591,12 @@ _first_request_checked = False
 @app.before_request
 def _before_every_request():
     global _first_request_checked
+    g.started = perf_counter()
     # 1) один раз на первый запрос — гарантируем БД (аналог before_first_request в Flask<3)
     if not _first_request_checked:
-        ensure_db_exists()
+        migrate_db()
+        job_queue.ensure_started()
+        metrics.ensure_started()
         _first_request_checked = True
 
     # 2) мягкое выключение бота
@@ -327,27 +2605,229 @@ def _before_every_request():
     if request.method == 'POST' and request.path.endswith('/python_bot/') and not bot_enabled():
         return ('', 204)
 
-    # 3) логируем интересные запросы
-    if request.path.endswith('/python_bot/') or request.path.startswith('/api/'):
+    # 3) логируем интересные запросы (тело — с выборкой по типу события, см. LOG_BODY_SAMPLING)
+    if (request.path.endswith('/python_bot/') or request.path.startswith('/api/')) and logger.isEnabledFor(logging.INFO):
         hdrs = {k: v for k, v in request.headers.items()
                 if k.lower() in ('host','user-agent','content-type','x-forwarded-for','x-forwarded-proto','x-forwarded-prefix')}
-        body = request.get_data(as_text=True)[:4000]
-        logging.info("REQ %s %s headers=%s body=%s", request.method, request.path, hdrs, body)
+        event = None
+        if request.method == 'POST':
+            # сначала сырое тело в кэш: разбор формы иначе вычитает поток, и body= в логе будет пустым
+            request.get_data(cache=True)
+            event = request.form.get('event')
+        if LOG_BODY_MAX > 0 and should_log_body(event):
+            body = request.get_data(as_text=True)[:LOG_BODY_MAX]
+        else:
+            body = '<skipped>'
+        logging.info("REQ %s %s event=%s headers=%s body=%s", request.method, request.path, event, hdrs, body)
+
+_EVENT_NAME_RE = re.compile(r'^ON[A-Z_]{1,60}$')
+
+@app.after_request
+def _after(resp):
+    if request.path.endswith('/python_bot/') or request.path.startswith('/api/'):
+        logging.info("RESP %s %s -> %s", request.method, request.path, resp.status_code)
+    started = g.get('started')
+    if started is not None:
+        elapsed = perf_counter() - started
+        if request.method == 'POST' and request.path.endswith('/python_bot/'):
+            # тип события приходит от клиента — чужие значения не плодят серии
+            event = request.form.get('event') or ''
+            event = event if _EVENT_NAME_RE.match(event) else 'other'
+            metrics.inc('b24bot_webhook_requests_total', event=event, status=resp.status_code)
+            metrics.observe('b24bot_webhook_duration_seconds', elapsed, event=event)
+        elif request.url_rule is not None and request.path.startswith('/api/'):
+            route = request.url_rule.rule
+            metrics.inc('b24bot_http_requests_total', route=route, method=request.method, status=resp.status_code)
+            metrics.observe('b24bot_http_duration_seconds', elapsed, route=route)
+    return resp
+
+# ---------------------- Чтение логов ----------------------
+# Записи читаются с конца файла блоками и по цепочке bot.log -> bot.log.1 -> … ,
+# поэтому хвост из 200 строк не требует читать весь лог. Строки без заголовка
+# (traceback, многострочные тела) приклеиваются к своей записи.
+_LOG_HEAD_RE = re.compile(r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d{3} - ([A-Z]+) - ')
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'CRITICAL': 50}
+
+def log_files():
+    """bot.log и его ротированные копии, от новых к старым."""
+    paths = [LOG_FILE] + [f"{LOG_FILE}.{i}" for i in range(1, LOG_BACKUP_COUNT + 1)]
+    return [p for p in paths if os.path.exists(p)]
+
+def _reverse_lines(path, block=LOG_READ_BLOCK):
+    """Строки файла (bytes, без \\n) от последней к первой."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        rest = b''
+        while pos > 0:
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            lines = (f.read(step) + rest).split(b'\n')
+            rest = lines[0]
+            for line in reversed(lines[1:]):
+                yield line
+        yield rest
+
+def _reverse_records():
+    """Записи лога (str, с \\n) от новых к старым через все ротированные файлы."""
+    for path in log_files():
+        pending = []
+        try:
+            for raw in _reverse_lines(path):
+                line = raw.decode('utf-8', errors='ignore')
+                if not line and not pending:
+                    continue
+                pending.append(line)
+                if _LOG_HEAD_RE.match(line):
+                    yield '\n'.join(reversed(pending)) + '\n'
+                    pending = []
+        except FileNotFoundError:
+            # файл ротировали прямо во время чтения
+            continue
+        if pending:
+            yield '\n'.join(reversed(pending)) + '\n'
+
+def _parse_log_time(value):
+    value = value.strip().replace('T', ' ')
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value[:19], fmt).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            continue
+    raise ValueError(f"bad time: {value}")
+
+class LogFilter:
+    """Фильтр записей лога; since/until — локальное время сервера, как в самом логе."""
+
+    def __init__(self, level=None, substring=None, regex=None, since=None, until=None, chat_id=None, tenant=None):
+        self.min_level = None
+        if level:
+            level = level.upper()
+            if level not in LOG_LEVELS:
+                raise ValueError('bad level')
+            self.min_level = LOG_LEVELS[level]
+        self.substring = substring or None
+        self.regex = re.compile(regex) if regex else None
+        self.since = _parse_log_time(since) if since else None
+        self.until = _parse_log_time(until) if until else None
+        self.chat_re = None
+        if chat_id:
+            if not str(chat_id).isdigit():
+                raise ValueError('bad chat_id')
+            # "chat 55", "chat_id: 55", "'CHAT_ID': '55'", "CHAT_ID%5D=55" в теле запроса
+            self.chat_re = re.compile(r"(?i)chat(?:_id)?(?:%5D|\])?['\"]?[\s:=,'\"]{0,4}" + str(chat_id) + r"\b")
+        self.tenant_tag = f' - [{tenant}] ' if tenant else None
+
+    def time_of(self, record):
+        m = _LOG_HEAD_RE.match(record)
+        return m.group(1) if m else None
+
+    def too_old(self, record):
+        ts = self.time_of(record)
+        return self.since is not None and ts is not None and ts < self.since
+
+    def match(self, record):
+        m = _LOG_HEAD_RE.match(record)
+        if m:
+            ts, level = m.group(1), m.group(2)
+            if self.since is not None and ts < self.since:
+                return False
+            if self.until is not None and ts > self.until:
+                return False
+            if self.min_level is not None and LOG_LEVELS.get(level, 0) < self.min_level:
+                return False
+        elif self.min_level is not None or self.since is not None or self.until is not None:
+            return False
+        if self.tenant_tag is not None and self.tenant_tag not in record:
+            return False
+        if self.substring is not None and self.substring not in record:
+            return False
+        if self.regex is not None and not self.regex.search(record):
+            return False
+        if self.chat_re is not None and not self.chat_re.search(record):
+            return False
+        return True
+
+def tail_log_records(flt, n):
+    """До n подходящих записей, от новых к старым."""
+    found = 0
+    for record in _reverse_records():
+        if flt.too_old(record):
+            # дальше только более старые записи
+            return
+        if flt.match(record):
+            yield record
+            found += 1
+            if found >= n:
+                return
+
+def log_end_position():
+    try:
+        st = os.stat(LOG_FILE)
+    except FileNotFoundError:
+        return (None, 0)
+    return (st.st_ino, st.st_size)
+
+def _group_records(lines, pending, final=False):
+    """Склеивает строки (без \\n) в записи, как _reverse_records, но в прямом порядке.
 
-@app.after_request
-def _after(resp):
-    if request.path.endswith('/python_bot/') or request.path.startswith('/api/'):
-        logging.info("RESP %s %s -> %s", request.method, request.path, resp.status_code)
-    return resp
+    Запись закончена, когда пришёл заголовок следующей; её начало копится в
+    pending между вызовами. final — отдать и недописанную pending.
+    """
+    for line in lines:
+        if _LOG_HEAD_RE.match(line) and pending:
+            yield '\n'.join(pending) + '\n'
+            pending.clear()
+        if line or pending:
+            pending.append(line)
+    if final and pending:
+        yield '\n'.join(pending) + '\n'
+        pending.clear()
+
+def follow_log_records(flt, position, duration):
+    """Long-poll: отдаёт новые записи bot.log в течение duration секунд.
+
+    Фильтр применяется к записи целиком, со строками traceback, как в хвосте.
+    """
+    inode, offset = position
+    deadline = monotonic() + duration
+    partial = ''
+    pending = []
+    while monotonic() < deadline:
+        try:
+            st = os.stat(LOG_FILE)
+            if st.st_ino != inode or st.st_size < offset:
+                # лог ротировали — читаем новый файл с начала
+                yield from filter(flt.match, _group_records([], pending, final=True))
+                inode, offset, partial = st.st_ino, 0, ''
+            if st.st_size > offset:
+                with open(LOG_FILE, 'rb') as f:
+                    f.seek(offset)
+                    data = f.read(st.st_size - offset)
+                offset += len(data)
+                text = partial + data.decode('utf-8', errors='ignore')
+                lines = text.split('\n')
+                partial = lines.pop()
+                yield from filter(flt.match, _group_records(lines, pending))
+                continue
+        except FileNotFoundError:
+            pass
+        if not partial:
+            # новых строк нет: обработчик пишет запись с traceback одним вызовом, значит последняя дописана
+            yield from filter(flt.match, _group_records([], pending, final=True))
+        sleep(LOG_FOLLOW_POLL_SEC)
+    yield from filter(flt.match, _group_records([], pending, final=True))
 
 # ---------------------- Админ-эндпойнты ----------------------
 @app.route('/api/admin/enable', methods=['POST'])
 def admin_enable():
     _admin_check()
-    if os.path.exists(DISABLED_FLAG):
-        os.remove(DISABLED_FLAG)
+    t = tenant()
+    if os.path.exists(t.disabled_flag):
+        os.remove(t.disabled_flag)
     try:
-        with open(ENABLED_FLAG, 'w') as _:
+        with open(t.enabled_flag, 'w') as _:
             pass
     except Exception:
         pass
@@ -356,18 +2836,33 @@ def admin_enable():
 @app.route('/api/admin/disable', methods=['POST'])
 def admin_disable():
     _admin_check()
-    with open(DISABLED_FLAG, 'w') as _:
+    with open(tenant().disabled_flag, 'w') as _:
         pass
     return jsonify({'ok': True, 'enabled': False})
 
 @app.route('/api/admin/status', methods=['GET'])
 def admin_status():
     _admin_check()
-    return jsonify({'ok': True, 'enabled': bot_enabled(), 'instance': INSTANCE, 'bot_code': BOT_CODE})
+    t = tenant()
+    auth = get_current_auth() or {}
+    try:
+        expires_in = round(float(auth['expires']) - unix_time())
+    except (KeyError, TypeError, ValueError):
+        expires_in = None
+    return jsonify({'ok': True, 'enabled': bot_enabled(), 'instance': t.name, 'bot_code': t.bot_code,
+                    'auth': {'installed': bool(auth), 'token_expires_in_sec': expires_in,
+                             'refresh_failed': t.auth_store.refresh_failed_at is not None}})
+
+@app.route('/api/admin/logging', methods=['GET'])
+def admin_logging():
+    _admin_check(pool=True)
+    return jsonify({'ok': True, 'level': logging.getLevelName(logger.level),
+                    'queue_size': queue_handler.queue.qsize(), 'dropped': queue_handler.dropped,
+                    'body_sampling': LOG_BODY_RATES})
 
 @app.route('/api/admin/loglevel', methods=['POST'])
 def admin_loglevel():
-    _admin_check()
+    _admin_check(pool=True)
     lvl = (request.args.get('level') or (request.json.get('level') if request.is_json else '')).upper()
     if lvl not in ('DEBUG','INFO','WARNING','ERROR','CRITICAL'):
         return jsonify({'ok': False, 'error': 'bad level'}), 400
@@ -375,21 +2870,575 @@ def admin_loglevel():
     logging.info("Log level changed to %s by admin", lvl)
     return jsonify({'ok': True, 'level': lvl})
 
+@app.route('/api/admin/db', methods=['GET'])
+def admin_db():
+    _admin_check()
+    plans = check_query_plans()
+    return jsonify({
+        'ok': all(p['indexed'] for p in plans.values()),
+        'schema_version': schema_version(),
+        'expected_version': SCHEMA_VERSION,
+        'query_plans': plans,
+        'search_index': search_status(),
+        'stats': stats_status(),
+        'archive': archive_status(),
+    })
+
+@app.route('/api/admin/search/backfill', methods=['POST'])
+def admin_search_backfill():
+    _admin_check()
+    started = start_search_backfill(rebuild=request.args.get('rebuild') in ('1', 'true', 'yes'))
+    return jsonify({'ok': True, 'started': started, **search_status()}), 202 if started else 200
+
+@app.route('/api/admin/stats/backfill', methods=['POST'])
+def admin_stats_backfill():
+    _admin_check()
+    started = start_stats_backfill(rebuild=request.args.get('rebuild') in ('1', 'true', 'yes'))
+    return jsonify({'ok': True, 'started': started, **stats_status()}), 202 if started else 200
+
+@app.route('/api/admin/archive', methods=['POST'])
+def admin_archive():
+    _admin_check()
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return jsonify({'ok': False, 'error': 'ARCHIVE_AFTER_DAYS is not set'}), 400
+    started = start_archive()
+    return jsonify({'ok': True, 'started': started}), 202 if started else 200
+
+@app.route('/api/admin/jobs', methods=['GET'])
+def admin_jobs():
+    _admin_check()
+    try:
+        limit = int(request.args.get('limit', 100))
+    except Exception:
+        limit = 100
+    return jsonify({'ok': True, **job_queue.stats(), 'dead_letters': job_queue.dead_letters(limit)})
+
+@app.route('/api/admin/jobs/<int:job_id>/retry', methods=['POST'])
+def admin_job_retry(job_id):
+    _admin_check()
+    if not job_queue.retry_dead(job_id):
+        return jsonify({'ok': False, 'error': 'job not found'}), 404
+    return jsonify({'ok': True, 'id': job_id})
+
+@app.route('/api/admin/dialogs/<int:chat_id>/refresh', methods=['POST'])
+def admin_refresh_participants(chat_id):
+    _admin_check()
+    job_id = enqueue_job('refresh_participants', {'chat_id': chat_id})
+    if job_id is None:
+        return jsonify({'ok': False, 'error': 'failed to queue job'}), 500
+    return jsonify({'ok': True, 'job_id': job_id})
+
+@app.route('/api/admin/ratelimit', methods=['GET'])
+def admin_ratelimit():
+    _admin_check(pool=True)
+    return jsonify({'ok': True, 'enabled': RATE_LIMIT_ENABLED, **rate_limiter.state()})
+
+@app.route('/api/admin/cache', methods=['GET'])
+def admin_cache():
+    _admin_check()
+    return jsonify({'ok': True, 'pid': os.getpid(),
+                    'caches': {name: cache.stats() for name, cache in write_caches().items()}})
+
+@app.route('/api/admin/cache/clear', methods=['POST'])
+def admin_cache_clear():
+    _admin_check()
+    clear_write_caches()
+    return jsonify({'ok': True})
+
+def _process_metrics():
+    """Счётчики и очереди, которые процесс и так ведёт сам: кэши, очередь ingest и логов."""
+    out = []
+    active = active_tenants()
+    for t in active:
+        for name, cache in t.caches.items():
+            st = cache.stats()
+            out += [('b24bot_cache_hits_total', {'cache': name}, st['hits']),
+                    ('b24bot_cache_misses_total', {'cache': name}, st['misses']),
+                    ('b24bot_cache_entries', {'cache': name}, st['size'])]
+    if tenants is not None:
+        out.append(('b24bot_tenants_active', {}, len(active)))
+    out += [('b24bot_queue_depth', {'queue': 'ingest'}, ingest_writer.queue.qsize()),
+            ('b24bot_queue_depth', {'queue': 'log'}, queue_handler.queue.qsize()),
+            ('b24bot_log_dropped_total', {}, queue_handler.dropped)]
+    return out
+
+metrics.add_collector(_process_metrics)
+
+def _shared_metrics():
+    """Значения из общих БД — одинаковы для всех воркеров, их не суммируем."""
+    out = []
+    jobs = job_queue.stats()
+    for kind in JOB_HANDLERS:
+        out.append(('b24bot_jobs_pending', {'kind': kind}, jobs['pending'].get(kind, 0)))
+    out.append(('b24bot_jobs_dead', {}, jobs['dead']))
+    if RATE_LIMIT_ENABLED:
+        for portal, st in rate_limiter.state()['portals'].items():
+            for priority, n in st['waiting'].items():
+                out.append(('b24bot_ratelimit_waiting', {'portal': portal, 'priority': priority}, n))
+    return out
+
+@app.route('/api/admin/metrics', methods=['GET'])
+def admin_metrics():
+    """Метрики всех воркеров в текстовом формате Prometheus."""
+    _admin_check(pool=True)
+    if not METRICS_ENABLED:
+        return Response('# metrics disabled (METRICS_ENABLED=0)\n', mimetype='text/plain')
+    metrics.ensure_started()
+    try:
+        shared = _shared_metrics()
+    except Exception as e:
+        logging.error(f"Shared metrics failed: {e}")
+        shared = []
+    return Response(render_metrics(metrics.collect(), shared), mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/admin/logs', methods=['GET'])
 def admin_logs():
+    """Хвост лога с фильтрами: lines, level, q, regex, since, until, chat_id, order, follow, timeout."""
     _admin_check()
+    args = request.args
     try:
-        n = int(request.args.get('lines', 200))
+        n = int(args.get('lines', 200))
     except Exception:
         n = 200
+    n = max(1, min(n, LOG_TAIL_MAX))
     try:
-        with open(LOG_FILE, 'r', encoding='utf-8', errors='ignore') as f:
-            lines = f.readlines()[-n:]
-        return Response(''.join(lines), mimetype='text/plain; charset=utf-8')
+        flt = LogFilter(
+            level=args.get('level'),
+            substring=args.get('q'),
+            regex=args.get('regex'),
+            since=args.get('since'),
+            until=args.get('until'),
+            chat_id=args.get('chat_id'),
+            # общий bot.log мультитенантного режима: только записи своего инстанса
+            tenant=tenant().name if tenants is not None else None,
+        )
+    except (ValueError, re.error) as e:
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    newest_first = args.get('order') == 'desc'
+    follow = args.get('follow') in ('1', 'true', 'yes')
+    try:
+        follow_sec = min(float(args.get('timeout', 30)), LOG_FOLLOW_MAX_SEC)
+    except ValueError:
+        follow_sec = 30.0
+    try:
+        # позицию для follow запоминаем до чтения хвоста, чтобы не потерять строки между ними
+        position = log_end_position() if follow else None
+        records = tail_log_records(flt, n)
+        if newest_first:
+            body = records
+        else:
+            body = reversed(list(records))
+        def generate():
+            for record in body:
+                yield record
+            if follow:
+                yield from follow_log_records(flt, position, follow_sec)
+        return Response(generate(), mimetype='text/plain; charset=utf-8')
     except Exception as e:
         return jsonify({'ok': False, 'error': str(e)}), 500
 
+# ---------------------- Архив старых сообщений ----------------------
+# Сообщения старше ARCHIVE_AFTER_DAYS дней переезжают в archive/<YYYY-MM>.db
+# рядом с dialogs.db (месяц — по времени сообщения), диалоги без сообщений в
+# горячей БД — туда же по месяцу start_time вместе с участниками. Схема
+# архива повторяет таблицы горячей БД. Чтение подключает (ATTACH) только
+# архивы месяцев, которые задевает запрошенный интервал.
+ARCHIVE_TABLES = ('dialogs', 'dialog_participants', 'messages')
+# ключ строки: по нему чтение отбрасывает архивную копию, если строка ещё (или снова)
+# в горячей БД; диалог — по chat_id, id у вернувшегося из архива тот же
+ARCHIVE_KEYS = {'dialogs': ('chat_id',), 'dialog_participants': ('dialog_id', 'user_id'), 'messages': ('id',)}
+
+def archive_dir(path=None):
+    return os.path.join(os.path.dirname(path or tenant().db_file), 'archive')
+
+def archive_file(month, path=None):
+    return os.path.join(archive_dir(path), f'{month}.db')
+
+def _archive_schema(month):
+    return 'arc_' + month.replace('-', '_')
+
+def _attached(con):
+    return [row['name'] for row in con.execute("PRAGMA database_list") if row['name'].startswith('arc_')]
+
+def attach_archives(con, months, path=None, create=False):
+    """Подключает к соединению архивы месяцев; возвращает имена схем подключённых.
+
+    Подключения живут вместе с соединением потока; сверх ARCHIVE_ATTACH_MAX
+    ненужные сейчас отключаются. Несуществующий файл без create пропускается —
+    ATTACH создал бы пустой.
+    """
+    attached = _attached(con)
+    wanted = {_archive_schema(m): m for m in months}
+    missing = [name for name in wanted if name not in attached]
+    if missing and len(attached) + len(missing) > ARCHIVE_ATTACH_MAX:
+        for name in attached:
+            if name not in wanted:
+                try:
+                    con.execute(f"DETACH DATABASE {name}")
+                except sqlite3.OperationalError:
+                    pass  # ещё читается незакрытым курсором
+    schemas = []
+    for name, month in wanted.items():
+        if name in missing:
+            file = archive_file(month, path)
+            if not create and not os.path.exists(file):
+                logging.warning(f"Archive {file} is listed in archive_months but missing")
+                continue
+            os.makedirs(os.path.dirname(file), exist_ok=True)
+            con.execute(f"ATTACH DATABASE ? AS {name}", (file,))
+        schemas.append(name)
+    return schemas
+
+def archive_schemas(con, ts_from, ts_to, path=None):
+    """Схемы архивов месяцев, которые пересекаются с [ts_from, ts_to]."""
+    months = [row[0] for row in con.execute(
+        "SELECT month FROM archive_months WHERE month BETWEEN ? AND ?", (ts_from[:7], ts_to[:7]))]
+    return attach_archives(con, months, path) if months else []
+
+def _archive_source(schema, table):
+    # перенос коммитит архив раньше, чем удаляет из горячей БД (см. _copy_to_archive):
+    # после сбоя между ними строка есть в обоих местах — берём горячую
+    match = ' AND '.join(f"_h.{key} = _a.{key}" for key in ARCHIVE_KEYS[table])
+    return (f"(SELECT * FROM {schema}.{table} _a "
+            f"WHERE NOT EXISTS (SELECT 1 FROM main.{table} _h WHERE {match}))")
+
+def in_schema(sql, schema=None):
+    """Запрос по шаблону с {dialogs}, {dialog_participants}, {messages} — к горячей БД или архиву schema.
+
+    Псевдоним таблицы пишет сам шаблон ("FROM {messages} m"); users всегда из горячей БД.
+    """
+    if schema is None:
+        return sql.format(**{table: table for table in ARCHIVE_TABLES})
+    return sql.format(**{table: _archive_source(schema, table) for table in ARCHIVE_TABLES})
+
+def archive_union(sql, params, schemas):
+    """Шаблон вида "SELECT … ORDER BY …" по горячей БД и архивам schemas через UNION ALL."""
+    if not schemas:
+        return in_schema(sql), tuple(params)
+    head, order = sql.rsplit('ORDER BY', 1)
+    parts = [in_schema(head, schema) for schema in (None,) + tuple(schemas)]
+    # снаружи подзапроса видны только имена столбцов результата: m.timestamp -> timestamp
+    order = re.sub(r'\b\w+\.', '', order)
+    return 'SELECT * FROM (' + ' UNION ALL '.join(parts) + ') ORDER BY' + order, tuple(params) * len(parts)
+
+def _ensure_archive_schema(con, schema):
+    for table in ARCHIVE_TABLES:
+        sql = con.execute("SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+        con.execute(re.sub(r'^CREATE TABLE ', f'CREATE TABLE IF NOT EXISTS {schema}.', sql))
+        # архив мог быть создан при старой схеме — добавляем столбцы, появившиеся позже
+        have = {row['name'] for row in con.execute(f"PRAGMA {schema}.table_info({table})")}
+        for col in con.execute(f"PRAGMA main.table_info({table})").fetchall():
+            if col['name'] not in have:
+                con.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {col['name']} {col['type']}")
+    con.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_dialogs_start_time ON dialogs (start_time)")
+    con.execute(f"CREATE INDEX IF NOT EXISTS {schema}.idx_messages_chat_ts ON messages (dialog_chat_id, timestamp)")
+    # свой полнотекстовый индекс: при переносе строка уходит из messages_fts горячей
+    # БД (триггер на DELETE) и попадает в индекс архива триггером на INSERT
+    if not con.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'messages_fts'").fetchone():
+        con.execute(f"""
+            CREATE VIRTUAL TABLE {schema}.messages_fts USING fts5(
+                message_text, content='messages', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        # архив, перенесённый до появления индекса в архивах
+        con.execute(f"INSERT INTO {schema}.messages_fts (rowid, message_text) "
+                    f"SELECT id, {_fts_text('message_text')} FROM {schema}.messages")
+    con.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {schema}.trg_messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, message_text) VALUES (NEW.id, {_fts_text('NEW.message_text')});
+        END
+    """)
+
+def _copy_to_archive(con, path, schema, table, key, ids):
+    # отдельная транзакция до удаления из горячей БД: в WAL коммит по двум файлам
+    # не атомарен даже в одной транзакции, а так при сбое строка окажется в обоих
+    # местах, но не потеряется; дубль отбрасывает чтение (in_schema), следующий
+    # перенос удаляет горячую копию
+    cols = ', '.join(row['name'] for row in con.execute(f"PRAGMA main.table_info({table})"))
+    with db_tx(path):
+        con.execute(f"INSERT OR IGNORE INTO {schema}.{table} ({cols}) "
+                    f"SELECT {cols} FROM main.{table} WHERE {key} IN (SELECT value FROM json_each(?))", (ids,))
+
+def _delete_archived(con, schema, table, key, ids):
+    return con.execute(
+        f"DELETE FROM main.{table} WHERE {key} IN (SELECT value FROM json_each(?)) "
+        f"AND {key} IN (SELECT {key} FROM {schema}.{table} WHERE {key} IN (SELECT value FROM json_each(?)))",
+        (ids, ids)).rowcount
+
+def _count_archived(con, month, dialogs=0, messages=0):
+    con.execute(
+        "INSERT INTO archive_months (month, dialogs, messages, updated_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (month) DO UPDATE SET dialogs = dialogs + excluded.dialogs, "
+        "messages = messages + excluded.messages, updated_at = excluded.updated_at",
+        (month, dialogs, messages, datetime.now().isoformat()))
+
+def _by_month(rows, ts):
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[ts][:7], []).append(row)
+    return sorted(groups.items())
+
+def archive_messages(con, path, cutoff, batch):
+    """Переносит сообщения старше cutoff; идёт по id, пока в пачке есть старые."""
+    moved, after = 0, 0
+    while True:
+        rows = con.execute("SELECT id, timestamp FROM messages WHERE id > ? ORDER BY id LIMIT ?",
+                           (after, batch)).fetchall()
+        old = [row for row in rows if row['timestamp'] < cutoff]
+        if not old:
+            return moved
+        after = rows[-1]['id']
+        for month, group in _by_month(old, 'timestamp'):
+            schema = attach_archives(con, [month], path, create=True)[0]
+            _ensure_archive_schema(con, schema)
+            ids = json.dumps([row['id'] for row in group])
+            _copy_to_archive(con, path, schema, 'messages', 'id', ids)
+            with db_tx(path):
+                n = _delete_archived(con, schema, 'messages', 'id', ids)
+                _count_archived(con, month, messages=n)
+            moved += n
+
+def archive_dialogs(con, path, cutoff, batch):
+    """Переносит диалоги, начатые до cutoff, у которых в горячей БД не осталось сообщений."""
+    moved = 0
+    caches = write_caches()
+    while True:
+        rows = con.execute(
+            "SELECT d.id, d.chat_id, d.start_time FROM dialogs d WHERE d.start_time < ? "
+            "AND NOT EXISTS (SELECT 1 FROM messages m WHERE m.dialog_chat_id = d.chat_id) "
+            "ORDER BY d.start_time LIMIT ?", (cutoff, batch)).fetchall()
+        if not rows:
+            return moved
+        for month, group in _by_month(rows, 'start_time'):
+            schema = attach_archives(con, [month], path, create=True)[0]
+            _ensure_archive_schema(con, schema)
+            ids = json.dumps([row['id'] for row in group])
+            _copy_to_archive(con, path, schema, 'dialog_participants', 'dialog_id', ids)
+            _copy_to_archive(con, path, schema, 'dialogs', 'id', ids)
+            with db_tx(path):
+                _delete_archived(con, schema, 'dialog_participants', 'dialog_id', ids)
+                n = _delete_archived(con, schema, 'dialogs', 'id', ids)
+                con.executemany("INSERT OR REPLACE INTO archive_dialogs (chat_id, dialog_id, month) VALUES (?, ?, ?)",
+                                [(row['chat_id'], row['id'], month) for row in group])
+                _count_archived(con, month, dialogs=n)
+            moved += n
+            for row in group:
+                caches['dialogs'].discard(row['chat_id'])
+        caches['participants'].clear()
+
+def restore_archived_dialog(chat_id, path=None):
+    """Возвращает в горячую БД перенесённый диалог, в который снова пишут; True — вернули.
+
+    Строка dialogs возвращается с тем же id и start_time, вместе с участниками,
+    иначе запись завела бы второй диалог того же чата. Архивная копия удаляется
+    после коммита горячей БД; до того её скрывает чтение (ARCHIVE_KEYS).
+    """
+    try:
+        con = get_db(path)
+        row = con.execute("SELECT dialog_id, month FROM archive_dialogs WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return False
+        dialog_id, month = row['dialog_id'], row['month']
+        schemas = attach_archives(con, [month], path)
+        if not schemas:
+            return False
+        schema = schemas[0]
+        with db_tx(path):
+            for table, key in (('dialogs', 'id'), ('dialog_participants', 'dialog_id')):
+                cols = ', '.join(r['name'] for r in con.execute(f"PRAGMA {schema}.table_info({table})"))
+                n = con.execute(f"INSERT OR IGNORE INTO main.{table} ({cols}) "
+                                f"SELECT {cols} FROM {schema}.{table} WHERE {key} = ?", (dialog_id,)).rowcount
+                if table == 'dialogs' and n:
+                    # trg_dialogs_stats_insert посчитал открытие диалога второй раз
+                    con.execute(f"UPDATE stats_dialogs SET opened = opened - 1 WHERE hour = "
+                                f"(SELECT {_stats_hour('start_time')} FROM main.dialogs WHERE id = ?)", (dialog_id,))
+                    _count_archived(con, month, dialogs=-1)
+            con.execute("DELETE FROM archive_dialogs WHERE chat_id = ?", (chat_id,))
+        with db_tx(path):
+            con.execute(f"DELETE FROM {schema}.dialog_participants WHERE dialog_id = ?", (dialog_id,))
+            con.execute(f"DELETE FROM {schema}.dialogs WHERE id = ?", (dialog_id,))
+        logging.info(f"Dialog {chat_id} restored from archive {month}")
+        return True
+    except Exception as e:
+        # без восстановления запись заведёт новый диалог; архивную копию чтение скроет по chat_id
+        logging.error(f"Error restoring archived dialog {chat_id}: {e}")
+        return False
+
+def incremental_vacuum(path=None, pages=ARCHIVE_VACUUM_PAGES):
+    """Возвращает ОС свободные страницы горячей БД порциями по pages; число освобождённых."""
+    con = get_db(path)
+    if con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        logging.warning("dialogs.db is not in auto_vacuum=INCREMENTAL mode; run `archive --convert-vacuum` once")
+        return 0
+    freed = 0
+    while True:
+        before = con.execute("PRAGMA freelist_count").fetchone()[0]
+        if not before:
+            break
+        # каждая порция — своя короткая транзакция; executescript выполняет PRAGMA до конца
+        con.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        after = con.execute("PRAGMA freelist_count").fetchone()[0]
+        freed += before - after
+        if after >= before:
+            break
+    # в WAL файл укорачивается при checkpoint
+    con.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return freed
+
+def _upgrade_archives(con, path):
+    # архивы прошлых переносов могли быть созданы при старой схеме (без столбцов, индекса поиска)
+    for (month,) in con.execute("SELECT month FROM archive_months ORDER BY month").fetchall():
+        for schema in attach_archives(con, [month], path):
+            _ensure_archive_schema(con, schema)
+
+def archive_old_data(path=None, days=ARCHIVE_AFTER_DAYS, batch=ARCHIVE_BATCH, vacuum=True):
+    """Переносит старые сообщения и диалоги в архивы по месяцам и сжимает горячую БД."""
+    if days <= 0:
+        return {'messages': 0, 'dialogs': 0, 'freed_pages': 0}
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    con = get_db(path)
+    _upgrade_archives(con, path)
+    result = {'cutoff': cutoff,
+              'messages': archive_messages(con, path, cutoff, batch),
+              'dialogs': archive_dialogs(con, path, cutoff, batch)}
+    result['freed_pages'] = incremental_vacuum(path) if vacuum else 0
+    logging.info(f"Archived {result['messages']} messages and {result['dialogs']} dialogs older than {cutoff}, "
+                 f"freed {result['freed_pages']} pages")
+    return result
+
+def start_archive():
+    return start_background('archive', archive_old_data)
+
+def archive_status(path=None):
+    con = get_db(path)
+    months = [dict(row) for row in con.execute(
+        "SELECT month, dialogs, messages, updated_at FROM archive_months ORDER BY month")]
+    for m in months:
+        file = archive_file(m['month'], path)
+        m['bytes'] = os.path.getsize(file) if os.path.exists(file) else None
+    page_size = con.execute("PRAGMA page_size").fetchone()[0]
+    return {
+        'after_days': ARCHIVE_AFTER_DAYS,
+        'months': months,
+        'hot_bytes': con.execute("PRAGMA page_count").fetchone()[0] * page_size,
+        'free_bytes': con.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+        'incremental_vacuum': con.execute("PRAGMA auto_vacuum").fetchone()[0] == 2,
+    }
+
+@app.cli.command('archive')
+@click.option('--days', type=int, default=None, help='старше скольких дней (по умолчанию ARCHIVE_AFTER_DAYS)')
+@click.option('--no-vacuum', is_flag=True, help='не возвращать место после переноса')
+@click.option('--convert-vacuum', is_flag=True,
+              help='один раз перевести dialogs.db в auto_vacuum=INCREMENTAL (полный VACUUM, блокирует запись)')
+@click.option('--db', 'db_file', default=None, help='путь к dialogs.db (по умолчанию — инстанса рядом с main.py)')
+def archive_command(days, no_vacuum, convert_vacuum, db_file):
+    """Переносит старые сообщения и диалоги в archive/<YYYY-MM>.db."""
+    migrate_db(db_file)
+    if convert_vacuum:
+        con = get_db(db_file)
+        con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        con.execute("VACUUM")
+        click.echo(f"auto_vacuum={con.execute('PRAGMA auto_vacuum').fetchone()[0]}")
+    started = perf_counter()
+    result = archive_old_data(db_file, ARCHIVE_AFTER_DAYS if days is None else days, vacuum=not no_vacuum)
+    click.echo(f"{result} in {perf_counter() - started:.1f}s")
+
 # ---------------------- Публичные API ----------------------
+# запросы, которые читают и архивы, — шаблоны для in_schema(): {dialogs},
+# {dialog_participants}, {messages} заменяются таблицей горячей БД или архива
+SQL_DIALOGS_BY_TIME = "SELECT id, chat_id, start_time FROM {dialogs} d WHERE start_time BETWEEN ? AND ? ORDER BY start_time DESC, id DESC"
+# следующая страница после курсора (start_time, id); верхнюю границу BETWEEN
+# вызывающий сужает до времени курсора, чтобы индекс не пролистывал отданные строки
+SQL_DIALOGS_AFTER = (
+    "SELECT id, chat_id, start_time FROM {dialogs} d WHERE start_time BETWEEN ? AND ? "
+    "AND (start_time, id) < (?, ?) ORDER BY start_time DESC, id DESC"
+)
+SQL_DIALOG_BY_CHAT = "SELECT id, chat_id, start_time FROM {dialogs} d WHERE chat_id = ?"
+SQL_DIALOG_PARTICIPANTS = """
+    SELECT u.id, u.user_name, u.role 
+    FROM users u
+    JOIN {dialog_participants} dp ON u.id = dp.user_id
+    WHERE dp.dialog_id = ?
+"""
+SQL_DIALOG_MESSAGES = """
+    SELECT m.id, m.author_id, u.user_name as author_name, m.message_text, m.timestamp 
+    FROM {messages} m
+    LEFT JOIN users u ON m.author_id = u.id
+    WHERE m.dialog_chat_id = ? AND m.timestamp BETWEEN ? AND ?
+    ORDER BY m.timestamp ASC, m.id ASC
+"""
+# следующая страница после курсора (timestamp, id); нижнюю границу BETWEEN
+# вызывающий поднимает до времени курсора
+SQL_DIALOG_MESSAGES_AFTER = """
+    SELECT m.id, m.author_id, u.user_name as author_name, m.message_text, m.timestamp 
+    FROM {messages} m
+    LEFT JOIN users u ON m.author_id = u.id
+    WHERE m.dialog_chat_id = ? AND m.timestamp BETWEEN ? AND ? AND (m.timestamp, m.id) > (?, ?)
+    ORDER BY m.timestamp ASC, m.id ASC
+"""
+# /api/dialogs/batch: список chat_id приходит одним JSON-массивом, позиция в нём
+# (json_each.key) задаёт порядок выдачи
+SQL_BATCH_DIALOGS = "SELECT id, chat_id, start_time FROM {dialogs} d WHERE chat_id IN (SELECT value FROM json_each(?))"
+SQL_BATCH_PARTICIPANTS = """
+    SELECT dp.dialog_id, u.id, u.user_name, u.role
+    FROM {dialog_participants} dp
+    JOIN users u ON u.id = dp.user_id
+    WHERE dp.dialog_id IN (SELECT value FROM json_each(?))
+    ORDER BY dp.dialog_id, dp.user_id
+"""
+# счётчик — по покрывающему индексу, последнее сообщение — первая запись индекса с конца
+SQL_BATCH_SUMMARY = """
+    SELECT c.value AS chat_id,
+        (SELECT COUNT(*) FROM {messages} m WHERE dialog_chat_id = c.value AND timestamp BETWEEN ? AND ?) AS message_count,
+        (SELECT id FROM {messages} m WHERE dialog_chat_id = c.value AND timestamp BETWEEN ? AND ?
+         ORDER BY timestamp DESC, id DESC LIMIT 1) AS last_id
+    FROM json_each(?) c
+"""
+SQL_BATCH_LAST = """
+    SELECT m.dialog_chat_id, m.id, m.author_id, u.user_name as author_name, m.message_text, m.timestamp
+    FROM {messages} m
+    LEFT JOIN users u ON m.author_id = u.id
+    WHERE m.id IN (SELECT value FROM json_each(?))
+"""
+SQL_BATCH_MESSAGES = """
+    SELECT c.key AS pos, m.id, m.author_id, u.user_name as author_name, m.message_text, m.timestamp
+    FROM json_each(?) c
+    JOIN {messages} m ON m.dialog_chat_id = c.value
+    LEFT JOIN users u ON m.author_id = u.id
+    WHERE m.timestamp BETWEEN ? AND ?
+    ORDER BY pos, m.timestamp, m.id
+"""
+
+# Запросы API, которые обязаны идти по индексу (проверяется check_query_plans); шаблоны in_schema()
+INDEXED_API_QUERIES = {
+    'dialogs_by_time': (SQL_DIALOGS_BY_TIME, ('', '')),
+    'dialogs_after': (SQL_DIALOGS_AFTER, ('', '', '', 0)),
+    'dialog_by_chat': (SQL_DIALOG_BY_CHAT, (0,)),
+    'dialog_participants': (SQL_DIALOG_PARTICIPANTS, (0,)),
+    'dialog_messages': (SQL_DIALOG_MESSAGES, (0, '', '')),
+    'dialog_messages_after': (SQL_DIALOG_MESSAGES_AFTER, (0, '', '', '', 0)),
+    'dialogs_of_user': ("SELECT dialog_id FROM dialog_participants WHERE user_id = ?", (0,)),
+    'batch_dialogs': (SQL_BATCH_DIALOGS, ('[]',)),
+    'batch_participants': (SQL_BATCH_PARTICIPANTS, ('[]',)),
+    'batch_summary': (SQL_BATCH_SUMMARY, ('', '', '', '', '[]')),
+    'batch_last': (SQL_BATCH_LAST, ('[]',)),
+    'batch_messages': (SQL_BATCH_MESSAGES, ('[]', '', '')),
+}
+
+def check_query_plans(path=None):
+    """EXPLAIN QUERY PLAN для запросов API: {имя: {'indexed': bool, 'plan': [...]}}."""
+    con = get_db(path)
+    report = {}
+    for name, (sql, params) in INDEXED_API_QUERIES.items():
+        plan = [row['detail'] for row in con.execute("EXPLAIN QUERY PLAN " + in_schema(sql), params)]
+        # полный проход — "SCAN <table>", в том числе по покрывающему индексу;
+        # допустим только SCAN табличной функции json_each (список id из запроса)
+        full_scan = any(d.startswith('SCAN') and 'VIRTUAL TABLE' not in d for d in plan)
+        report[name] = {'indexed': not full_scan, 'plan': plan}
+    return report
+
 def get_time_range_utc(args):
     date_str = args.get('date')
     if date_str:
@@ -408,20 +3457,176 @@ def get_time_range_utc(args):
     end_utc   = local_end_dt   - tz_delta
     return start_utc.isoformat(), end_utc.isoformat()
 
+# ---------------------- Пагинация и потоковая выдача ----------------------
+# Курсор — непрозрачная строка с ключом (время, id) последней отданной строки.
+def encode_cursor(key):
+    raw = json.dumps(list(key), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        ts, row_id = json.loads(raw)
+        return str(ts), int(row_id)
+    except Exception:
+        raise ValueError('bad cursor')
+
+def paging_args(args):
+    """(limit, after, stream) из query-параметров; ValueError, если они некорректны."""
+    limit = args.get('limit')
+    if limit not in (None, ''):
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError('bad limit')
+        if not 1 <= limit <= API_PAGE_MAX:
+            raise ValueError(f'limit must be between 1 and {API_PAGE_MAX}')
+    else:
+        limit = None
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+    stream = args.get('stream') or None
+    if stream not in (None, 'json', 'ndjson'):
+        raise ValueError('stream must be json or ndjson')
+    return limit, after, stream
+
+def keyset_query(sql_first, sql_after, params, after, limit, schemas=()):
+    """Выполняет запрос первой или следующей страницы; берёт limit+1, чтобы знать, есть ли ещё.
+
+    schemas — подключённые архивы, строки которых добавляются к горячей БД.
+    """
+    if after is not None:
+        sql, params = archive_union(sql_after, tuple(params) + tuple(after), schemas)
+    else:
+        sql, params = archive_union(sql_first, params, schemas)
+    if limit is not None:
+        sql, params = sql + " LIMIT ?", params + (limit + 1,)
+    return get_db().execute(sql, params)
+
+def paged_rows(cur, limit, key, state):
+    """Строки курсора пачками по STREAM_FETCH_SIZE; state['next_cursor'] — если есть следующая страница."""
+    sent = 0
+    last = None
+    while True:
+        rows = cur.fetchmany(STREAM_FETCH_SIZE)
+        if not rows:
+            return
+        for row in rows:
+            if limit is not None and sent >= limit:
+                state['next_cursor'] = encode_cursor(key(last))
+                cur.close()
+                return
+            last = row
+            sent += 1
+            yield dict(row)
+
+def _chunked(parts, size=STREAM_CHUNK_BYTES):
+    """Склеивает мелкие куски в блоки ~size байт, чтобы не писать в сокет по строке."""
+    buf, n = [], 0
+    for part in parts:
+        buf.append(part)
+        n += len(part)
+        if n >= size:
+            yield ''.join(buf)
+            buf, n = [], 0
+    if buf:
+        yield ''.join(buf)
+
+def json_array_stream(head, rows, tail, ensure_ascii=True):
+    """head + JSON-массив rows + tail(); tail вызывается после выдачи всех строк."""
+    def parts():
+        yield head + '['
+        first = True
+        for row in rows:
+            yield ('' if first else ', ') + json.dumps(row, ensure_ascii=ensure_ascii)
+            first = False
+        yield ']' + tail()
+    return _chunked(parts())
+
+def ndjson_stream(head_rows, rows, tail):
+    def parts():
+        for row in head_rows:
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+        for row in tail():
+            yield json.dumps(row, ensure_ascii=False) + '\n'
+    return _chunked(parts())
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# ---------------------- Условные запросы и кэш ответов ----------------------
+# Любая запись в VERSIONED_TABLES увеличивает change_version (триггеры), поэтому
+# ETag ответа — версия данных плюс хэш запроса. Опрос без изменений стоит
+# одного чтения строки change_version: 304 по If-None-Match или тело из кэша
+# 'responses' без запросов к таблицам. Версия читается до данных, поэтому тело
+# может быть только новее своей версии, но не старее.
+def change_version():
+    row = get_db().execute("SELECT version, epoch FROM change_version WHERE id = 1").fetchone()
+    return f"{row['epoch']}-{row['version']}"
+
+def conditional_get(f):
+    """ETag/If-None-Match и кэш тел для GET-эндпойнта, чей ответ зависит только от VERSIONED_TABLES."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if request.method != 'GET':
+            return f(*args, **kwargs)
+        try:
+            version = change_version()
+        except Exception as e:
+            logging.error(f"change_version failed, answering without ETag: {e}")
+            return f(*args, **kwargs)
+        # без date период считается от сегодняшней даты UTC — она тоже часть ключа
+        key = (request.path, tuple(sorted(request.args.items(multi=True))), datetime.utcnow().date().isoformat())
+        etag = f"{version}-{zlib.crc32(repr(key).encode('utf-8')):08x}"
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers=headers)
+        cache = write_caches()['responses']
+        hit = cache.get(key)
+        if hit is not None and hit[0] == etag:
+            return Response(hit[1], status=200, content_type=hit[2], headers=headers)
+        resp = app.make_response(f(*args, **kwargs))
+        if resp.status_code != 200:
+            return resp
+        resp.headers.update(headers)
+        if not resp.is_streamed:
+            # потоковые ответы не буферизуем: их смысл — не держать тело в памяти
+            body = resp.get_data()
+            cache.set(key, (etag, body, resp.content_type), nbytes=len(body))
+        return resp
+    return decorated
+
 @app.route('/api/dialogs', methods=['GET'])
 @token_required
+@conditional_get
 def get_dialogs():
     try:
         start_utc_str, end_utc_str = get_time_range_utc(request.args)
-        con = sqlite3.connect(DB_FILE)
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
-        cur.execute(
-            "SELECT id, chat_id, start_time FROM dialogs WHERE start_time BETWEEN ? AND ? ORDER BY start_time DESC",
-            (start_utc_str, end_utc_str)
-        )
-        dialogs = [dict(row) for row in cur.fetchall()]
-        con.close()
+        limit, after, stream = paging_args(request.args)
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400, {'Content-Type': 'application/json'}
+    try:
+        if after is not None:
+            end_utc_str = min(end_utc_str, after[0])
+        schemas = archive_schemas(get_db(), start_utc_str, end_utc_str)
+        cur = keyset_query(SQL_DIALOGS_BY_TIME, SQL_DIALOGS_AFTER, (start_utc_str, end_utc_str), after, limit, schemas)
+        paged = limit is not None or after is not None
+        state = {}
+        rows = paged_rows(cur, limit, lambda r: (r['start_time'], r['id']), state)
+        if stream == 'ndjson':
+            tail = lambda: [{'next_cursor': state['next_cursor']}] if 'next_cursor' in state else []
+            return Response(ndjson_stream([], rows, tail), mimetype=NDJSON_MIMETYPE)
+        if stream == 'json':
+            if paged:
+                body = json_array_stream('{"dialogs": ', rows,
+                                         lambda: ', "next_cursor": %s}' % json.dumps(state.get('next_cursor')))
+            else:
+                body = json_array_stream('', rows, lambda: '')
+            return Response(body, mimetype='application/json')
+        dialogs = list(rows)
+        if paged:
+            dialogs = {'dialogs': dialogs, 'next_cursor': state.get('next_cursor')}
         return json.dumps(dialogs), 200, {'Content-Type': 'application/json'}
     except Exception as e:
         logging.error(f"API Error in get_dialogs: {e}")
@@ -429,66 +3634,770 @@ def get_dialogs():
 
 @app.route('/api/dialogs/<int:chat_id>', methods=['GET'])
 @token_required
+@conditional_get
 def get_dialog_details(chat_id):
     try:
         start_utc_str, end_utc_str = get_time_range_utc(request.args)
-        con = sqlite3.connect(DB_FILE)
-        con.row_factory = sqlite3.Row
+        limit, after, stream = paging_args(request.args)
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400, {'Content-Type': 'application/json'}
+    try:
+        con = get_db()
         cur = con.cursor()
 
-        cur.execute("SELECT id, chat_id, start_time FROM dialogs WHERE chat_id = ?", (chat_id,))
+        cur.execute(in_schema(SQL_DIALOG_BY_CHAT), (chat_id,))
         dialog_info = cur.fetchone()
+        sql_participants = in_schema(SQL_DIALOG_PARTICIPANTS)
+        if not dialog_info:
+            # диалог мог уехать в архив — каталог знает, в какой месяц
+            archived = con.execute("SELECT month FROM archive_dialogs WHERE chat_id = ?", (chat_id,)).fetchone()
+            for schema in attach_archives(con, [archived['month']]) if archived else []:
+                dialog_info = con.execute(in_schema(SQL_DIALOG_BY_CHAT, schema), (chat_id,)).fetchone()
+                sql_participants = in_schema(SQL_DIALOG_PARTICIPANTS, schema)
         if not dialog_info:
             return json.dumps({'error': 'Dialog not found'}), 404, {'Content-Type': 'application/json'}
 
         dialog_db_id = dialog_info['id']
         result = dict(dialog_info)
 
-        cur.execute("""
-            SELECT u.id, u.user_name, u.role 
-            FROM users u
-            JOIN dialog_participants dp ON u.id = dp.user_id
-            WHERE dp.dialog_id = ?
-        """, (dialog_db_id,))
+        cur.execute(sql_participants, (dialog_db_id,))
         result['participants'] = [dict(row) for row in cur.fetchall()]
 
-        cur.execute("""
-            SELECT m.id, m.author_id, u.user_name as author_name, m.message_text, m.timestamp 
-            FROM messages m
-            LEFT JOIN users u ON m.author_id = u.id
-            WHERE m.dialog_chat_id = ? AND m.timestamp BETWEEN ? AND ?
-            ORDER BY m.timestamp ASC
-        """, (chat_id, start_utc_str, end_utc_str))
-        result['messages'] = [dict(row) for row in cur.fetchall()]
+        if after is not None:
+            start_utc_str = max(start_utc_str, after[0])
+        schemas = archive_schemas(con, start_utc_str, end_utc_str)
+        msg_cur = keyset_query(SQL_DIALOG_MESSAGES, SQL_DIALOG_MESSAGES_AFTER,
+                               (chat_id, start_utc_str, end_utc_str), after, limit, schemas)
+        state = {}
+        messages = paged_rows(msg_cur, limit, lambda r: (r['timestamp'], r['id']), state)
+
+        if stream == 'ndjson':
+            # первая строка — сам диалог с участниками, дальше по строке на сообщение
+            tail = lambda: [{'next_cursor': state['next_cursor']}] if 'next_cursor' in state else []
+            return Response(ndjson_stream([result], messages, tail), mimetype=NDJSON_MIMETYPE)
+        if stream == 'json':
+            head = json.dumps(result, ensure_ascii=False)[:-1] + ', "messages": '
+            if limit is not None or after is not None:
+                tail = lambda: ', "next_cursor": %s}' % json.dumps(state.get('next_cursor'))
+            else:
+                tail = lambda: '}'
+            return Response(json_array_stream(head, messages, tail, ensure_ascii=False),
+                            mimetype='application/json; charset=utf-8')
 
-        con.close()
+        result['messages'] = list(messages)
+        if limit is not None or after is not None:
+            result['next_cursor'] = state.get('next_cursor')
         return json.dumps(result, ensure_ascii=False), 200, {'Content-Type': 'application/json; charset=utf-8'}
     except Exception as e:
         logging.error(f"API Error in get_dialog_details for chat {chat_id}: {e}")
         return json.dumps({'error': str(e)}), 500, {'Content-Type': 'application/json'}
 
+# ---------------------- Пакетная выдача диалогов ----------------------
+# /api/dialogs/batch — то же, что /api/dialogs/<chat_id> по каждому чату пачки,
+# плюс число и последнее сообщение за период. Вместо трёх запросов на чат —
+# по одному набору на всю пачку (и на каждый подключённый архив).
+def batch_chat_ids():
+    """chat_id из ?chat_ids=1,2,3 или тела {"chat_ids": [...]}; None — выбрать по фильтру /api/dialogs."""
+    raw = request.args.get('chat_ids')
+    if raw is None and request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            raise ValueError('body must be {"chat_ids": [...]}')
+        raw = body.get('chat_ids')
+    if raw is None:
+        return None
+    if isinstance(raw, str):
+        raw = [part for part in raw.split(',') if part.strip()]
+    try:
+        chat_ids = list(dict.fromkeys(int(x) for x in raw))
+    except (TypeError, ValueError):
+        raise ValueError('chat_ids must be integers')
+    if not 1 <= len(chat_ids) <= API_BATCH_MAX:
+        raise ValueError(f'chat_ids must list 1 to {API_BATCH_MAX} chats')
+    return chat_ids
+
+def _batch_dialogs_in(con, schema, chat_ids, found):
+    """Диалоги и участники из горячей БД (schema=None) или архива; кладёт в found по chat_id."""
+    sql_dialogs, sql_participants = in_schema(SQL_BATCH_DIALOGS, schema), in_schema(SQL_BATCH_PARTICIPANTS, schema)
+    dialogs = {row['id']: dict(row, participants=[]) for row in con.execute(sql_dialogs, (json.dumps(chat_ids),))}
+    if dialogs:
+        for row in con.execute(sql_participants, (json.dumps(list(dialogs)),)):
+            dialogs[row['dialog_id']]['participants'].append(
+                {'id': row['id'], 'user_name': row['user_name'], 'role': row['role']})
+    for dialog in dialogs.values():
+        found[dialog['chat_id']] = dialog
+
+def batch_dialogs(con, chat_ids):
+    """{chat_id: диалог с участниками}; перенесённые в архив ищутся по каталогу archive_dialogs."""
+    found = {}
+    _batch_dialogs_in(con, None, chat_ids, found)
+    missing = [chat_id for chat_id in chat_ids if chat_id not in found]
+    if missing:
+        by_month = {}
+        for row in con.execute("SELECT chat_id, month FROM archive_dialogs WHERE chat_id IN (SELECT value FROM json_each(?))",
+                               (json.dumps(missing),)):
+            by_month.setdefault(row['month'], []).append(row['chat_id'])
+        # по месяцу за раз: подключений не больше ARCHIVE_ATTACH_MAX
+        for month, chats in sorted(by_month.items()):
+            for schema in attach_archives(con, [month]):
+                _batch_dialogs_in(con, schema, chats, found)
+    return found
+
+def batch_summary(con, chat_ids, ts_from, ts_to, schemas):
+    """{chat_id: (число сообщений, последнее сообщение)} за [ts_from, ts_to] по горячей БД и архивам."""
+    ids = json.dumps(chat_ids)
+    counts = dict.fromkeys(chat_ids, 0)
+    last = {}
+    for schema in [None] + list(schemas):
+        sql_summary, sql_last = in_schema(SQL_BATCH_SUMMARY, schema), in_schema(SQL_BATCH_LAST, schema)
+        last_ids = []
+        for row in con.execute(sql_summary, (ts_from, ts_to, ts_from, ts_to, ids)):
+            counts[row['chat_id']] += row['message_count']
+            if row['last_id'] is not None:
+                last_ids.append(row['last_id'])
+        if last_ids:
+            for row in con.execute(sql_last, (json.dumps(last_ids),)):
+                message = dict(row)
+                chat_id = message.pop('dialog_chat_id')
+                prev = last.get(chat_id)
+                if prev is None or (message['timestamp'], message['id']) > (prev['timestamp'], prev['id']):
+                    last[chat_id] = message
+    return {chat_id: (counts[chat_id], last.get(chat_id)) for chat_id in chat_ids}
+
+def _fetched(cur):
+    while True:
+        rows = cur.fetchmany(STREAM_FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+def batch_items(dialogs, msg_cur):
+    """Диалоги по порядку; с msg_cur — каждый со своими сообщениями (курсор упорядочен по pos)."""
+    rows = _fetched(msg_cur) if msg_cur is not None else iter(())
+    row = next(rows, None)
+    for pos, dialog in enumerate(dialogs):
+        if msg_cur is not None:
+            dialog['messages'] = []
+            while row is not None and row['pos'] == pos:
+                message = dict(row)
+                del message['pos']
+                dialog['messages'].append(message)
+                row = next(rows, None)
+        yield dialog
+
+@app.route('/api/dialogs/batch', methods=['GET', 'POST'])
+@token_required
+@conditional_get
+def get_dialogs_batch():
+    try:
+        start_utc_str, end_utc_str = get_time_range_utc(request.args)
+        chat_ids = batch_chat_ids()
+        limit, after, stream = paging_args(request.args)
+        if chat_ids is not None and (limit is not None or after is not None):
+            raise ValueError('limit and cursor apply only without chat_ids')
+        if limit is not None and limit > API_BATCH_MAX:
+            raise ValueError(f'limit must be between 1 and {API_BATCH_MAX}')
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400, {'Content-Type': 'application/json'}
+    with_messages = request.args.get('messages') in ('1', 'true', 'yes')
+    try:
+        con = get_db()
+        state = {}
+        by_filter = chat_ids is None
+        if by_filter:
+            # та же выборка, что /api/dialogs за период, страницами по API_BATCH_MAX
+            end_dialogs = min(end_utc_str, after[0]) if after is not None else end_utc_str
+            cur = keyset_query(SQL_DIALOGS_BY_TIME, SQL_DIALOGS_AFTER, (start_utc_str, end_dialogs), after,
+                               limit or API_BATCH_MAX, archive_schemas(con, start_utc_str, end_dialogs))
+            chat_ids = [row['chat_id'] for row in paged_rows(cur, limit or API_BATCH_MAX,
+                                                             lambda r: (r['start_time'], r['id']), state)]
+        found = batch_dialogs(con, chat_ids) if chat_ids else {}
+        dialogs = [found[chat_id] for chat_id in chat_ids if chat_id in found]
+        not_found = [chat_id for chat_id in chat_ids if chat_id not in found]
+
+        schemas = archive_schemas(con, start_utc_str, end_utc_str)
+        summary = batch_summary(con, [d['chat_id'] for d in dialogs], start_utc_str, end_utc_str, schemas)
+        for dialog in dialogs:
+            dialog['message_count'], dialog['last_message'] = summary[dialog['chat_id']]
+        msg_cur = None
+        if with_messages and dialogs:
+            sql, params = archive_union(SQL_BATCH_MESSAGES,
+                                        (json.dumps([d['chat_id'] for d in dialogs]), start_utc_str, end_utc_str),
+                                        schemas)
+            msg_cur = con.execute(sql, params)
+        items = batch_items(dialogs, msg_cur)
+
+        tail = {'not_found': not_found}
+        if by_filter:
+            tail['next_cursor'] = state.get('next_cursor')
+        if stream == 'ndjson':
+            return Response(ndjson_stream([], items, lambda: [tail]), mimetype=NDJSON_MIMETYPE)
+        return Response(json_array_stream('{"dialogs": ', items, lambda: ', ' + json.dumps(tail, ensure_ascii=False)[1:],
+                                          ensure_ascii=False),
+                        mimetype='application/json; charset=utf-8')
+    except Exception as e:
+        logging.error(f"API Error in get_dialogs_batch: {e}")
+        return json.dumps({'error': str(e)}), 500, {'Content-Type': 'application/json'}
+
 @app.route('/api/users', methods=['GET'])
 @token_required
+@conditional_get
 def get_users():
     try:
-        con = sqlite3.connect(DB_FILE)
-        con.row_factory = sqlite3.Row
-        cur = con.cursor()
-        cur.execute("SELECT id, user_name, role FROM users")
+        cur = get_db().execute("SELECT id, user_name, role FROM users")
         users = [dict(row) for row in cur.fetchall()]
-        con.close()
         return json.dumps(users), 200, {'Content-Type': 'application/json'}
     except Exception as e:
         logging.error(f"API Error in get_users: {e}")
         return json.dumps({'error': str(e)}), 500, {'Content-Type': 'application/json'}
 
+# ---------------------- Выгрузка для синхронизации ----------------------
+# Каждая строка несёт seq — возрастающий номер (id сообщения/диалога,
+# dialog_participants.seq, users.seq); потребитель передаёт последний полученный
+# seq как since и получает только новое. Пользователь с изменённым именем/ролью
+# получает новый seq.
+EXPORT_ENTITIES = {
+    # сущность: (столбец seq, таблица, столбцы, JOIN)
+    'messages': ('m.id', 'messages m', "m.id AS seq, m.id, m.dialog_chat_id AS chat_id, m.author_id, "
+                                       "m.message_text, m.timestamp", ''),
+    'dialogs': ('d.id', 'dialogs d', "d.id AS seq, d.id, d.chat_id, d.start_time", ''),
+    'participants': ('dp.seq', 'dialog_participants dp', "dp.seq, dp.dialog_id, d.chat_id, dp.user_id",
+                     'LEFT JOIN dialogs d ON d.id = dp.dialog_id'),
+    'users': ('u.seq', 'users u', "u.seq, u.id, u.user_name, u.role", ''),
+}
+EXPORT_FORMATS = {'ndjson': NDJSON_MIMETYPE, 'csv': 'text/csv'}
+
+def export_sql(entity):
+    seq, table, columns, join = EXPORT_ENTITIES[entity]
+    return f"SELECT {columns} FROM {table} {join} WHERE {seq} > ? AND {seq} <= ? ORDER BY {seq} LIMIT ?"
+
+INDEXED_API_QUERIES.update({f'export_{entity}': (export_sql(entity), (0, 0, 1)) for entity in EXPORT_ENTITIES})
+
+def export_bounds(con, entity, since, limit):
+    """Верхняя граница seq выгрузки: фиксируется до чтения, строки новее уйдут в следующую."""
+    seq, table, _, _ = EXPORT_ENTITIES[entity]
+    row = None
+    if limit is not None:
+        row = con.execute(f"SELECT {seq} FROM {table} WHERE {seq} > ? ORDER BY {seq} LIMIT 1 OFFSET ?",
+                          (since, limit - 1)).fetchone()
+    if row is None:
+        row = con.execute(f"SELECT MAX({seq}) FROM {table} WHERE {seq} > ?", (since,)).fetchone()
+    return row[0] if row[0] is not None else since
+
+def export_rows(con, entity, since, until, chunk=EXPORT_CHUNK_ROWS):
+    """Строки since < seq <= until пачками по chunk отдельными запросами.
+
+    Между пачками курсор SQLite закрыт: выгрузка миллионов строк не держит
+    снимок WAL (и не мешает checkpoint) и не копит строки в памяти.
+    """
+    query = export_sql(entity)
+    last = since
+    while last < until:
+        rows = con.execute(query, (last, until, chunk)).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last = rows[-1]['seq']
+
+def csv_stream(rows):
+    def parts():
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        header = False
+        for row in rows:
+            if not header:
+                writer.writerow(row.keys())
+                header = True
+            writer.writerow(tuple(row))
+            if buf.tell() >= STREAM_CHUNK_BYTES:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+    return parts()
+
+def gzip_stream(parts, level=EXPORT_GZIP_LEVEL):
+    """Сжимает поток строк в gzip на лету, блоками по мере заполнения zlib."""
+    z = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for part in parts:
+        data = z.compress(part.encode('utf-8'))
+        if data:
+            yield data
+    yield z.flush()
+
+@app.route('/api/export', methods=['GET'])
+@token_required
+def export_data():
+    entity = request.args.get('entity', 'messages')
+    fmt = request.args.get('format', 'ndjson')
+    try:
+        if entity not in EXPORT_ENTITIES:
+            raise ValueError(f"entity must be one of {', '.join(EXPORT_ENTITIES)}")
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError('format must be ndjson or csv')
+        try:
+            since = int(request.args.get('since') or 0)
+            limit = int(request.args['limit']) if request.args.get('limit') else None
+        except ValueError:
+            raise ValueError('since and limit must be integers')
+        if limit is not None and limit < 1:
+            raise ValueError('limit must be positive')
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400, {'Content-Type': 'application/json'}
+    try:
+        con = get_db()
+        until = export_bounds(con, entity, since, limit)
+        rows = export_rows(con, entity, since, until)
+        if fmt == 'csv':
+            body = csv_stream(rows)
+        else:
+            body = _chunked(json.dumps(dict(row), ensure_ascii=False) + '\n' for row in rows)
+        headers = {'X-Export-Since': str(since), 'X-Export-Next-Since': str(until), 'Vary': 'Accept-Encoding'}
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            body = gzip_stream(body)
+        return Response(body, mimetype=EXPORT_FORMATS[fmt], headers=headers)
+    except Exception as e:
+        logging.error(f"API Error in export_data: {e}")
+        return json.dumps({'error': str(e)}), 500, {'Content-Type': 'application/json'}
+
+# ---------------------- Дозаливка истории ----------------------
+# Производные от messages таблицы (поисковый индекс, статистика) для новых
+# сообщений ведут триггеры, а сообщения, записанные до миграции, дозаливает
+# run_backfill() пачками по id — отдельными транзакциями, чтобы не держать
+# запись вебхуков на время обработки всей истории. Состояние — строка
+# (upto, done) в своей таблице: сообщения с done < id <= upto ещё ждут.
+_background = set()
+_background_lock = threading.Lock()
+
+def backfill_status(table, path=None):
+    row = get_db(path).execute(f"SELECT upto, done FROM {table}").fetchone()
+    return {'backfill_upto': row['upto'], 'backfill_done': min(row['done'], row['upto']),
+            'complete': row['done'] >= row['upto']}
+
+def run_backfill(table, apply, path=None, batch=SEARCH_BACKFILL_BATCH):
+    """Вызывает apply(con, lo, hi) для сообщений lo < id <= hi, пока done не дойдёт до upto.
+
+    Возвращает сумму того, что вернули вызовы apply.
+    """
+    total = 0
+    while True:
+        with db_tx(path) as con:
+            upto, done = con.execute(f"SELECT upto, done FROM {table}").fetchone()
+            if done >= upto:
+                break
+            end = min(done + batch, upto)
+            total += apply(con, done, end)
+            con.execute(f"UPDATE {table} SET done = ?", (end,))
+    return total
+
+def start_background(name, target, **kwargs):
+    """target(**kwargs) для текущего инстанса в фоновом потоке; False — уже идёт в этом процессе."""
+    t = tenant()
+    key = (name, t.db_file)
+    with _background_lock:
+        if key in _background:
+            return False
+        _background.add(key)
+
+    def run():
+        try:
+            with use_tenant(t):
+                target(**kwargs)
+        except Exception as e:
+            logging.error(f"Background {name} failed: {e}")
+        finally:
+            with _background_lock:
+                _background.discard(key)
+    threading.Thread(target=run, name=name, daemon=True).start()
+    return True
+
+# ---------------------- Полнотекстовый поиск ----------------------
+# messages_fts (FTS5) ведут триггеры на messages; сообщения, записанные до
+# миграции 5, дозаливает search_backfill().
+def search_status(path=None):
+    return backfill_status('search_backfill', path)
+
+def _search_backfill_batch(con, lo, hi):
+    return con.execute(
+        f"INSERT INTO messages_fts (rowid, message_text) "
+        f"SELECT id, {_fts_text('message_text')} FROM messages WHERE id > ? AND id <= ?", (lo, hi)
+    ).rowcount
+
+def search_backfill(path=None, rebuild=False, batch=SEARCH_BACKFILL_BATCH):
+    """Индексирует сообщения, ещё не попавшие в messages_fts; rebuild — весь индекс заново.
+
+    Возвращает число проиндексированных сообщений.
+    """
+    if rebuild:
+        with db_tx(path) as con:
+            con.execute("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')")
+            con.execute("UPDATE search_backfill SET upto = (SELECT IFNULL(MAX(id), 0) FROM messages), done = 0")
+        logging.info("Search index cleared for rebuild")
+    total = run_backfill('search_backfill', _search_backfill_batch, path, batch)
+    if total:
+        logging.info(f"Search index backfilled: {total} messages")
+    return total
+
+def start_search_backfill(rebuild=False):
+    return start_background('search-backfill', search_backfill, rebuild=rebuild)
+
+_SEARCH_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+def search_match_query(q, syntax=False):
+    """Строка запроса -> выражение FTS5.
+
+    По умолчанию каждое слово — префикс ("заказ"* найдёт «заказа», «заказу»),
+    слова объединяются по И; так запрос не зависит от окончаний и не может
+    оказаться синтаксической ошибкой FTS5. syntax=True — q уже на языке FTS5.
+    """
+    q = q.replace('ё', 'е').replace('Ё', 'Е')
+    if syntax:
+        return q
+    return ' '.join(f'"{word}"*' for word in _SEARCH_WORD_RE.findall(q))
+
+SQL_SEARCH = """
+    SELECT m.id, m.dialog_chat_id AS chat_id, m.author_id, u.user_name AS author_name, u.role,
+           m.timestamp, m.message_text,
+           highlight(messages_fts, 0, :open, :close) AS highlight,
+           snippet(messages_fts, 0, :open, :close, '…', 16) AS snippet,
+           bm25(messages_fts) AS score
+    FROM {schema}messages_fts
+    JOIN {schema}messages m ON m.id = messages_fts.rowid
+    LEFT JOIN users u ON u.id = m.author_id
+    WHERE messages_fts MATCH :match {filters}
+    ORDER BY {order}
+    LIMIT :limit OFFSET :offset
+"""
+SEARCH_FILTERS = {
+    'chat_id': 'm.dialog_chat_id = :chat_id',
+    'author_id': 'm.author_id = :author_id',
+    'role': 'u.role = :role',
+}
+SEARCH_ORDERS = {'rank': 'messages_fts.rank', 'recent': 'messages_fts.rowid DESC'}
+
+# порядок при слиянии результатов горячей БД и архивов; bm25 у каждого индекса
+# своя (по его статистике слов), поэтому ранги из разных файлов сравнимы лишь примерно
+SEARCH_MERGE_KEYS = {'rank': lambda row: row['score'], 'recent': lambda row: -row['id']}
+
+def search_time_range(args):
+    """(from, to) UTC по date или date_from/date_to (включительно, с tz_offset); None — без ограничения."""
+    date_from = args.get('date_from') or args.get('date')
+    date_to = args.get('date_to') or args.get('date')
+    if not (date_from or date_to):
+        return None
+    tz_delta = timedelta(hours=int(args.get('tz_offset', 0)))
+    ts_from = (datetime.strptime(date_from, '%Y-%m-%d') - tz_delta).isoformat() if date_from else ''
+    ts_to = (datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1) - tz_delta).isoformat() if date_to else '9999'
+    return ts_from, ts_to
+
+def search_archive_months(con, time_range):
+    """Месяцы архива для поиска (с последнего): задетые интервалом или все."""
+    ts_from, ts_to = time_range or ('', '9999')
+    return [row[0] for row in con.execute(
+        "SELECT month FROM archive_months WHERE month BETWEEN ? AND ? ORDER BY month DESC", (ts_from[:7], ts_to[:7]))]
+
+def _search_source(con, schema, params, filters, order):
+    """Совпадения в горячей БД (schema=None) или архиве: (строки, окно ранжирования или None)."""
+    prefix = f'{schema}.' if schema else ''
+    if schema and not con.execute(f"SELECT 1 FROM {schema}.sqlite_master WHERE name = 'messages_fts'").fetchone():
+        logging.warning(f"Archive {schema} has no search index yet; it is built by the next archive run")
+        return [], None
+    params, filters, window = dict(params), list(filters), None
+    if 'chat_id' in params:
+        # FTS5 умеет искать в диапазоне rowid: берём только id сообщений этого чата
+        params['id_lo'], params['id_hi'] = con.execute(
+            f"SELECT MIN(id), MAX(id) FROM {prefix}messages WHERE dialog_chat_id = ?", (params['chat_id'],)).fetchone()
+        if params['id_lo'] is None:
+            return [], None
+        filters.append('messages_fts.rowid BETWEEN :id_lo AND :id_hi')
+    narrowed = any(k in params for k in ('author_id', 'role', 'ts_from'))
+    if order == 'rank' and SEARCH_RANK_WINDOW and not narrowed:
+        # bm25 считается по каждому совпадению: частое слово в миллионах сообщений —
+        # сотни мс. Ранжируем среди SEARCH_RANK_WINDOW последних совпадений; с фильтрами
+        # по автору/роли/дате окно могло бы отсечь все подходящие строки — там без окна
+        bounds = ' AND rowid BETWEEN :id_lo AND :id_hi' if 'chat_id' in params else ''
+        row = con.execute(f"SELECT rowid FROM {prefix}messages_fts WHERE messages_fts MATCH :match{bounds} "
+                          f"ORDER BY rowid DESC LIMIT 1 OFFSET {SEARCH_RANK_WINDOW - 1}", params).fetchone()
+        if row is not None:
+            window = SEARCH_RANK_WINDOW
+            params['floor'] = row[0]
+            filters.append('messages_fts.rowid >= :floor')
+    sql = SQL_SEARCH.format(schema=prefix, filters=''.join(' AND ' + f for f in filters), order=SEARCH_ORDERS[order])
+    return [dict(row) for row in con.execute(sql, params).fetchall()], window
+
+@app.route('/api/search', methods=['GET'])
+@token_required
+def search_messages():
+    q = (request.args.get('q') or '').strip()
+    params = {'open': request.args.get('hl_open', '<mark>'), 'close': request.args.get('hl_close', '</mark>')}
+    filters = []
+    try:
+        params['match'] = search_match_query(q, request.args.get('syntax') == 'fts5')
+        if not params['match']:
+            raise ValueError('q is required')
+        for name, clause in SEARCH_FILTERS.items():
+            value = request.args.get(name)
+            if value:
+                params[name] = value if name == 'role' else int(value)
+                filters.append(clause)
+        time_range = search_time_range(request.args)
+        if time_range:
+            params['ts_from'], params['ts_to'] = time_range
+            filters.append('m.timestamp >= :ts_from AND m.timestamp < :ts_to')
+        order = request.args.get('order', 'rank')
+        if order not in SEARCH_ORDERS:
+            raise ValueError('order must be rank or recent')
+        limit = int(request.args.get('limit') or 20)
+        offset = int(request.args.get('offset') or 0)
+        if not 1 <= limit <= SEARCH_LIMIT_MAX or offset < 0:
+            raise ValueError(f'limit must be between 1 and {SEARCH_LIMIT_MAX}, offset >= 0')
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400, {'Content-Type': 'application/json'}
+    try:
+        con = get_db()
+        months = search_archive_months(con, time_range)
+        if months:
+            # у каждого архива свой индекс: берём из каждого первые offset+limit+1
+            # и сливаем; дубль строки, не удалённой из горячей БД после сбоя, отбрасываем
+            params['limit'], params['offset'] = offset + limit + 1, 0
+        else:
+            params['limit'], params['offset'] = limit + 1, offset
+        rows, window = _search_source(con, None, params, filters, order)
+        for month in months:
+            for schema in attach_archives(con, [month]):
+                found, archive_window = _search_source(con, schema, params, filters, order)
+                rows += found
+                window = window or archive_window
+        if months:
+            merged = {}
+            for row in sorted(rows, key=SEARCH_MERGE_KEYS[order]):
+                merged.setdefault(row['id'], row)
+            rows = list(merged.values())[offset:offset + limit + 1]
+        result = {
+            'query': params['match'],
+            'results': rows[:limit],
+            'next_offset': offset + limit if len(rows) > limit else None,
+            'rank_window': window,
+            'index_complete': search_status()['complete'],
+        }
+        return json.dumps(result, ensure_ascii=False), 200, {'Content-Type': 'application/json; charset=utf-8'}
+    except sqlite3.OperationalError as e:
+        # синтаксис FTS5 при syntax=fts5
+        return json.dumps({'error': str(e)}), 400, {'Content-Type': 'application/json'}
+    except Exception as e:
+        logging.error(f"API Error in search_messages: {e}")
+        return json.dumps({'error': str(e)}), 500, {'Content-Type': 'application/json'}
+
+@app.cli.command('search-backfill')
+@click.option('--rebuild', is_flag=True, help='стереть индекс и построить заново')
+@click.option('--db', 'db_file', default=None, help='путь к dialogs.db (по умолчанию — инстанса рядом с main.py)')
+def search_backfill_command(rebuild, db_file):
+    """Индексирует для /api/search сообщения, записанные до появления индекса."""
+    migrate_db(db_file)
+    started = perf_counter()
+    n = search_backfill(db_file, rebuild=rebuild)
+    click.echo(f"indexed {n} messages in {perf_counter() - started:.1f}s: {search_status(db_file)}")
+
+# ---------------------- Статистика ----------------------
+# Отчёты читают готовые часовые строки stats_* (см. _migration_stats), а не
+# messages: новые сообщения и диалоги учитывают триггеры в той же транзакции,
+# что и запись, историю до миграции 6 — stats_backfill().
+def stats_status(path=None):
+    return backfill_status('stats_backfill', path)
+
+def _stats_backfill_batch(con, lo, hi):
+    con.execute(f"""
+        INSERT INTO stats_messages (hour, role, author_id, messages)
+        SELECT {_stats_hour('m.timestamp')}, IFNULL(u.role, ''),
+               CASE u.role WHEN 'manager' THEN m.author_id ELSE 0 END, COUNT(*)
+        FROM messages m LEFT JOIN users u ON u.id = m.author_id
+        WHERE m.id > ? AND m.id <= ?
+        GROUP BY 1, 2, 3
+        ON CONFLICT (hour, role, author_id) DO UPDATE SET messages = messages + excluded.messages
+    """, (lo, hi))
+    # коррелированные подзапросы, а не UPDATE … FROM: тот появился только в SQLite 3.33
+    batch = {'lo': lo, 'hi': hi}
+    first_client = """(SELECT MIN(m.timestamp) FROM messages m JOIN users u ON u.id = m.author_id
+                       WHERE m.dialog_chat_id = dialogs.chat_id AND m.id > :lo AND m.id <= :hi AND u.role = 'client')"""
+    # первый ответ после сдвинутого раньше first_client_at пересчитывает trg_dialogs_first_response_recalc
+    con.execute(f"""
+        UPDATE dialogs SET first_client_at = {first_client}
+        WHERE chat_id IN (SELECT m.dialog_chat_id FROM messages m JOIN users u ON u.id = m.author_id
+                          WHERE m.id > :lo AND m.id <= :hi AND u.role = 'client')
+          AND (first_client_at IS NULL OR first_client_at > {first_client})
+    """, batch)
+    response = f"""(SELECT {_response_sec('MIN(m.timestamp)', 'dialogs.first_client_at')}
+                    FROM messages m JOIN users u ON u.id = m.author_id
+                    WHERE m.dialog_chat_id = dialogs.chat_id AND m.id > :lo AND m.id <= :hi AND u.role = 'manager'
+                      AND m.timestamp >= dialogs.first_client_at)"""
+    con.execute(f"""
+        UPDATE dialogs SET first_response_sec = {response}
+        WHERE chat_id IN (SELECT m.dialog_chat_id FROM messages m JOIN users u ON u.id = m.author_id
+                          WHERE m.id > :lo AND m.id <= :hi AND u.role = 'manager')
+          AND {response} IS NOT NULL
+          AND (first_response_sec IS NULL OR first_response_sec > {response})
+    """, batch)
+    return con.execute("SELECT COUNT(*) FROM messages WHERE id > ? AND id <= ?", (lo, hi)).fetchone()[0]
+
+def stats_backfill(path=None, rebuild=False, batch=STATS_BACKFILL_BATCH):
+    """Учитывает в stats_* сообщения, записанные до миграции; rebuild — пересчитать всё.
+
+    Возвращает число учтённых сообщений.
+    """
+    if rebuild:
+        with db_tx(path) as con:
+            con.execute("UPDATE dialogs SET first_client_at = NULL, first_response_sec = NULL "
+                        "WHERE first_client_at IS NOT NULL OR first_response_sec IS NOT NULL")
+            for table in ('stats_messages', 'stats_dialogs', 'stats_response'):
+                con.execute(f"DELETE FROM {table}")
+            con.execute(f"INSERT INTO stats_dialogs (hour, opened) "
+                        f"SELECT {_stats_hour('start_time')}, COUNT(*) FROM dialogs GROUP BY 1")
+            con.execute("UPDATE stats_backfill SET upto = (SELECT IFNULL(MAX(id), 0) FROM messages), done = 0")
+        logging.info("Statistics cleared for rebuild")
+    total = run_backfill('stats_backfill', _stats_backfill_batch, path, batch)
+    if total:
+        logging.info(f"Statistics backfilled: {total} messages")
+    return total
+
+def start_stats_backfill(rebuild=False):
+    return start_background('stats-backfill', stats_backfill, rebuild=rebuild)
+
+SQL_STATS_DIALOGS = """
+    SELECT IFNULL(SUM(opened), 0) AS opened, IFNULL(SUM(with_client), 0) AS with_client,
+           IFNULL(SUM(responded), 0) AS responded, IFNULL(SUM(response_sec), 0) AS response_sec
+    FROM stats_dialogs WHERE hour BETWEEN ? AND ?
+"""
+SQL_STATS_MESSAGES = """
+    SELECT s.role, s.author_id, u.user_name, SUM(s.messages) AS messages
+    FROM stats_messages s LEFT JOIN users u ON u.id = s.author_id AND s.author_id <> 0
+    WHERE s.hour BETWEEN ? AND ?
+    GROUP BY s.role, s.author_id
+    ORDER BY messages DESC
+"""
+SQL_STATS_RESPONSE = "SELECT le, SUM(dialogs) AS dialogs FROM stats_response WHERE hour BETWEEN ? AND ? GROUP BY le"
+INDEXED_API_QUERIES.update({
+    'stats_dialogs': (SQL_STATS_DIALOGS, ('', '')),
+    'stats_messages': (SQL_STATS_MESSAGES, ('', '')),
+    'stats_response': (SQL_STATS_RESPONSE, ('', '')),
+})
+
+def response_percentile(histogram, total, p):
+    """Верхняя граница корзины, в которую попадает p-я доля ответов; None — позже последней границы."""
+    seen = 0
+    for le in FIRST_RESPONSE_BUCKETS:
+        seen += histogram.get(le, 0)
+        if total and seen >= total * p:
+            return le
+    return None
+
+def collect_stats(con, hour_from, hour_to):
+    """Сводка за часы hour_from..hour_to включительно (ключи 'YYYY-MM-DDTHH')."""
+    d = con.execute(SQL_STATS_DIALOGS, (hour_from, hour_to)).fetchone()
+    by_role, by_manager = {}, []
+    for row in con.execute(SQL_STATS_MESSAGES, (hour_from, hour_to)):
+        role = row['role'] or 'unknown'
+        by_role[role] = by_role.get(role, 0) + row['messages']
+        if row['role'] == 'manager':
+            by_manager.append({'user_id': row['author_id'], 'user_name': row['user_name'],
+                               'messages': row['messages']})
+    histogram = {row['le']: row['dialogs'] for row in con.execute(SQL_STATS_RESPONSE, (hour_from, hour_to))}
+    responded = d['responded']
+    return {
+        'dialogs': {
+            'opened': d['opened'],
+            'with_client': d['with_client'],
+            'responded': responded,
+            'unanswered': d['with_client'] - responded,
+        },
+        'messages': {'total': sum(by_role.values()), 'by_role': by_role, 'by_manager': by_manager},
+        'first_response': {
+            'avg_sec': round(d['response_sec'] / responded, 1) if responded else None,
+            'p50_le_sec': response_percentile(histogram, responded, 0.5),
+            'p90_le_sec': response_percentile(histogram, responded, 0.9),
+            'histogram': {**{str(le): histogram.get(le, 0) for le in FIRST_RESPONSE_BUCKETS},
+                          '+Inf': histogram.get(-1, 0)},
+        },
+    }
+
+@app.route('/api/stats', methods=['GET'])
+@token_required
+def get_stats():
+    try:
+        start_utc_str, end_utc_str = get_time_range_utc(request.args)
+    except ValueError as e:
+        return json.dumps({'error': str(e)}), 400, {'Content-Type': 'application/json'}
+    try:
+        con = get_db()
+        # часовые строки: start_time/end_time округляются до часа
+        hour_from, hour_to = start_utc_str[:13], end_utc_str[:13]
+        result = {'from': hour_from + ':00:00', 'to': hour_to + ':59:59', **collect_stats(con, hour_from, hour_to),
+                  'complete': stats_status()['complete']}
+        return json.dumps(result, ensure_ascii=False), 200, {'Content-Type': 'application/json; charset=utf-8'}
+    except Exception as e:
+        logging.error(f"API Error in get_stats: {e}")
+        return json.dumps({'error': str(e)}), 500, {'Content-Type': 'application/json'}
+
+@app.cli.command('stats-backfill')
+@click.option('--rebuild', is_flag=True, help='стереть статистику и пересчитать по всем сообщениям')
+@click.option('--db', 'db_file', default=None, help='путь к dialogs.db (по умолчанию — инстанса рядом с main.py)')
+def stats_backfill_command(rebuild, db_file):
+    """Учитывает в /api/stats сообщения, записанные до появления статистики."""
+    migrate_db(db_file)
+    started = perf_counter()
+    n = stats_backfill(db_file, rebuild=rebuild)
+    click.echo(f"counted {n} messages in {perf_counter() - started:.1f}s: {stats_status(db_file)}")
+
 # ---------------------- Вебхук бота ----------------------
+def process_bot_event(event, data):
+    """Запись ONIMBOTJOINCHAT/ONIMBOTMESSAGEADD и постановка REST-задач. False — событие не обработано."""
+    if event == 'ONIMBOTJOINCHAT':
+        params = data.get('data', {}).get('PARAMS', {})
+        user_info = data.get('data', {}).get('USER', {})
+
+        chat_id_str = params.get('CHAT_ID')
+        user_id = user_info.get('ID')      # может быть 0
+        user_name = user_info.get('NAME') or ''
+
+        if chat_id_str:
+            chat_id = int(chat_id_str)
+
+            # Всегда фиксируем сам диалог; участника — если ID присутствует (включая 0)
+            role = 'client' if (user_info.get('IS_EXTRANET') == 'Y') else 'manager'
+            if not ingest_event(chat_id, user_id, user_name, role, event_key=webhook_event_key(event, data)):
+                return False
+
+            logging.info(f"Bot joined chat {chat_id}. Transferring to operator queue...")
+            # повтор после неудачи перепишет диалог и участника идемпотентно
+            return enqueue_job('session_transfer', {'chat_id': chat_id}) is not None
+
+    elif event == 'ONIMBOTMESSAGEADD':
+        params = data.get('data', {}).get('PARAMS', {})
+        user_info = data.get('data', {}).get('USER', {})
+
+        chat_id_str  = params.get('CHAT_ID')
+        author_id    = params.get('AUTHOR_ID')
+        author_name  = user_info.get('NAME', '') or ''
+        message_text = params.get('MESSAGE')
+        message_id   = params.get('MESSAGE_ID')
+        message_id   = int(message_id) if str(message_id or '').isdigit() else None
+
+        if chat_id_str and message_text:
+            chat_id = int(chat_id_str)
+            is_extranet = user_info.get('IS_EXTRANET') == 'Y'
+            author_role = 'client' if is_extranet else 'manager'
+            return ingest_event(chat_id, author_id, author_name, author_role, message_text, message_id,
+                                event_key=webhook_event_key(event, data))
+
+    return True
+
 # ПИНГ для проверки URL руками
 @app.route('/python_bot/', methods=['GET'])
 def webhook_ping():
     return jsonify({
         'ok': True,
-        'instance': INSTANCE,
+        'instance': tenant().name,
         'prefix': request.headers.get('X-Forwarded-Prefix'),
         'host': request.host,
         'path': request.path
@@ -518,86 +4427,40 @@ def webhook_handler():
         if not save_auth_data(auth_from_request):
             return "Failed to save auth", 500
 
-        handler_url = public_handler_url()
-
-        result = rest_command(auth_from_request, 'imbot.register', {
-            'CODE': BOT_CODE,
-            'TYPE': 'O',
-            'EVENT_WELCOME_MESSAGE': handler_url,
-            'EVENT_MESSAGE_ADD':    handler_url,
-            'EVENT_BOT_DELETE':     handler_url,
-            'PROPERTIES': {
-                'NAME': 'Python Interceptor Bot',
-                'WORK_POSITION': 'Перехват и передача диалогов',
-                'COLOR': 'AQUA',
-            }
-        })
-        if result and 'result' in result:
-            logging.info(f"Bot registered with ID: {result.get('result')}")
-        else:
-            logging.error(f"Failed to register bot. Response: {redact(result)}")
+        # регистрация бота — фоновой задачей с ретраями (см. JOB_HANDLERS)
+        if enqueue_job('bot_register', {'handler_url': public_handler_url()}) is None:
+            return "Failed to queue bot registration", 500
         return "OK"
 
-    auth_data = get_current_auth()
+    auth_data = get_current_auth() or get_current_auth(force=True)
     if not auth_data:
-        logging.warning(f"No auth data in {AUTH_FILE}. Please install the app first.")
+        logging.warning(f"No auth data in {tenant().auth_file}. Please install the app first.")
         return "Unauthorized", 401
 
+    if auth_data.get('application_token') != app_token:
+        # возможно, ONAPPINSTALL только что обработал другой воркер — сверяемся с файлом
+        auth_data = get_current_auth(force=True) or auth_data
     if auth_data.get('application_token') != app_token:
         logging.warning(f"Mismatched token! Expected { _mask_val(auth_data.get('application_token')) }, got { _mask_val(app_token) }")
         return "Forbidden", 403
 
-    if event == 'ONIMBOTJOINCHAT':
-        params = data.get('data', {}).get('PARAMS', {})
-        user_info = data.get('data', {}).get('USER', {})
-
-        chat_id_str = params.get('CHAT_ID')
-        user_id = user_info.get('ID')      # может быть 0
-        user_name = user_info.get('NAME') or ''
-
-        if chat_id_str:
-            chat_id = int(chat_id_str)
-
-            # Всегда фиксируем сам диалог
-            if not get_dialog_id(chat_id):
-                save_new_dialog(chat_id)
-
-            # Добавляем участника, если ID присутствует (включая 0)
-            if user_id is not None:
-                role = 'client' if (user_info.get('IS_EXTRANET') == 'Y') else 'manager'
-                add_user(user_id, user_name, role)
-                add_participant_to_dialog(chat_id, user_id)
-
-            logging.info(f"Bot joined chat {chat_id}. Transferring to operator queue...")
-            rest_command(auth_data, 'imopenlines.bot.session.transfer', {
-                'CHAT_ID': chat_id,
-                'QUEUE': 'Y',
-                'LEAVE': 'Y'
-            })
-
-    elif event == 'ONIMBOTMESSAGEADD':
-        params = data.get('data', {}).get('PARAMS', {})
-        user_info = data.get('data', {}).get('USER', {})
-
-        chat_id_str  = params.get('CHAT_ID')
-        author_id    = params.get('AUTHOR_ID')
-        author_name  = user_info.get('NAME', '') or ''
-        message_text = params.get('MESSAGE')
-
-        if chat_id_str and message_text:
-            chat_id = int(chat_id_str)
-
-            if not get_dialog_id(chat_id):
-                save_new_dialog(chat_id)
-
-            if author_id is not None:
-                is_extranet = user_info.get('IS_EXTRANET') == 'Y'
-                author_role = 'client' if is_extranet else 'manager'
-                add_user(author_id, author_name, author_role)
-                add_participant_to_dialog(chat_id, author_id)
-
-            save_message(chat_id, author_id, message_text)
+    event_key = webhook_event_key(event, data)
+    if event_key and not claim_event(event_key):
+        logging.info(f"Duplicate {event} delivery {event_key}, skipped")
+        metrics.inc('b24bot_webhook_duplicates_total', event=event)
+        return "OK"
 
+    try:
+        processed = process_bot_event(event, data)
+    except Exception:
+        if event_key:
+            release_event(event_key)
+        raise
+    if not processed:
+        # не 200 — Б24 доставит событие снова, и свободный ключ его пропустит
+        if event_key:
+            release_event(event_key)
+        return "Failed to process event", 500
     return "OK"
 
 # ---------------------- Локальный запуск ----------------------
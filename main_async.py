@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""Асинхронная точка входа: aiohttp-сервер, мост к тому же WSGI-приложению.
+
+Асинхронны только соединения, чтение тел и отдача ответов (цикл asyncio) и
+вызовы Б24 из REST-задач (JOB_HANDLERS, через aiohttp). Сами маршруты
+(/python_bot/, /api/dialogs, /api/users, /api/admin/*) — это Flask-приложение
+из main.py: запрос целиком, со всей работой с SQLite, выполняется синхронно в
+пуле ASYNC_THREADS потоков, так что поведение и ответы совпадают с синхронным
+режимом (tests/test_async_parity.py). Код сценария REST-задачи между вызовами
+Б24 — в том же пуле.
+
+Одновременно обрабатывается не больше ASYNC_THREADS запросов, остальные ждут
+в очереди пула, не занимая потока (тело уже прочитано циклом). Это намеренно:
+каждый вебхук — транзакции на запись в SQLite, а писатель у БД один. Поэтому
+и выигрыш у вебхуков небольшой: на bench_webhooks (1 воркер, 300 клиентов)
+~183–191 запросов/с против ~151–165 у gunicorn с теми же потоками (разброс
+прогонов — до 15%); при 128 потоках — те же ~200 и ошибки «database is locked».
+
+    python main_async.py --port 8080
+    gunicorn main_async:app --worker-class aiohttp.GunicornWebWorker --workers 3 --bind 127.0.0.1:8080
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from time import monotonic, perf_counter
+from urllib.parse import unquote_to_bytes
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector, web
+
+import main
+from main import (JOB_HANDLERS, JOB_POLL_SEC, PRIORITY_DEFAULT, RATE_LIMIT_ENABLED, RATE_LIMIT_WAIT_SEC,
+                  REST_POOL_SIZE, REST_TIMEOUT, JobQueue, RateLimitTimeout,
+                  fresh_auth, metrics, rate_limiter, refresh_auth, rest_expired, rest_outcome,
+                  rest_target, rest_waited, use_tenant)
+
+ASYNC_THREADS     = int(os.environ.get('ASYNC_THREADS', '32'))
+ASYNC_JOB_WORKERS = int(os.environ.get('ASYNC_JOB_WORKERS', '16'))
+ASYNC_MAX_BODY    = int(os.environ.get('ASYNC_MAX_BODY', str(16 * 1024 * 1024)))
+
+# заголовки соединения выставляет сам aiohttp
+_HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-length'}
+
+class Runner:
+    """Пул потоков для SQLite и кода приложения; вызовы несут контекст (инстанс) задачи."""
+
+    def __init__(self, threads):
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='aio-sync')
+
+    def __call__(self, fn, *args):
+        ctx = contextvars.copy_context()
+        return asyncio.get_running_loop().run_in_executor(self.executor, ctx.run, fn, *args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+# ---------------------- Flask-приложение в пуле потоков ----------------------
+def wsgi_environ(request, body):
+    path = unquote_to_bytes(request.raw_path.split('?', 1)[0]).decode('latin-1')
+    host, _, port = (request.host or '').partition(':')
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': request.query_string,
+        'SERVER_NAME': host or 'localhost',
+        'SERVER_PORT': port or ('443' if request.scheme == 'https' else '80'),
+        'SERVER_PROTOCOL': f'HTTP/{request.version.major}.{request.version.minor}',
+        'REMOTE_ADDR': request.remote or '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        key = name.upper().replace('-', '_')
+        if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[key] = value
+            continue
+        key = 'HTTP_' + key
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+class WSGIBridge:
+    """aiohttp-обработчик, отдающий запрос WSGI-приложению.
+
+    Тело читается в цикле, сам запрос выполняется в потоке пула. Ответ с
+    Content-Length собирается в потоке и отдаётся одним куском; потоковый
+    (NDJSON, хвост логов) пишется по мере генерации, а поток ждёт, пока кусок
+    уйдёт клиенту — генератор и его курсор SQLite не покидают свой поток.
+    """
+
+    def __init__(self, wsgi_app, runner):
+        self.wsgi_app = wsgi_app
+        self.runner = runner
+
+    async def __call__(self, request):
+        body = await request.read()
+        environ = wsgi_environ(request, body)
+        stream = web.StreamResponse()
+        loop = asyncio.get_running_loop()
+        done = await self.runner(self._run, environ, request, stream, loop)
+        if done is None:
+            return stream
+        status, reason, headers, chunks = done
+        return web.Response(status=status, reason=reason, headers=headers, body=b''.join(chunks))
+
+    def _run(self, environ, request, stream, loop):
+        state = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and 'sent' in state:
+                raise exc_info[1].with_traceback(exc_info[2])
+            code, _, reason = status.partition(' ')
+            state['head'] = (int(code), reason, [(k, v) for k, v in headers if k.lower() not in _HOP_HEADERS],
+                             any(k.lower() == 'content-length' for k, _ in headers))
+            return lambda chunk: send(chunk)
+
+        def send(chunk):
+            state['sent'] = True
+            asyncio.run_coroutine_threadsafe(self._send(request, stream, state['head'], chunk), loop).result()
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks = []
+            for chunk in result:
+                if not chunk:
+                    continue
+                if state['head'][3] and 'sent' not in state:
+                    chunks.append(chunk)
+                else:
+                    send(chunk)
+            if 'sent' in state:
+                send(b'')
+                return None
+            code, reason, headers, _ = state['head']
+            return code, reason, headers, chunks
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    @staticmethod
+    async def _send(request, stream, head, chunk):
+        if not stream.prepared:
+            code, reason, headers, _ = head
+            stream.set_status(code, reason)
+            for k, v in headers:
+                stream.headers.add(k, v)
+            await stream.prepare(request)
+        if chunk:
+            await stream.write(chunk)
+        else:
+            await stream.write_eof()
+
+# ---------------------- REST Б24 через aiohttp ----------------------
+class AsyncRest:
+    """Неблокирующий аналог rest_command/run_rest с тем же лимитером, метриками и логами."""
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.session = None
+
+    async def start(self, app):
+        self.session = ClientSession(connector=TCPConnector(limit_per_host=REST_POOL_SIZE),
+                                     timeout=ClientTimeout(total=REST_TIMEOUT))
+
+    async def close(self, app):
+        if self.session is not None:
+            await self.session.close()
+
+    async def acquire(self, portal, priority=PRIORITY_DEFAULT, timeout=RATE_LIMIT_WAIT_SEC):
+        """RateLimiter.acquire, но паузы — asyncio.sleep, а не поток в sleep()."""
+        started = monotonic()
+        ticket = await self.runner(rate_limiter.join, portal, priority)
+        try:
+            while True:
+                wait = await self.runner(rate_limiter.try_acquire, portal, ticket)
+                if wait is None:
+                    ticket = None
+                    return monotonic() - started
+                if monotonic() - started + wait > timeout:
+                    raise RateLimitTimeout(f"rate limit wait for {portal} exceeded {timeout}s")
+                await asyncio.sleep(min(max(wait, 0.02), 0.5))
+        finally:
+            if ticket is not None:
+                await self.runner(rate_limiter.leave, ticket)
+
+    async def command(self, auth_data, method, params=None, priority=PRIORITY_DEFAULT):
+        # обновление токена — файловая блокировка и HTTP, поэтому в пуле потоков
+        auth_data = await self.runner(fresh_auth, auth_data)
+        api_url, params, portal = rest_target(auth_data, method, params)
+        penalties = 0
+        refreshed = False
+        while True:
+            if RATE_LIMIT_ENABLED:
+                try:
+                    rest_waited(method, portal, await self.acquire(portal, priority))
+                except RateLimitTimeout as e:
+                    logging.error("REST %s not sent: %s", method, e)
+                    return {'error': 'RATE_LIMIT_TIMEOUT', 'error_description': str(e)}
+                except Exception as e:
+                    logging.error("Rate limiter failed, calling %s without it: %s", method, e)
+            started = perf_counter()
+            try:
+                logging.info("REST %s -> %s", method, api_url)
+                async with self.session.post(api_url, json=params) as response:
+                    text = await response.text()
+                    status, reason = response.status, response.reason
+            except (ClientError, asyncio.TimeoutError) as e:
+                metrics.observe('b24bot_rest_duration_seconds', perf_counter() - started, method=method, portal=portal)
+                metrics.inc('b24bot_rest_requests_total', method=method, portal=portal, outcome='exception')
+                logging.error("REST %s exception: %s", method, e or e.__class__.__name__)
+                return {'error': str(e) or e.__class__.__name__}
+            metrics.observe('b24bot_rest_duration_seconds', perf_counter() - started, method=method, portal=portal)
+            try:
+                js = json.loads(text)
+            except ValueError:
+                js = {'non_json': text[:2000]}
+            if await self.runner(rest_outcome, method, portal, status, js, penalties):
+                penalties += 1
+                continue
+            if rest_expired(js) and not refreshed:
+                refreshed = True
+                fresh = await self.runner(refresh_auth, auth_data)
+                if fresh:
+                    auth_data = fresh
+                    api_url, params, portal = rest_target(auth_data, method, params)
+                    continue
+            if status >= 400:
+                # как raise_for_status() в синхронном rest_command
+                error = f"{status} {'Client' if status < 500 else 'Server'} Error: {reason} for url: {api_url}"
+                logging.error("REST %s exception: %s", method, error)
+                return {'error': error}
+            return js
+
+    async def run(self, steps):
+        """run_rest() для того же сценария: шаги — в пуле потоков, HTTP — в цикле."""
+        done, value = await self.runner(_advance, steps, None)
+        while not done:
+            js = await self.command(*value)
+            done, value = await self.runner(_advance, steps, js)
+        return value
+
+def _advance(steps, value):
+    # StopIteration нельзя пробросить через Future — возвращаем признак конца
+    try:
+        return False, steps.send(value)
+    except StopIteration as e:
+        return True, e.value
+
+class AsyncJobQueue(JobQueue):
+    """Та же таблица rest_jobs, но исполнители — задачи asyncio с REST через aiohttp."""
+
+    def __init__(self, workers, poll_sec, runner, rest):
+        super().__init__(workers, poll_sec)
+        self.runner = runner
+        self.rest = rest
+        self._loop = None
+        self._event = None
+        self._tasks = []
+
+    def ensure_started(self):
+        # исполнители запускаются вместе с приложением (start)
+        pass
+
+    def wake(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    async def start(self, app):
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(scan=(i == 0)), name=f'rest-job-{i}') for i in range(self.workers)]
+
+    async def stop(self, app):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._loop = None
+
+    async def run_once_async(self):
+        job = await self.runner(self._claim)
+        if job is None:
+            await self.runner(self._idle)
+            return False
+        try:
+            await self.rest.run(JOB_HANDLERS[job['kind']](json.loads(job['payload'])))
+        except Exception as e:
+            await self.runner(self._finish, job, str(e) or e.__class__.__name__)
+        else:
+            await self.runner(self._finish, job)
+        return True
+
+    async def _worker(self, scan=False):
+        if scan and main.tenants is not None:
+            # инстансы с задачами, оставшимися до рестарта
+            await self.runner(main.tenants.load_pending)
+        while True:
+            # как в JobQueue._run: сброс до опроса, чтобы не потерять wake()
+            self._event.clear()
+            busy = False
+            for t in await self.runner(self.due_tenants):
+                try:
+                    with use_tenant(t):
+                        busy = await self.run_once_async() or busy
+                except Exception as e:
+                    logging.error(f"Job worker error ({t.name}): {e}")
+            if not busy:
+                try:
+                    await asyncio.wait_for(self._event.wait(), self.poll_sec)
+                except asyncio.TimeoutError:
+                    pass
+
+# ---------------------- Приложение ----------------------
+def create_app(threads=ASYNC_THREADS, job_workers=ASYNC_JOB_WORKERS):
+    runner = Runner(threads)
+    rest = AsyncRest(runner)
+    # enqueue_job() и админка работают с main.job_queue — подменяем исполнителей
+    main.job_queue = jobs = AsyncJobQueue(job_workers, JOB_POLL_SEC, runner, rest)
+
+    aio_app = web.Application(client_max_size=ASYNC_MAX_BODY)
+    # связанный async-метод, а не объект: aiohttp считает вызываемые объекты устаревшими «голыми» функциями
+    aio_app.router.add_route('*', '/{tail:.*}', WSGIBridge(main.app, runner).__call__)
+    aio_app.on_startup.extend([rest.start, jobs.start])
+    aio_app.on_cleanup.extend([jobs.stop, rest.close])
+
+    async def _shutdown_pool(app):
+        runner.shutdown()
+    aio_app.on_cleanup.append(_shutdown_pool)
+    return aio_app
+
+app = create_app()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bitrix24 bot on asyncio (aiohttp)')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    logging.info("Starting aiohttp server on %s:%s (%s threads)", args.host, args.port, ASYNC_THREADS)
+    main.init_db()
+    web.run_app(app, host=args.host, port=args.port, print=None)
@@ -93,7 +93,21 @@ port_in_use() {
   fi
 }
 
-if grep -q "^${INSTANCE}:" "$PORTS_MAP" 2>/dev/null; then
+# ---------- Общий пул процессов (TENANTS_ROOT) или свой сервис ----------
+POOL_SERVICE="gunicorn-b24bot-pool.service"
+POOL_DIR="/opt/b24bot"
+POOL_PORT="18000"
+if [ -f "/etc/systemd/system/${POOL_SERVICE}" ]; then
+  USE_POOL="y"
+  info "Найден общий сервис ${POOL_SERVICE} — инстанс будет обслуживаться им"
+else
+  read -r -p "Обслуживать инстанс общим пулом процессов ${POOL_SERVICE}? (y/N): " USE_POOL
+  USE_POOL=$(printf '%s' "${USE_POOL:-n}" | tr -d '\r' | tr '[:upper:]' '[:lower:]')
+fi
+
+if [ "$USE_POOL" = "y" ]; then
+  APP_PORT="$POOL_PORT"
+elif grep -q "^${INSTANCE}:" "$PORTS_MAP" 2>/dev/null; then
   APP_PORT="$(grep "^${INSTANCE}:" "$PORTS_MAP" | head -n1 | cut -d: -f2)"
 else
   APP_PORT=""
@@ -163,8 +177,54 @@ except Exception as e:
     raise
 PYCODE
 
+# ---------- Systemd service: общий пул ----------
+# Один сервис на все каталоги ${BASE_DIR}/<инстанс>; токен и BOT_CODE каждого
+# инстанса он читает из /etc/b24bot/env/<инстанс>.env
+if [ "$USE_POOL" = "y" ] && [ ! -f "/etc/systemd/system/${POOL_SERVICE}" ]; then
+  if [ ! -f "${POOL_DIR}/main.py" ]; then
+    git clone "${REPO_URL:-$REPO_URL_DEFAULT}" "$POOL_DIR" || error "git clone (pool)"
+  fi
+  python3 -m venv "${POOL_DIR}/.venv" || error "venv (pool)"
+  "${POOL_DIR}/.venv/bin/pip" install --upgrade pip || error "pip upgrade (pool)"
+  "${POOL_DIR}/.venv/bin/pip" install -r "${POOL_DIR}/requirements.txt" || error "pip install (pool)"
+  chown -R www-data:www-data "$POOL_DIR"
+
+  POOL_ENV="/etc/b24bot/pool.env"
+  if [ ! -f "$POOL_ENV" ]; then
+    POOL_TOKEN="$(tr -dc 'A-Za-z0-9' </dev/urandom | head -c 40)"
+    cat > "$POOL_ENV" <<EOF
+TENANTS_ROOT=${BASE_DIR}
+TENANT_ENV_DIR=/etc/b24bot/env
+POOL_ADMIN_TOKEN=${POOL_TOKEN}
+EOF
+    chmod 600 "$POOL_ENV"
+    info "POOL_ADMIN_TOKEN (логи, метрики, лимитер пула) сохранён в $POOL_ENV"
+  fi
+
+  cat > "/etc/systemd/system/${POOL_SERVICE}" <<EOF
+[Unit]
+Description=Gunicorn Bitrix24 Bot (shared pool for ${BASE_DIR})
+After=network.target
+
+[Service]
+User=www-data
+Group=www-data
+WorkingDirectory=${POOL_DIR}
+ExecStart=${POOL_DIR}/.venv/bin/gunicorn --workers 3 --threads 8 --bind 127.0.0.1:${POOL_PORT} main:app
+Restart=always
+Environment="PATH=${POOL_DIR}/.venv/bin"
+EnvironmentFile=${POOL_ENV}
+
+[Install]
+WantedBy=multi-user.target
+EOF
+  systemctl daemon-reload
+  systemctl enable --now "${POOL_SERVICE}"
+fi
+
 # ---------- Systemd service (unique per instance) ----------
 SERVICE="gunicorn-b24bot-${INSTANCE}.service"
+if [ "$USE_POOL" != "y" ]; then
 cat > "/etc/systemd/system/${SERVICE}" <<EOF
 [Unit]
 Description=Gunicorn Bitrix24 Bot (${INSTANCE})
@@ -185,6 +245,14 @@ EOF
 
 systemctl daemon-reload
 systemctl enable --now "${SERVICE}"
+fi
+
+# ---------- Ночной перенос старых сообщений в архив ----------
+# ничего не делает, пока в env-файле не задан ARCHIVE_AFTER_DAYS
+cat > "/etc/cron.d/b24bot-${INSTANCE}-archive" <<EOF
+30 3 * * * root cd ${PROJECT_DIR} && set -a && . /etc/b24bot/env/${INSTANCE}.env && runuser -u www-data -- ${PROJECT_DIR}/.venv/bin/flask --app main archive >/dev/null 2>&1
+EOF
+chmod 644 "/etc/cron.d/b24bot-${INSTANCE}-archive"
 
 # ---------- Nginx per-domain vhost + per-instance snippets ----------
 
@@ -277,15 +345,21 @@ ENABLED_FLAG="${PROJECT_DIR}/ENABLED"
 DISABLED_FLAG="${PROJECT_DIR}/DISABLED"
 PORTS_MAP="/etc/b24bot/ports.map"
 ENV_FILE="/etc/b24bot/env/${INSTANCE}.env"
+# инстанс общего пула: своего юнита нет, on/off — только флагами ENABLED/DISABLED
+if [ ! -f "/etc/systemd/system/${SERVICE}" ] && [ -f /etc/systemd/system/gunicorn-b24bot-pool.service ]; then
+  SERVICE="gunicorn-b24bot-pool.service"; POOL=1
+else
+  POOL=0
+fi
 
 case "$CMD" in
   on)
     rm -f "$DISABLED_FLAG"; touch "$ENABLED_FLAG"
-    systemctl start "$SERVICE"
+    [ "$POOL" -eq 1 ] || systemctl start "$SERVICE"
     echo "Instance ${INSTANCE}: ON"
     ;;
   off)
-    systemctl stop "$SERVICE" || true
+    [ "$POOL" -eq 1 ] || systemctl stop "$SERVICE" || true
     rm -f "$ENABLED_FLAG"; touch "$DISABLED_FLAG"
     echo "Instance ${INSTANCE}: OFF"
     ;;
@@ -305,10 +379,13 @@ case "$CMD" in
   purge)
     echo "Purging instance ${INSTANCE}..."
 
-    # 1) stop & remove service
-    systemctl stop "$SERVICE" 2>/dev/null || true
-    systemctl disable "$SERVICE" 2>/dev/null || true
-    rm -f "/etc/systemd/system/${SERVICE}"
+    # 1) stop & remove service (общий пул не трогаем)
+    if [ "$POOL" -eq 0 ]; then
+      systemctl stop "$SERVICE" 2>/dev/null || true
+      systemctl disable "$SERVICE" 2>/dev/null || true
+      rm -f "/etc/systemd/system/${SERVICE}"
+    fi
+    rm -f "/etc/cron.d/b24bot-${INSTANCE}-archive"
     systemctl daemon-reload
 
     # 2) delete project dir
@@ -355,5 +432,9 @@ chmod +x /usr/local/bin/botctl
 success "Готово!"
 echo
 echo "Домен:   http://${DOMAIN_FQDN}/${INSTANCE}/python_bot/"
-echo "Сервис:  systemctl status gunicorn-b24bot-${INSTANCE}"
+if [ "$USE_POOL" = "y" ]; then
+  echo "Сервис:  systemctl status gunicorn-b24bot-pool (общий пул)"
+else
+  echo "Сервис:  systemctl status gunicorn-b24bot-${INSTANCE}"
+fi
 echo "Управление: sudo botctl ${INSTANCE} {on|off|restart|status|enable|disable|purge}"
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""Общая обвязка тестов: main.py импортируется из временного каталога инстанса.
+
+Как в bench/stand.py, каталог содержит ссылки на main.py, main_async.py и
+config.py: BASE_DIR в main.py берётся из пути без разыменования ссылок,
+поэтому БД, auth.json и bot.log тестов не трогают рабочие файлы.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_TOKEN = 'test-token'
+
+INSTANCE_DIR = tempfile.mkdtemp(prefix='b24test-')
+for _name in ('main.py', 'main_async.py', 'config.py'):
+    os.symlink(os.path.join(REPO_DIR, _name), os.path.join(INSTANCE_DIR, _name))
+os.environ.update({
+    'API_SECRET_TOKEN': API_TOKEN,
+    'INSTANCE': 'test',
+    'RATE_LIMIT_ENABLED': '0',
+})
+sys.path.insert(0, INSTANCE_DIR)
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(INSTANCE_DIR, ignore_errors=True)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Перенос в archive/<YYYY-MM>.db: история остаётся в поиске, не двоится после сбоя и при новом сообщении."""
+import pytest
+
+from conftest import API_TOKEN
+import main
+
+BEARER = {'Authorization': f'Bearer {API_TOKEN}'}
+CHAT_ID = 900001
+
+@pytest.fixture(scope='module')
+def archived():
+    main.migrate_db()
+    con = main.get_db()
+    con.execute("INSERT INTO dialogs (chat_id, start_time) VALUES (?, '2020-03-02T09:00:00')", (CHAT_ID,))
+    ids = [con.execute("INSERT INTO messages (dialog_chat_id, author_id, message_text, timestamp) VALUES (?, 7, ?, ?)",
+                       (CHAT_ID, f'нафталин {i}', f'2020-03-02T09:0{i}:00')).lastrowid for i in range(3)]
+    main.archive_old_data(days=30, vacuum=False)
+    return ids
+
+def get(path, **args):
+    r = main.app.test_client().get(path, query_string=args, headers=BEARER)
+    assert r.status_code == 200, r.get_data()
+    return r.get_json()
+
+def search_ids(**args):
+    return [row['id'] for row in get('/api/search', q='нафталин', **args)['results']]
+
+def test_archived_messages_are_searchable(archived):
+    con = main.get_db()
+    assert not con.execute("SELECT 1 FROM messages WHERE dialog_chat_id = ?", (CHAT_ID,)).fetchone()
+    assert sorted(search_ids()) == archived
+    assert search_ids(order='recent') == archived[::-1]
+    assert search_ids(chat_id=CHAT_ID, date='2020-03-02') and search_ids(date='2020-03-03') == []
+    page = get('/api/search', q='нафталин', order='recent', limit=2, offset=1)
+    assert [row['id'] for row in page['results']] == archived[1::-1] and page['next_offset'] is None
+
+def test_interrupted_move_is_not_duplicated(archived):
+    # сбой между копированием в архив и удалением: строка в обеих БД
+    con = main.get_db()
+    schema = main.attach_archives(con, ['2020-03'])[0]
+    con.execute(f"INSERT INTO messages (id, dialog_chat_id, author_id, message_text, timestamp) "
+                f"SELECT id, dialog_chat_id, author_id, message_text, timestamp FROM {schema}.messages WHERE id = ?",
+                (archived[0],))
+    details = get(f'/api/dialogs/{CHAT_ID}', date='2020-03-02')
+    assert [m['id'] for m in details['messages']] == archived
+    batch = get('/api/dialogs/batch', chat_ids=str(CHAT_ID), date='2020-03-02')
+    assert batch['dialogs'][0]['message_count'] == 3
+    assert sorted(search_ids()) == archived
+    assert main.archive_old_data(days=30, vacuum=False)['messages'] == 1
+    assert sorted(search_ids()) == archived
+
+def test_new_message_restores_archived_dialog(archived):
+    chat_id = CHAT_ID + 1
+    con = main.get_db()
+    dialog_id = con.execute("INSERT INTO dialogs (chat_id, start_time) VALUES (?, '2020-04-01T09:00:00')",
+                            (chat_id,)).lastrowid
+    con.execute("INSERT INTO users (id, user_name, role) VALUES (90001, 'Клиент', 'client')")
+    con.execute("INSERT INTO dialog_participants (dialog_id, user_id) VALUES (?, 90001)", (dialog_id,))
+    con.execute("INSERT INTO messages (dialog_chat_id, author_id, message_text, timestamp) "
+                "VALUES (?, 90001, 'было', '2020-04-01T09:01:00')", (chat_id,))
+    assert main.archive_old_data(days=30, vacuum=False)['dialogs'] == 1
+    opened = con.execute("SELECT opened FROM stats_dialogs WHERE hour = '2020-04-01T09'").fetchone()[0]
+
+    # клиент вернулся в старый чат
+    assert main.ingest_event(chat_id, 90002, 'Менеджер', 'manager', 'снова здравствуйте')
+    rows = con.execute("SELECT id, start_time FROM dialogs WHERE chat_id = ?", (chat_id,)).fetchall()
+    assert [tuple(r) for r in rows] == [(dialog_id, '2020-04-01T09:00:00')]
+    assert not con.execute("SELECT 1 FROM archive_dialogs WHERE chat_id = ?", (chat_id,)).fetchone()
+    assert con.execute("SELECT opened FROM stats_dialogs WHERE hour = '2020-04-01T09'").fetchone()[0] == opened
+    details = get(f'/api/dialogs/{chat_id}', date='2020-04-01')
+    assert sorted(p['id'] for p in details['participants']) == [90001, 90002]
+    assert [m['message_text'] for m in details['messages']] == ['было']
+    listed = get('/api/dialogs', date='2020-04-01')
+    assert [d['chat_id'] for d in listed if d['chat_id'] == chat_id] == [chat_id]
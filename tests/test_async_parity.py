@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""main.py под Flask и main_async.py под aiohttp отвечают одинаково на одни и те же запросы."""
+import asyncio
+from datetime import datetime
+from urllib.parse import urlencode
+
+import pytest
+
+pytest.importorskip('aiohttp')
+from aiohttp.test_utils import TestClient, TestServer  # noqa: E402
+
+from conftest import API_TOKEN  # noqa: E402
+import main  # noqa: E402
+import main_async  # noqa: E402
+
+APP_TOKEN = 'parity-app-token'
+FORM = {'Content-Type': 'application/x-www-form-urlencoded'}
+BEARER = {'Authorization': f'Bearer {API_TOKEN}'}
+HOST = {'Host': 'bot.example.org'}
+
+def message_add(chat_id, message_id, text, author_id=7, app_token=APP_TOKEN):
+    return urlencode({
+        'event': 'ONIMBOTMESSAGEADD',
+        'data[PARAMS][CHAT_ID]': chat_id,
+        'data[PARAMS][AUTHOR_ID]': author_id,
+        'data[PARAMS][MESSAGE]': text,
+        'data[PARAMS][MESSAGE_ID]': message_id,
+        'data[USER][NAME]': 'Иван Петров',
+        'data[USER][IS_EXTRANET]': 'Y',
+        'auth[application_token]': app_token,
+        'ts': 1738317540,
+    })
+
+def join_chat(chat_id, ts, user_id=9):
+    return urlencode({
+        'event': 'ONIMBOTJOINCHAT',
+        'data[PARAMS][CHAT_ID]': chat_id,
+        'data[USER][ID]': user_id,
+        'data[USER][NAME]': 'Оператор',
+        'auth[application_token]': APP_TOKEN,
+        'ts': ts,
+    })
+
+def sync_request(method, path, headers=None, body=None):
+    r = main.app.test_client().open(path, method=method, headers=headers or {}, data=body)
+    return r.status_code, r.headers.get('Content-Type'), r.headers.get('ETag'), r.get_data()
+
+def async_requests(requests):
+    async def run():
+        async with TestClient(TestServer(main_async.create_app())) as client:
+            out = []
+            for method, path, headers, body in requests:
+                r = await client.request(method, path, headers=headers or {}, data=body)
+                out.append((r.status, r.headers.get('Content-Type'), r.headers.get('ETag'), await r.read()))
+            return out
+    return asyncio.run(run())
+
+def both(requests):
+    """Ответы синхронного и асинхронного входов на одну и ту же последовательность запросов."""
+    sync = [sync_request(*req) for req in requests]
+    return sync, async_requests(requests)
+
+@pytest.fixture(scope='module', autouse=True)
+def installed():
+    main.init_db()
+    main.save_auth_data({'application_token': APP_TOKEN, 'access_token': 'token',
+                         'client_endpoint': 'http://127.0.0.1:9/rest/'})
+
+def messages_count():
+    return main.get_db().execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+def test_webhooks_match():
+    events = [message_add(500 + i % 3, 9000 + i, f'сообщение {i}') for i in range(6)]
+    events += [join_chat(600, 1738317600), join_chat(601, 1738317601)]
+    posts = [('POST', '/python_bot/', FORM, body) for body in events]
+    before = messages_count()
+
+    # первые доставки делятся между входами, повтор каждой приходит через другой вход
+    first_sync = [sync_request(*req) for req in posts[0::2]]
+    first_async = async_requests(posts[1::2])
+    again_async = async_requests(posts[0::2])
+    again_sync = [sync_request(*req) for req in posts[1::2]]
+    assert first_sync == first_async == again_async == again_sync
+    assert {r[3] for r in first_sync} == {b'OK'}
+    assert messages_count() - before == 6
+
+    sync, async_ = both([
+        ('GET', '/python_bot/', HOST, None),
+        ('POST', '/python_bot/', FORM, message_add(500, 9100, 'чужой', app_token='wrong')),
+        ('POST', '/python_bot/', FORM, 'event=ONUNKNOWN&auth%5Bapplication_token%5D=' + APP_TOKEN),
+    ])
+    assert sync == async_
+    assert [r[0] for r in sync] == [200, 403, 200]
+
+def test_api_matches():
+    day = datetime.now().strftime('%Y-%m-%d')
+    sync_request('POST', '/python_bot/', FORM, message_add(700, 9200, 'для API'))
+    requests = [
+        ('GET', f'/api/dialogs?date={day}', BEARER, None),
+        ('GET', f'/api/dialogs?date={day}&limit=2', BEARER, None),
+        ('GET', f'/api/dialogs?date={day}&stream=ndjson', BEARER, None),
+        ('GET', f'/api/dialogs?date={day}&stream=json', BEARER, None),
+        ('GET', f'/api/dialogs/700?date={day}', BEARER, None),
+        ('GET', '/api/dialogs/batch?chat_ids=500,501,700,404404&messages=1', BEARER, None),
+        ('GET', '/api/users', BEARER, None),
+        ('GET', '/api/search?q=API', BEARER, None),
+        ('GET', f'/api/stats?date={day}', BEARER, None),
+        ('GET', '/api/export?entity=messages', BEARER, None),
+        ('GET', '/api/dialogs', {}, None),
+        ('GET', '/api/dialogs?date=bad', BEARER, None),
+    ]
+    sync, async_ = both(requests)
+    for req, s, a in zip(requests, sync, async_):
+        assert s == a, req[1]
+    assert [r[0] for r in sync[:10]] == [200] * 10
+    assert all(r[3] for r in sync)
+    assert b'"chat_id": 700' in sync[0][3]
+
+    # ETag одного входа годится для другого
+    etag = sync[0][2]
+    assert etag
+    cond = [('GET', f'/api/dialogs?date={day}', dict(BEARER, **{'If-None-Match': etag}), None)]
+    sync, async_ = both(cond)
+    assert sync[0][0] == async_[0][0] == 304
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""auth.json: кэш в памяти воркера подхватывает запись другого воркера по stat; токен обновляет один воркер."""
+import json
+import threading
+
+import pytest
+
+import main
+
+AUTH = {'access_token': 'a1', 'refresh_token': 'r1', 'expires': 0, 'client_endpoint': 'https://b24.test/rest/'}
+
+def test_cached_until_recheck(tmp_path, monkeypatch):
+    path = str(tmp_path / 'auth.json')
+    worker_a, worker_b = main.AuthStore(path, 60), main.AuthStore(path, 60)
+    worker_a.save(AUTH)
+    assert worker_b.get()['access_token'] == 'a1'
+
+    reads = []
+    real_load = main.json.load
+    monkeypatch.setattr(main.json, 'load', lambda f: reads.append(f.name) or real_load(f))
+    worker_a.save(dict(AUTH, access_token='a2'))
+    # в пределах recheck_sec — ни stat, ни чтения: отдаётся копия из памяти
+    got = worker_b.get()
+    assert got['access_token'] == 'a1' and reads == []
+    got['access_token'] = 'испорчено'
+    assert worker_b.get()['access_token'] == 'a1'
+    # новый файл (другой inode после os.replace) — перечитывается один раз
+    assert worker_b.get(force=True)['access_token'] == 'a2' and reads == [path]
+    assert worker_b.get(force=True)['access_token'] == 'a2' and reads == [path]
+
+def test_broken_file_is_not_cached(tmp_path):
+    path = tmp_path / 'auth.json'
+    path.write_text('{"access_token": ', encoding='utf-8')
+    store = main.AuthStore(str(path), 0)
+    assert store.get() is None
+    # дописали — следующий get() читает снова, а не держит «нет данных»
+    path.write_text(json.dumps(AUTH), encoding='utf-8')
+    assert store.get()['access_token'] == 'a1'
+
+def test_refresh_single_flight(tmp_path):
+    """Воркеры и потоки с одним устаревшим токеном: к OAuth-серверу уходит один запрос."""
+    path = str(tmp_path / 'auth.json')
+    stores = [main.AuthStore(path, 60), main.AuthStore(path, 60)]
+    stores[0].save(AUTH)
+    calls = []
+
+    def fetch(auth):
+        calls.append(auth['refresh_token'])
+        main.sleep(0.05)   # пока идёт запрос, остальные ждут на flock
+        return dict(auth, access_token='a2', refresh_token='r2', expires=main.unix_time() + 3600)
+
+    results = []
+    threads = [threading.Thread(target=lambda s=stores[i % 2]: results.append(s.refresh(AUTH, fetch)))
+               for i in range(8)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert calls == ['r1']
+    assert [r['access_token'] for r in results] == ['a2'] * 8
+    assert stores[1].get(force=True)['refresh_token'] == 'r2'
+
+@pytest.fixture
+def portal(tmp_path, monkeypatch):
+    """Инстанс с auth.json, OAuth-сервер и портал — подделки, считающие вызовы."""
+    t = main.Tenant('auth', str(tmp_path), 'tok', 'code')
+    t.auth_store.save(AUTH)
+    state = {'refreshes': 0, 'fresh': dict(AUTH, access_token='a2', refresh_token='r2'),
+             'replies': [], 'sent': []}
+
+    def oauth(auth):
+        state['refreshes'] += 1
+        return state['fresh']
+    monkeypatch.setattr(main, '_oauth_refresh', oauth)
+
+    class Session:
+        def post(self, url, json, timeout):
+            state['sent'].append((url, dict(json)))
+            status, body = state['replies'].pop(0)
+            return FakeResponse(status, body)
+    monkeypatch.setattr(main, '_http_session', lambda url: Session())
+    with main.use_tenant(t):
+        yield state
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code, self._body, self.text = status_code, body, json.dumps(body)
+
+    def json(self):
+        return self._body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise main.requests.exceptions.HTTPError(f'{self.status_code}')
+
+EXPIRED = (401, {'error': 'expired_token', 'error_description': 'The access token provided has expired.'})
+
+def test_expired_token_retried_once(portal):
+    portal['replies'] = [EXPIRED, (200, {'result': True})]
+    assert main.rest_command(dict(AUTH), 'im.message.add', {'DIALOG_ID': 1}) == {'result': True}
+    assert [params['auth'] for _, params in portal['sent']] == ['a1', 'a2']
+    assert portal['refreshes'] == 1 and main.get_current_auth(force=True)['access_token'] == 'a2'
+
+    # и новый токен отвергнут — один refresh на вызов, дальше ошибка, а не цикл
+    portal['sent'].clear()
+    portal['replies'] = [EXPIRED, EXPIRED, (200, {'result': True})]
+    assert 'error' in main.rest_command(main.get_current_auth(), 'im.message.add', {'DIALOG_ID': 1})
+    assert len(portal['sent']) == 2 and portal['refreshes'] == 2
+
+def test_failed_refresh_backs_off(portal):
+    portal['fresh'] = None
+    assert main.refresh_auth(dict(AUTH)) is None
+    assert main.refresh_auth(dict(AUTH)) is None
+    assert portal['refreshes'] == 1
+    # после AUTH_REFRESH_RETRY_SEC — новая попытка
+    store = main.tenant().auth_store
+    store.refresh_failed_at -= main.AUTH_REFRESH_RETRY_SEC + 1
+    portal['fresh'] = dict(AUTH, access_token='a3')
+    assert main.refresh_auth(dict(AUTH))['access_token'] == 'a3'
+    assert portal['refreshes'] == 2 and store.refresh_failed_at is None
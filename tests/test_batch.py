@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""/api/dialogs/batch: несколько диалогов за один запрос, с участниками, сводкой и сообщениями."""
+import json
+
+import pytest
+
+import main
+
+BEARER = {'Authorization': 'Bearer tok'}
+DAY = '2025-02-03'
+
+@pytest.fixture
+def client(tmp_path):
+    t = main.Tenant('batch', str(tmp_path), 'tok', 'code')
+    with main.use_tenant(t):
+        main.migrate_db()
+        con = main.get_db()
+        con.executemany("INSERT INTO users (id, user_name, role) VALUES (?, ?, ?)",
+                        [(7, 'Клиент', 'client'), (8, 'Оператор', 'operator')])
+        for chat_id, minute in ((101, 0), (102, 10), (103, 20)):
+            con.execute("INSERT INTO dialogs (chat_id, start_time) VALUES (?, ?)", (chat_id, f'{DAY}T10:{minute:02d}:00'))
+        dialog_id = dict(con.execute("SELECT chat_id, id FROM dialogs").fetchall())
+        con.executemany("INSERT INTO dialog_participants (dialog_id, user_id) VALUES (?, ?)",
+                        [(dialog_id[101], 7), (dialog_id[101], 8), (dialog_id[103], 7)])
+        con.executemany("INSERT INTO messages (dialog_chat_id, author_id, message_text, timestamp) VALUES (?, ?, ?, ?)",
+                        [(101, 7, 'привет', f'{DAY}T10:00:30'),
+                         (101, 8, 'здравствуйте', f'{DAY}T10:01:00'),
+                         (103, 7, 'вчерашнее', '2025-02-02T10:00:00'),   # вне периода
+                         (103, 7, 'ещё вопрос', f'{DAY}T10:21:00')])
+        yield main.app.test_client()
+        main.close_db()
+
+def get(client, **args):
+    r = client.get('/api/dialogs/batch', query_string=dict(date=DAY, **args), headers=BEARER)
+    assert r.status_code == 200, r.get_data()
+    return r
+
+def test_summary_and_not_found(client):
+    body = get(client, chat_ids='103,999,101,103').get_json()
+    # порядок запроса, повторы схлопнуты
+    assert [d['chat_id'] for d in body['dialogs']] == [103, 101]
+    assert body['not_found'] == [999] and 'next_cursor' not in body
+    d103, d101 = body['dialogs']
+    assert d101['message_count'] == 2 and d101['last_message']['message_text'] == 'здравствуйте'
+    assert d103['message_count'] == 1 and d103['last_message']['message_text'] == 'ещё вопрос'
+    assert [p['id'] for p in d101['participants']] == [7, 8]
+    assert 'messages' not in d101
+
+def test_post_body_with_messages(client):
+    r = client.post('/api/dialogs/batch', query_string={'date': DAY, 'messages': '1'},
+                    json={'chat_ids': [101, 102, 103]}, headers=BEARER)
+    assert r.status_code == 200, r.get_data()
+    dialogs = {d['chat_id']: d for d in r.get_json()['dialogs']}
+    assert [m['message_text'] for m in dialogs[101]['messages']] == ['привет', 'здравствуйте']
+    assert dialogs[102]['messages'] == [] and dialogs[102]['message_count'] == 0
+    assert dialogs[102]['last_message'] is None
+    assert [m['message_text'] for m in dialogs[103]['messages']] == ['ещё вопрос']
+
+def test_ndjson_matches_json(client):
+    plain = get(client, chat_ids='101,103,5', messages='1').get_json()
+    r = get(client, chat_ids='101,103,5', messages='1', stream='ndjson')
+    assert r.mimetype == main.NDJSON_MIMETYPE
+    lines = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    assert lines[:-1] == plain['dialogs'] and lines[-1] == {'not_found': [5]}
+
+def test_filter_pages(client):
+    seen, cursor = [], None
+    while True:
+        body = get(client, limit=2, **({'cursor': cursor} if cursor else {})).get_json()
+        assert body['not_found'] == []
+        seen += [d['chat_id'] for d in body['dialogs']]
+        cursor = body['next_cursor']
+        if cursor is None:
+            break
+    assert sorted(seen) == [101, 102, 103] and len(seen) == 3
+
+def test_bad_args(client):
+    for args in ({'chat_ids': 'x'}, {'chat_ids': '101', 'limit': '2'},
+                 {'chat_ids': ','.join(str(i) for i in range(main.API_BATCH_MAX + 1))}):
+        r = client.get('/api/dialogs/batch', query_string=dict(date=DAY, **args), headers=BEARER)
+        assert r.status_code == 400, args
+    r = client.post('/api/dialogs/batch', query_string={'date': DAY}, json=[101], headers=BEARER)
+    assert r.status_code == 400
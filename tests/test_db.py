@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""Соединения потока: LRU не вытесняет соединение посреди транзакции и закрывает то, что вытеснил."""
+import threading
+
+import pytest
+
+import main
+
+def in_thread(fn):
+    # у нового потока свой набор соединений — соединения других тестов не трогаем
+    out = {}
+
+    def run():
+        try:
+            out['result'] = fn()
+        finally:
+            main.close_db()
+    th = threading.Thread(target=run)
+    th.start()
+    th.join(10)
+    return out['result']
+
+def test_lru_skips_connection_in_transaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'DB_MAX_CONNS_PER_THREAD', 2)
+    x, y, z = (str(tmp_path / f'{name}.db') for name in 'xyz')
+
+    def scenario():
+        with main.db_tx(x) as con_x:
+            con_x.execute("CREATE TABLE t (v)")
+            con_y = main.get_db(y)
+            main.get_db(z)                    # лишнее: x в транзакции, вытесняется y
+            con_x.execute("INSERT INTO t VALUES (1)")
+        return con_x, con_y, list(main._db_local.conns)
+
+    con_x, con_y, paths = in_thread(scenario)
+    assert paths == [x, z]
+    with pytest.raises(main.sqlite3.ProgrammingError):
+        con_y.execute("SELECT 1")             # вытесненное закрыто, а не брошено
+    check = main.sqlite3.connect(x)
+    assert check.execute("SELECT v FROM t").fetchall() == [(1,)]
+    check.close()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Дедупликация вебхуков: ключ в webhook_events общий для воркеров, кэш в памяти — у каждого свой."""
+import contextlib
+
+import pytest
+
+import main
+
+@pytest.fixture
+def worker():
+    """worker('a') — контекст, в котором claim/release идут с кэшами воркера a."""
+    main.migrate_db()
+    t = main.tenant()
+    own, caches = t.caches, {}
+
+    @contextlib.contextmanager
+    def use(name):
+        t.caches = caches.setdefault(name, main.new_write_caches())
+        try:
+            yield
+        finally:
+            t.caches = own
+    return use
+
+def test_redelivery_after_release_reaches_other_worker(worker):
+    key = 'msg:dedup-race'
+    with worker('a'):
+        assert main.claim_event(key)          # A обрабатывает оригинал
+    with worker('b'):
+        assert not main.claim_event(key)      # повтор, пока A занят, — дубль
+    with worker('a'):
+        main.release_event(key)               # A не справился и ответил 500
+    with worker('b'):
+        assert main.claim_event(key)          # повтор Б24 попал к B и принят
+    with worker('a'):
+        assert not main.claim_event(key)
+
+def test_processed_event_stays_duplicate(worker):
+    key = 'msg:dedup-done'
+    with worker('a'):
+        assert main.claim_event(key)
+        assert not main.claim_event(key)
+    with worker('b'):
+        assert not main.claim_event(key)
+        assert not main.claim_event(key)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""ETag: повторный GET без изменений — 304 или тело из кэша, любая запись меняет ETag."""
+import pytest
+
+import main
+
+BEARER = {'Authorization': 'Bearer tok'}
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'INGEST_MODE', 'direct')
+    t = main.Tenant('etag', str(tmp_path), 'tok', 'code')
+    with main.use_tenant(t):
+        main.migrate_db()
+        assert main.ingest_event(940001, 97, 'Клиент', 'client', 'первое')
+        yield main.app.test_client()
+        main.close_db()
+
+def get(client, path, etag=None, **args):
+    headers = dict(BEARER, **({'If-None-Match': etag} if etag else {}))
+    return client.get(path, query_string=args, headers=headers)
+
+def test_not_modified_until_write(client):
+    first = get(client, '/api/dialogs/940001')
+    assert first.status_code == 200 and first.headers['Cache-Control'] == 'no-cache'
+    etag = first.headers['ETag']
+    texts = [m['message_text'] for m in first.get_json()['messages']]
+    assert texts == ['первое']
+
+    again = get(client, '/api/dialogs/940001', etag)
+    assert again.status_code == 304 and again.headers['ETag'] == etag and again.get_data() == b''
+
+    assert main.ingest_event(940001, 97, 'Клиент', 'client', 'второе')
+    changed = get(client, '/api/dialogs/940001', etag)
+    assert changed.status_code == 200 and changed.headers['ETag'] != etag
+    assert [m['message_text'] for m in changed.get_json()['messages']] == ['первое', 'второе']
+
+def test_repeat_served_from_cache(client):
+    cache = main.tenant().caches['responses']
+    first = get(client, '/api/users')
+    hits = cache.stats()['hits']
+    second = get(client, '/api/users')
+    assert second.status_code == 200 and second.get_data() == first.get_data()
+    assert second.headers['ETag'] == first.headers['ETag'] and cache.stats()['hits'] == hits + 1
+    # новый пользователь — старое тело из кэша не отдаётся
+    assert main.ingest_event(940002, 98, 'Оператор', 'operator', 'ответ')
+    third = get(client, '/api/users')
+    assert third.headers['ETag'] != first.headers['ETag']
+    assert {u['id'] for u in third.get_json()} == {97, 98}
+
+def test_etag_depends_on_query(client):
+    one = get(client, '/api/dialogs', tz_offset='0').headers['ETag']
+    other = get(client, '/api/dialogs', tz_offset='3').headers['ETag']
+    assert one != other
+    assert get(client, '/api/dialogs', other, tz_offset='0').status_code == 200
+
+def test_streamed_and_post_not_cached(client):
+    cache = main.tenant().caches['responses']
+    r = get(client, '/api/dialogs', stream='json')
+    assert r.is_streamed and r.status_code == 200 and cache.stats()['size'] == 0
+    assert get(client, '/api/dialogs', r.headers['ETag'], stream='json').status_code == 304
+    r = client.post('/api/dialogs/batch', json={'chat_ids': [940001]}, headers=BEARER)
+    assert r.status_code == 200 and 'ETag' not in r.headers
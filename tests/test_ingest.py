@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Запись события вебхука: целиком или никак — напрямую, групповым коммитом и в режиме async."""
+import logging
+
+import pytest
+
+import main
+
+@pytest.fixture
+def reject_boom():
+    """Сообщение с текстом 'boom' не записывается (ошибка посреди события)."""
+    main.migrate_db()
+    con = main.get_db()
+    con.execute("CREATE TRIGGER IF NOT EXISTS test_reject_boom BEFORE INSERT ON messages "
+                "WHEN NEW.message_text = 'boom' BEGIN SELECT RAISE(ABORT, 'rejected'); END")
+    yield con
+    con.execute("DROP TRIGGER IF EXISTS test_reject_boom")
+
+def dialog_exists(con, chat_id):
+    return con.execute("SELECT 1 FROM dialogs WHERE chat_id = ?", (chat_id,)).fetchone() is not None
+
+def test_direct_event_rolls_back_whole(reject_boom, monkeypatch):
+    monkeypatch.setattr(main, 'INGEST_MODE', 'direct')
+    assert not main.ingest_event(910001, 91, 'Клиент', 'client', 'boom')
+    assert not dialog_exists(reject_boom, 910001)
+    assert not reject_boom.execute("SELECT 1 FROM dialog_participants WHERE user_id = 91").fetchone()
+    assert main.ingest_event(910001, 91, 'Клиент', 'client', 'привет')
+    assert dialog_exists(reject_boom, 910001)
+
+def test_group_commit_isolates_failed_event(reject_boom, monkeypatch):
+    monkeypatch.setattr(main, 'INGEST_MODE', 'group')
+    # одна пачка: плохое событие откатывается, соседние записываются
+    events = [(910002, 'раз'), (910003, 'boom'), (910004, 'два')]
+    states = [main.ingest_writer.submit({
+        'chat_id': chat_id, 'user_id': 92, 'user_name': 'Клиент', 'role': 'client', 'message_text': text,
+        'message_id': None, 'event_key': None, 'ts': '2025-01-31T10:00:00', 'tenant': main.tenant(),
+    }, wait=(chat_id == events[-1][0])) for chat_id, text in events]
+    assert states == [main.SUBMIT_QUEUED, main.SUBMIT_QUEUED, main.SUBMIT_COMMITTED]
+    assert [dialog_exists(reject_boom, chat_id) for chat_id, _ in events] == [True, False, True]
+    assert not main.ingest_event(910005, 92, 'Клиент', 'client', 'boom')
+
+def test_async_failure_releases_key(reject_boom, monkeypatch, caplog):
+    monkeypatch.setattr(main, 'INGEST_MODE', 'async')
+    key = 'msg:910006'
+    assert main.claim_event(key)
+    with caplog.at_level(logging.CRITICAL):
+        assert main.ingest_event(910006, 93, 'Клиент', 'client', 'boom', 910006, event_key=key)
+        assert main.ingest_writer.flush()
+    assert not dialog_exists(reject_boom, 910006)
+    assert any('NOT written' in r.getMessage() and '910006' in r.getMessage() for r in caplog.records)
+    # ключ свободен: повтор Б24 (или ручной) будет записан
+    assert main.claim_event(key)
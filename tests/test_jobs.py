@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Очередь REST-задач: аренда брошенной задачи истекает, исчерпавшая попытки уходит в dead letters."""
+import pytest
+
+import main
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    """Очередь без потоков-исполнителей на отдельном инстансе и управляемые часы."""
+    clock = [1_700_000_000.0]
+    monkeypatch.setattr(main, 'unix_time', lambda: clock[0])
+    monkeypatch.setattr(main, 'get_current_auth', lambda: {'access_token': 'x', 'client_endpoint': 'https://b24.test/rest/'})
+    q = main.JobQueue(workers=1, poll_sec=0.01)
+    monkeypatch.setattr(q, 'ensure_started', lambda: None)
+    # фоновые исполнители других тестов обслуживают только инстанс по умолчанию
+    t = main.Tenant('jobs', str(tmp_path), 'tok', 'code')
+    with main.use_tenant(t):
+        main.migrate_db()
+        q.clock = clock
+        yield q
+        main.close_db()
+
+def test_abandoned_job_is_reclaimed_after_lease(queue):
+    job_id = queue.enqueue('session_transfer', {'chat_id': 55})
+    job = queue._claim()
+    assert job['id'] == job_id and job['attempts'] == 1
+    # воркер умер посреди задачи: до конца аренды её никто не берёт
+    queue.clock[0] += main.JOB_LEASE_SEC - 1
+    assert queue._claim() is None
+    queue.clock[0] += 2
+    again = queue._claim()
+    assert again['id'] == job_id and again['attempts'] == 2
+
+def test_failing_transfer_goes_to_dead_letters(queue, monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, 'JOB_MAX_ATTEMPTS', 2)
+    monkeypatch.setattr(main, 'rest_command', lambda auth, method, params, priority: calls.append(method) or {'error': 'NOT_FOUND'})
+    job_id = queue.enqueue('session_transfer', {'chat_id': 55})
+
+    assert queue.run_once()
+    row = main.get_db().execute("SELECT run_at, last_error FROM rest_jobs WHERE id = ?", (job_id,)).fetchone()
+    assert row['run_at'] > queue.clock[0] and 'session.transfer failed' in row['last_error']
+    assert not queue.run_once()               # отложена с backoff
+
+    queue.clock[0] = row['run_at']
+    assert queue.run_once()
+    assert calls == ['imopenlines.bot.session.transfer'] * 2
+    assert queue.stats() == {'pending': {}, 'dead': 1}
+    dead = queue.dead_letters()
+    assert [(d['id'], d['attempts']) for d in dead] == [(job_id, 2)] and 'NOT_FOUND' in dead[0]['last_error']
+
+    # из dead letters — обратно в очередь
+    assert queue.retry_dead(job_id)
+    assert queue.stats() == {'pending': {'session_transfer': 1}, 'dead': 0}
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""Лог: хвост и follow фильтруют запись целиком, запись в очереди не зависит от дальнейших изменений аргументов."""
+import logging
+import os
+
+import pytest
+
+import main
+
+LOG = (
+    "2025-01-31 10:00:00,000 - INFO - root:1 - Received event for chat 55\n"
+    "2025-01-31 10:00:01,000 - ERROR - root:2 - Failed to save message for chat 55\n"
+    "Traceback (most recent call last):\n"
+    "  File \"main.py\", line 1, in save_message\n"
+    "sqlite3.OperationalError: database is locked\n"
+    "2025-01-31 10:00:02,000 - ERROR - root:3 - Failed for chat 77\n"
+    "Traceback (most recent call last):\n"
+    "ValueError: chat 55 mentioned only in traceback\n"
+)
+
+@pytest.fixture
+def log_file(tmp_path, monkeypatch):
+    path = str(tmp_path / 'bot.log')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(LOG)
+    monkeypatch.setattr(main, 'LOG_FILE', path)
+    monkeypatch.setattr(main, 'LOG_BACKUP_COUNT', 0)
+    monkeypatch.setattr(main, 'LOG_FOLLOW_POLL_SEC', 0.01)
+    return path
+
+@pytest.mark.parametrize('args', [{'chat_id': '55'}, {'level': 'ERROR'}, {'chat_id': '55', 'level': 'ERROR'}])
+def test_follow_matches_tail(log_file, args):
+    flt = main.LogFilter(**args)
+    tail = list(reversed(list(main.tail_log_records(flt, 100))))
+    follow = list(main.follow_log_records(flt, (os.stat(log_file).st_ino, 0), 0.1))
+    assert follow and follow == tail
+
+def test_follow_keeps_traceback_with_record(log_file):
+    flt = main.LogFilter(chat_id='55', level='ERROR')
+    records = list(main.follow_log_records(flt, (os.stat(log_file).st_ino, 0), 0.1))
+    assert len(records) == 2
+    assert records[0].endswith('sqlite3.OperationalError: database is locked\n')
+    assert records[1].startswith('2025-01-31 10:00:02,000 - ERROR')
+
+def test_prepare_snapshots_mutable_args():
+    payload, secret = {'state': 'before'}, main.Redacted({'access_token': 'abcdefghijkl'})
+    record = logging.LogRecord('root', logging.INFO, 'main.py', 1, 'got %s %r %d %s', (payload, ['x'], 5, secret), None)
+    main.queue_handler.prepare(record)
+    payload['state'] = 'after'  # поток запроса продолжил работу, запись ещё в очереди
+    assert record.getMessage() == "got {'state': 'before'} ['x'] 5 {'access_token': 'abcd…ijkl'}"
+    assert record.args[3] is secret
+
+def test_listener_restarted_in_forked_child():
+    marker = f'forked child {os.getpid()}'
+    pid = os.fork()
+    if pid == 0:
+        try:
+            logging.warning(marker)
+            main._stop_log_listener()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    with open(main.LOG_FILE, encoding='utf-8') as f:
+        assert marker in f.read()
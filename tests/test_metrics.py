@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Метрики: снимки воркеров складываются, счётчики умерших не теряются, вывод — формат Prometheus."""
+import json
+import os
+
+import pytest
+
+import main
+from conftest import API_TOKEN
+
+DEAD_PID = 999_999_999   # больше pid_max — такого процесса нет
+
+@pytest.fixture
+def metrics(tmp_path):
+    return main.Metrics(str(tmp_path / 'metrics'), 3600)
+
+def test_counters_and_histograms_rendered(metrics):
+    metrics.inc('b24bot_jobs_total', kind='send', outcome='ok')
+    metrics.inc('b24bot_jobs_total', 2, kind='send', outcome='ok')
+    for seconds in (0.003, 0.02, 0.02, 40):
+        metrics.observe('b24bot_http_duration_seconds', seconds, route='dialogs')
+    text = main.render_metrics(metrics.collect(), [('b24bot_jobs_pending', {}, 4)])
+    lines = text.splitlines()
+    assert '# TYPE b24bot_jobs_total counter' in lines
+    assert 'b24bot_jobs_total{kind="send",outcome="ok"} 3' in lines
+    assert 'b24bot_jobs_pending 4' in lines and 'b24bot_workers 1' in lines
+    # корзины накопительные, +Inf — все наблюдения
+    assert 'b24bot_http_duration_seconds_bucket{route="dialogs",le="0.005"} 1' in lines
+    assert 'b24bot_http_duration_seconds_bucket{route="dialogs",le="0.025"} 3' in lines
+    assert 'b24bot_http_duration_seconds_bucket{route="dialogs",le="30"} 3' in lines
+    assert 'b24bot_http_duration_seconds_bucket{route="dialogs",le="+Inf"} 4' in lines
+    assert 'b24bot_http_duration_seconds_count{route="dialogs"} 4' in lines
+    assert 'b24bot_http_duration_seconds_sum{route="dialogs"} 40.043000' in lines
+
+def test_dead_worker_counters_retired(metrics):
+    metrics.inc('b24bot_jobs_total', kind='send', outcome='ok')
+    os.makedirs(metrics.directory, exist_ok=True)
+    dead = {'pid': DEAD_PID, 'time': 0,
+            'values': [['b24bot_jobs_total', {'kind': 'send', 'outcome': 'ok'}, 5],
+                       ['b24bot_queue_depth', {}, 7]],
+            'hists': [['b24bot_http_duration_seconds', {'route': 'x'},
+                       [1] + [0] * len(main.LATENCY_BUCKETS), 0.001]]}
+    with open(os.path.join(metrics.directory, f'{DEAD_PID}.json'), 'w') as f:
+        json.dump(dead, f)
+
+    for _ in range(2):   # второй сбор не должен добавить снимок умершего ещё раз
+        got = metrics.collect()
+        assert got['workers'] == 1
+        assert got['values'][('b24bot_jobs_total', (('kind', 'send'), ('outcome', 'ok')))] == 6
+        assert ('b24bot_queue_depth', ()) not in got['values']           # gauge умершего выброшен
+        assert got['hists'][('b24bot_http_duration_seconds', (('route', 'x'),))][0][0] == 1
+    assert not os.path.exists(os.path.join(metrics.directory, f'{DEAD_PID}.json'))
+
+def test_disabled_metrics_write_nothing(tmp_path):
+    off = main.Metrics(str(tmp_path / 'off'), 3600, enabled=False)
+    off.inc('b24bot_jobs_total', kind='send', outcome='ok')
+    off.flush()
+    assert off.snapshot()['values'] == [] and not os.path.exists(off.directory)
+
+def test_admin_endpoint(metrics, monkeypatch):
+    monkeypatch.setattr(main, 'metrics', metrics)
+    monkeypatch.setattr(main, 'METRICS_ENABLED', True)
+    metrics.inc('b24bot_webhook_requests_total', event='ONIMBOTMESSAGEADD', status=200)
+    client = main.app.test_client()
+    assert client.get('/api/admin/metrics').status_code == 403
+    assert client.get('/api/admin/metrics', query_string={'token': 'wrong'}).status_code == 403
+    r = client.get('/api/admin/metrics', query_string={'token': API_TOKEN})
+    assert r.status_code == 200 and r.mimetype == 'text/plain'
+    text = r.get_data(as_text=True)
+    assert 'b24bot_webhook_requests_total{event="ONIMBOTMESSAGEADD",status="200"} 1' in text.splitlines()
+    assert '# TYPE b24bot_jobs_pending gauge' in text
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""Миграции: каждая коммитится отдельно, сбой не откатывает уже применённые и не глушится."""
+import pytest
+
+import main
+
+def test_failed_migration_keeps_earlier_steps(tmp_path, monkeypatch):
+    def broken(con):
+        con.execute("CREATE TABLE half_done (x)")
+        raise RuntimeError('no such module: fts5')
+
+    path = str(tmp_path / 'dialogs.db')
+    last = main.SCHEMA_VERSION
+    monkeypatch.setattr(main, 'MIGRATIONS', main.MIGRATIONS + [(last + 1, 'broken', broken)])
+    monkeypatch.setattr(main, 'SCHEMA_VERSION', last + 1)
+    with pytest.raises(RuntimeError):
+        main.migrate_db(path)
+    con = main.get_db(path)
+    assert main.schema_version(path) == last
+    tables = {row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'dialogs', 'messages', 'users'} <= tables and 'half_done' not in tables
+
+    # починили — следующий запуск продолжает с упавшего шага
+    monkeypatch.setattr(main, 'MIGRATIONS', main.MIGRATIONS[:-1] + [(last + 1, 'fixed', lambda con: None)])
+    main.migrate_db(path)
+    assert main.schema_version(path) == last + 1
+    main.close_db(path)
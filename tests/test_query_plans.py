@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Горячие запросы API (main.INDEXED_API_QUERIES) идут по индексам.
+
+Полный проход по messages, dialogs, dialog_participants или users — в плане
+это "SCAN <таблица или псевдоним>", в том числе по покрывающему индексу —
+роняет тест. Допустим только SCAN табличной функции json_each. То же — для
+запросов к подключённому архиву.
+"""
+import os
+
+import pytest
+
+import main
+
+@pytest.fixture(scope='module')
+def db(tmp_path_factory):
+    path = os.path.join(str(tmp_path_factory.mktemp('plans')), 'dialogs.db')
+    main.migrate_db(path)
+    yield path
+    main.close_db(path)
+
+def full_scans(plan):
+    return [d for d in plan if d.startswith('SCAN') and 'VIRTUAL TABLE' not in d]
+
+@pytest.mark.parametrize('name', sorted(main.INDEXED_API_QUERIES))
+def test_query_uses_index(db, name):
+    sql, params = main.INDEXED_API_QUERIES[name]
+    plan = [row['detail'] for row in main.get_db(db).execute("EXPLAIN QUERY PLAN " + main.in_schema(sql), params)]
+    assert not full_scans(plan), f"{name}: {plan}"
+
+# запросы, которые читают и архивы (шаблоны in_schema с таблицами архива)
+ARCHIVE_QUERIES = ['dialogs_by_time', 'dialogs_after', 'dialog_by_chat', 'dialog_participants', 'dialog_messages',
+                   'dialog_messages_after', 'batch_dialogs', 'batch_participants', 'batch_summary', 'batch_last',
+                   'batch_messages']
+
+@pytest.mark.parametrize('name', ARCHIVE_QUERIES)
+def test_archive_query_uses_index(db, name):
+    # in_schema подменяет таблицы подзапросом без строк, оставшихся в горячей БД
+    con = main.get_db(db)
+    schema = main.attach_archives(con, ['2000-01'], db, create=True)[0]
+    main._ensure_archive_schema(con, schema)
+    sql, params = main.INDEXED_API_QUERIES[name]
+    plan = [row['detail'] for row in con.execute("EXPLAIN QUERY PLAN " + main.in_schema(sql, schema), params)]
+    assert not full_scans(plan), f"{name}: {plan}"
+
+def test_admin_report_agrees(db):
+    report = main.check_query_plans(db)
+    assert set(report) == set(main.INDEXED_API_QUERIES)
+    assert all(entry['indexed'] for entry in report.values()), report
+
+def test_detects_dropped_index(tmp_path):
+    path = str(tmp_path / 'dialogs.db')
+    main.migrate_db(path)
+    con = main.get_db(path)
+    con.execute("DROP INDEX idx_messages_chat_ts")
+    sql, params = main.INDEXED_API_QUERIES['dialog_messages']
+    plan = [row['detail'] for row in con.execute("EXPLAIN QUERY PLAN " + main.in_schema(sql), params)]
+    main.close_db(path)
+    assert full_scans(plan)
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""Лимитер REST: общий token bucket на портал, срочные вызовы проходят раньше фоновых."""
+import pytest
+
+import main
+
+PORTAL = 'b24.test'
+
+@pytest.fixture
+def limiter(tmp_path, monkeypatch):
+    clock = [1_700_000_000.0]
+    monkeypatch.setattr(main, 'unix_time', lambda: clock[0])
+    rl = main.RateLimiter(str(tmp_path / 'ratelimit.db'), rate=2.0, burst=2)
+    rl.clock = clock
+    yield rl
+    main.close_db(rl.path)
+
+def test_burst_then_rate(limiter):
+    for _ in range(2):
+        assert limiter.try_acquire(PORTAL, limiter.join(PORTAL)) is None
+    ticket = limiter.join(PORTAL)
+    assert limiter.try_acquire(PORTAL, ticket) == pytest.approx(0.5)
+    limiter.clock[0] += 0.5
+    assert limiter.try_acquire(PORTAL, ticket) is None
+    # другой портал — своё ведро
+    assert limiter.try_acquire('other.test', limiter.join('other.test')) is None
+
+def test_transfer_overtakes_background(limiter):
+    for _ in range(2):
+        assert limiter.try_acquire(PORTAL, limiter.join(PORTAL)) is None
+    refresh = limiter.join(PORTAL, main.PRIORITY_REFRESH)
+    default = limiter.join(PORTAL, main.PRIORITY_DEFAULT)
+    transfer = limiter.join(PORTAL, main.PRIORITY_TRANSFER)
+    limiter.clock[0] += 0.5  # хватает на один токен
+    # токен достаётся только голове очереди — пришедшему последним, но срочному
+    assert limiter.try_acquire(PORTAL, refresh) is not None
+    assert limiter.try_acquire(PORTAL, default) is not None
+    assert limiter.try_acquire(PORTAL, transfer) is None
+    assert limiter.state()['portals'][PORTAL]['waiting'] == {main.PRIORITY_DEFAULT: 1, main.PRIORITY_REFRESH: 1}
+    limiter.clock[0] += 0.5
+    assert limiter.try_acquire(PORTAL, refresh) is not None
+    assert limiter.try_acquire(PORTAL, default) is None
+    limiter.clock[0] += 0.5
+    assert limiter.try_acquire(PORTAL, refresh) is None
+
+def test_query_limit_blocks_portal(limiter):
+    limiter.penalize(PORTAL, 3)
+    ticket = limiter.join(PORTAL, main.PRIORITY_TRANSFER)
+    assert limiter.try_acquire(PORTAL, ticket) == pytest.approx(3)
+    limiter.clock[0] += 3
+    assert limiter.try_acquire(PORTAL, ticket) is None
+
+def test_dead_waiter_does_not_block_queue(limiter):
+    stuck = limiter.join(PORTAL, main.PRIORITY_TRANSFER)   # воркер умер, не сняв билет
+    limiter.clock[0] += main.RateLimiter.STALE_WAITER_SEC + 1
+    ticket = limiter.join(PORTAL)
+    assert limiter.try_acquire(PORTAL, ticket) is None
+    assert main.get_db(limiter.path).execute("SELECT 1 FROM waiters WHERE id = ?", (stuck,)).fetchone() is None
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""REST Б24: batch режется по REST_BATCH_LIMIT, ответы раскладываются по ключам команд."""
+from urllib.parse import unquote
+
+import main
+
+AUTH = {'access_token': 't', 'client_endpoint': 'https://b24.test/rest/'}
+
+def run(commands, portal, halt=False):
+    """Выполняет rest_batch_steps против portal(cmd) -> ответ batch; возвращает результат и отправленные cmd."""
+    sent = []
+    steps = main.rest_batch_steps(AUTH, commands, halt=halt)
+    try:
+        call = next(steps)
+        while True:
+            _, method, params, _ = call
+            assert method == 'batch' and params['halt'] == (1 if halt else 0)
+            sent.append(params['cmd'])
+            call = steps.send(portal(params['cmd']))
+    except StopIteration as e:
+        return e.value, sent
+
+def echo(cmd):
+    return {'result': {'result': {key: unquote(q) for key, q in cmd.items()}, 'result_error': [],
+                       'result_total': [], 'result_next': []}}
+
+def test_batch_is_chunked_and_mapped_back():
+    commands = {f'u{i}': ('user.get', {'ID': [i, i + 1], 'ACTIVE': True}) for i in range(main.REST_BATCH_LIMIT + 3)}
+    out, sent = run(commands, echo)
+    assert [len(cmd) for cmd in sent] == [main.REST_BATCH_LIMIT, 3]
+    assert out['u7'] == {'result': 'user.get?ID[0]=7&ID[1]=8&ACTIVE=Y', 'total': None, 'next': None}
+    assert list(out) == list(commands)
+
+def test_batch_errors_and_halt():
+    def portal(cmd):
+        return {'result': {'result': {'a': {'ok': 1}}, 'result_error': {'b': {'error': 'NOT_FOUND'}},
+                           'result_total': {'a': 1}, 'result_next': {}}}
+    commands = {'a': ('im.chat.get', {}), 'b': ('im.chat.get', {}), 'c': ('im.chat.get', {})}
+    out, _ = run(commands, portal, halt=True)
+    assert out == {'a': {'result': {'ok': 1}, 'total': 1, 'next': None}, 'b': {'error': 'NOT_FOUND'},
+                   'c': {'error': 'not_executed', 'error_description': 'batch halted'}}
+    # ошибка всего batch — у каждой команды
+    out, _ = run(commands, lambda cmd: {'error': 'expired_token', 'error_description': 'expired'})
+    assert set(out) == set(commands) and all(v == {'error': 'expired_token', 'error_description': 'expired'}
+                                             for v in out.values())
+
+def test_session_reused_per_portal():
+    one = main._http_session('https://b24.test/rest/user.get')
+    assert main._http_session('https://b24.test/rest/batch') is one
+    assert main._http_session('https://other.test/rest/batch') is not one
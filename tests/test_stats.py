@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Статистика: триггеры при записи и stats-backfill по той же истории дают одинаковые счётчики."""
+import pytest
+
+import main
+
+# (chat_id, автор, время) в порядке записи; клиент 2 в чате 1 пишет «задним числом»
+HISTORY = [
+    (1, 101, '2025-01-31T10:03:00'),
+    (1, 201, '2025-01-31T10:05:00'),
+    (1, 101, '2025-01-31T10:01:00'),
+    (2, 102, '2025-01-31T11:00:00'),
+    (2, 201, '2025-01-31T11:30:00'),
+    (2, 202, '2025-01-31T11:10:00'),
+    (3, 201, '2025-01-31T12:00:00'),
+]
+
+@pytest.fixture
+def con(tmp_path):
+    t = main.Tenant('stats', str(tmp_path), 'tok', 'code')
+    with main.use_tenant(t):
+        main.migrate_db()
+        con = main.get_db()
+        con.executemany("INSERT INTO users (id, user_name, role) VALUES (?, ?, ?)",
+                        [(101, 'К1', 'client'), (102, 'К2', 'client'), (201, 'М1', 'manager'), (202, 'М2', 'manager')])
+        for chat_id in (1, 2, 3):
+            con.execute("INSERT INTO dialogs (chat_id, start_time) VALUES (?, ?)", (chat_id, f'2025-01-31T{9 + chat_id}:00:00'))
+        with main.db_tx() as tx:
+            tx.executemany("INSERT INTO messages (dialog_chat_id, author_id, message_text, timestamp) VALUES (?, ?, 'x', ?)",
+                           HISTORY)
+        yield con
+        main.close_db()
+
+def snapshot(con):
+    out = {table: sorted(tuple(r) for r in con.execute(f"SELECT * FROM {table}"))
+           for table in ('stats_messages', 'stats_dialogs')}
+    # триггер, переносящий диалог в другую корзину, оставляет в старой 0 — пересчёт её не создаёт
+    out['stats_response'] = [tuple(r) for r in con.execute("SELECT * FROM stats_response WHERE dialogs <> 0 ORDER BY 1, 2")]
+    out['dialogs'] = [tuple(r) for r in con.execute("SELECT chat_id, first_client_at, first_response_sec FROM dialogs ORDER BY chat_id")]
+    return out
+
+def test_backfill_matches_triggers(con):
+    live = snapshot(con)
+    # ответ считается от раннего сообщения клиента, даже если оно записано позже ответа
+    assert live['dialogs'] == [(1, '2025-01-31T10:01:00', 240.0), (2, '2025-01-31T11:00:00', 600.0), (3, None, None)]
+    # пачка в одно сообщение: ранний клиент чата 1 попадает в пачку уже после ответа менеджера
+    assert main.stats_backfill(rebuild=True, batch=1) == len(HISTORY)
+    assert snapshot(con) == live
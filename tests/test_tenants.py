@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Мультитенантный режим: БД, кэши и токены инстансов раздельны, общие эндпойнты — под токеном пула."""
+import logging
+import threading
+
+import pytest
+
+import main
+
+POOL_TOKEN = 'pool-token'
+TODAY = main.datetime.now().strftime('%Y-%m-%d')
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    """Реестр из двух инстансов a и b; app обслуживает их, как сервис с TENANTS_ROOT."""
+    root, env_dir = tmp_path / 'b24bots', tmp_path / 'env'
+    env_dir.mkdir()
+    for name in ('a', 'b'):
+        (root / name).mkdir(parents=True)
+        (env_dir / f'{name}.env').write_text(f'API_SECRET_TOKEN=tok-{name}\n', encoding='utf-8')
+    registry = main.TenantRegistry(str(root), str(env_dir), idle_sec=900, max_active=100)
+    monkeypatch.setattr(main, 'tenants', registry)
+    monkeypatch.setattr(main, 'POOL_ADMIN_TOKEN', POOL_TOKEN)
+    monkeypatch.setattr(main, 'INGEST_MODE', 'direct')
+    monkeypatch.setattr(main.app, 'wsgi_app', main.TenantMiddleware(main.app.wsgi_app, registry))
+    yield registry
+    for t in registry.active():
+        main.close_db(t.db_file)
+
+def get(path, token=None, **args):
+    headers = {'Authorization': f'Bearer {token}'} if token else {}
+    return main.app.test_client().get(path, query_string=args, headers=headers)
+
+def test_tenants_do_not_share_data(pool):
+    with main.use_tenant(pool.get('a')):
+        assert main.ingest_event(920001, 94, 'Клиент', 'client', 'только для a')
+    a, b = pool.get('a'), pool.get('b')
+    assert a.db_file != b.db_file and a.caches is not b.caches
+    assert a.caches['dialogs'].stats()['size'] == 1 and b.caches['dialogs'].stats()['size'] == 0
+
+    r = get('/a/api/dialogs', 'tok-a', date=TODAY)
+    assert r.status_code == 200 and [d['chat_id'] for d in r.get_json()] == [920001]
+    r = get('/b/api/dialogs', 'tok-b', date=TODAY)
+    assert r.status_code == 200 and r.get_json() == []
+    # токен одного инстанса не подходит другому, неизвестный инстанс — 404
+    assert get('/b/api/dialogs', 'tok-a').status_code == 401
+    assert get('/c/api/dialogs', 'tok-a').status_code == 404
+
+def test_pool_endpoints_need_pool_token(pool, monkeypatch):
+    for path in ('/a/api/admin/logging', '/a/api/admin/metrics', '/a/api/admin/ratelimit'):
+        assert main.app.test_client().get(path).status_code == 403
+        assert main.app.test_client().get(path, query_string={'token': 'tok-a'}).status_code == 403
+        assert main.app.test_client().get(path, query_string={'token': POOL_TOKEN}).status_code == 200
+    r = main.app.test_client().post('/a/api/admin/loglevel', query_string={'token': 'tok-a', 'level': 'DEBUG'})
+    assert r.status_code == 403
+    # своё по-прежнему под токеном инстанса
+    assert main.app.test_client().get('/a/api/admin/status', query_string={'token': 'tok-a'}).status_code == 200
+    monkeypatch.setattr(main, 'POOL_ADMIN_TOKEN', '')
+    assert main.app.test_client().get('/a/api/admin/metrics', query_string={'token': ''}).status_code == 403
+
+def test_retired_db_closed_in_other_threads(pool):
+    t = pool.get('a')
+    opened, resumed = threading.Event(), threading.Event()
+    seen = {}
+
+    def other_thread():
+        with main.use_tenant(t):
+            seen['before'] = main.get_db()
+            opened.set()
+            resumed.wait(5)
+            main.get_db(pool.get('b').db_file)  # любой следующий get_db() закрывает выгруженные
+            seen['after'] = main.get_db()
+            main.close_db()
+
+    th = threading.Thread(target=other_thread)
+    th.start()
+    assert opened.wait(5)
+    main.retire_db(t.db_file)
+    resumed.set()
+    th.join(5)
+    assert seen['after'] is not seen['before']
+    with pytest.raises(main.sqlite3.ProgrammingError):
+        seen['before'].execute("SELECT 1")
+
+def test_log_tag_added_by_formatter(pool):
+    record = logging.LogRecord('root', logging.INFO, 'main.py', 1, 'Saved %s', ('message',), None)
+    with main.use_tenant(pool.get('a')):
+        main._TenantLogTag().filter(record)
+    assert record.msg == 'Saved %s'
+    assert main.fmt.format(record).endswith(' - root:1 - [a] Saved message')
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""Кэши записи: повтор известного пользователя и участника не пишет в БД, откат не оставляет в кэше лишнего."""
+import pytest
+
+import main
+
+@pytest.fixture
+def traced(tmp_path, monkeypatch):
+    """Свой инстанс с пустыми кэшами; traced() — SQL, выполненный с прошлого вызова."""
+    monkeypatch.setattr(main, 'INGEST_MODE', 'direct')
+    t = main.Tenant('cache', str(tmp_path), 'tok', 'code')
+    with main.use_tenant(t):
+        main.migrate_db()
+        statements = []
+        main.get_db().set_trace_callback(statements.append)
+
+        def take():
+            out = [s for s in statements if not s.startswith(('BEGIN', 'COMMIT', 'ROLLBACK'))]
+            statements.clear()
+            return out
+        yield take
+        main.get_db().set_trace_callback(None)
+        main.close_db()
+
+def writes_to(statements, table):
+    return [s for s in statements if table in s and not s.lstrip().startswith('SELECT')]
+
+def test_known_user_and_participant_are_not_rewritten(traced):
+    assert main.ingest_event(930001, 95, 'Клиент', 'client', 'раз')
+    first = traced()
+    assert writes_to(first, 'users') and writes_to(first, 'dialog_participants')
+
+    assert main.ingest_event(930001, 95, 'Клиент', 'client', 'два')
+    second = traced()
+    assert not writes_to(second, 'users') and not writes_to(second, 'dialog_participants')
+    assert not [s for s in second if 'FROM dialogs' in s]           # id диалога — из кэша
+    assert any(s.startswith('INSERT OR IGNORE INTO messages ') for s in second)
+
+    # переименование — промах кэша, строка обновляется
+    assert main.ingest_event(930001, 95, 'Клиент Иванов', 'client', 'три')
+    assert writes_to(traced(), 'users')
+    assert main.get_db().execute("SELECT user_name FROM users WHERE id = 95").fetchone()[0] == 'Клиент Иванов'
+
+def test_rollback_clears_caches(traced):
+    con = main.get_db()
+    con.execute("CREATE TRIGGER reject_boom BEFORE INSERT ON messages WHEN NEW.message_text = 'boom' "
+                "BEGIN SELECT RAISE(ABORT, 'rejected'); END")
+    assert not main.ingest_event(930002, 96, 'Клиент', 'client', 'boom')
+    caches = main.tenant().caches
+    assert caches['users'].stats()['size'] == 0 and caches['participants'].stats()['size'] == 0
+    assert caches['dialogs'].stats()['size'] == 0
+    # диалог, пользователь и участник, «записанные» в откатившейся транзакции, пишутся заново
+    assert main.ingest_event(930002, 96, 'Клиент', 'client', 'ок')
+    assert con.execute("SELECT COUNT(*) FROM dialog_participants dp JOIN dialogs d ON d.id = dp.dialog_id "
+                       "WHERE d.chat_id = 930002 AND dp.user_id = 96").fetchone()[0] == 1